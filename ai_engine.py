@@ -1,48 +1,260 @@
-import google.generativeai as genai
+import asyncio
+import threading
+import random
 import time
 import re
 import os
-from settings import GEMINI_API_KEY # UPDATED IMPORT
+import metrics
+from datetime import datetime, timedelta, timezone
+from settings import (
+    GEMINI_API_KEY, GEMINI_MAX_CONCURRENT_UPLOADS, GEMINI_PROCESSING_TIMEOUT, GEMINI_FILE_MAX_AGE_MINUTES,
+    GEMINI_MODELS, MODEL_HEALTH_INTERVAL, GEMINI_RPM, GEMINI_TPM, GEMINI_QUOTAS, GEMINI_QUOTA_SHARE,
+    GEMINI_VIDEO_TOKENS, GEMINI_RATE_LIMIT_PAUSE,
+) # UPDATED IMPORT
 
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-except ImportError:
-    print("CRITICAL: GEMINI_API_KEY missing.")
+# --- LAZY MODEL SELECTION ---
+# google.generativeai is only imported, and a model only probed, the first time the AI is used,
+# so importing this module costs nothing at startup. The probe result is cached; a background
+# health check moves back to the preferred model, and errors that mean "this model is unusable"
+# fail over to the next one in GEMINI_MODELS.
 
-def get_working_model():
-    models_to_try = ['gemini-2.0-flash', 'gemini-2.5-flash-lite']
+_genai = None
+_model = None
+_model_name = None
+_unhealthy = {} # model name -> time it failed
+# _select_lock lets one thread at a time run the (slow, networked) probes; _model_lock only
+# guards swapping _model/_model_name and is never held across a network call, so the event
+# loop can take it in report_failure without stalling.
+_select_lock = threading.Lock()
+_model_lock = threading.Lock()
+
+# Errors worth switching models for (not e.g. a blocked prompt)
+FAILOVER_ERRORS = {
+    "NotFound", "PermissionDenied", "ResourceExhausted", "ServiceUnavailable",
+    "InternalServerError", "DeadlineExceeded", "TooManyRequests",
+}
+
+def get_genai():
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        try:
+            genai.configure(api_key=GEMINI_API_KEY)
+        except ImportError:
+            print("CRITICAL: GEMINI_API_KEY missing.")
+        _genai = genai
+    return _genai
+
+def probe_model(model_name):
+    """Cheap liveness check: count_tokens hits the model endpoint without spending generation quota."""
+    genai = get_genai()
+    model = genai.GenerativeModel(model_name)
+    model.count_tokens("test")
+    return model
+
+def select_model():
+    """Switches to the first working model, healthy ones first. Blocking: run it in a thread."""
     print("🤖 Selecting Video-Capable AI model...")
-    for model_name in models_to_try:
+    # Healthy models first, in preference order; recently failed ones only as a last resort
+    candidates = sorted(GEMINI_MODELS, key=lambda name: name in _unhealthy)
+    for model_name in candidates:
         try:
-            model = genai.GenerativeModel(model_name)
-            model.generate_content("test")
-            print(f"✅ Success: Connected to '{model_name}'")
-            return model
+            model = probe_model(model_name)
         except Exception as e:
             print(f"⚠️ Error with '{model_name}': {e}")
+            _unhealthy[model_name] = time.time()
             continue
+        print(f"✅ Success: Connected to '{model_name}'")
+        _set_model(model, model_name)
+        return model
     print("❌ CRITICAL: No working AI models found.")
+    _set_model(None, None)
     return None
 
-# Global model instance
-model = get_working_model()
+def _set_model(model, model_name):
+    global _model, _model_name
+    with _model_lock:
+        if model_name: _unhealthy.pop(model_name, None)
+        _model, _model_name = model, model_name
+
+def get_model():
+    if _model is not None: return _model
+    with _select_lock:
+        if _model is not None: return _model # Selected while we waited
+        return select_model()
+
+def model_name_of(model):
+    return getattr(model, "model_name", "default").removeprefix("models/")
+
+def report_failure(model, error):
+    """Called when a model call fails; drops the model if the error says it is unusable."""
+    global _model, _model_name
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        governor.pause(model_name_of(model), GEMINI_RATE_LIMIT_PAUSE)
+    if type(error).__name__ not in FAILOVER_ERRORS: return
+    with _model_lock:
+        if model is not _model: return # Someone already failed over
+        print(f"⚠️ Model '{_model_name}' failing ({type(error).__name__}), failing over")
+        _unhealthy[_model_name] = time.time()
+        _model, _model_name = None, None
+
+async def model_health_loop():
+    """Every MODEL_HEALTH_INTERVAL seconds, return to the preferred model once it works again."""
+    while True:
+        await asyncio.sleep(MODEL_HEALTH_INTERVAL)
+        if _model_name == GEMINI_MODELS[0]: continue
+        def refresh():
+            try: model = probe_model(GEMINI_MODELS[0])
+            except Exception: return
+            _set_model(model, GEMINI_MODELS[0])
+            print(f"✅ Back on preferred model '{GEMINI_MODELS[0]}'")
+        await asyncio.to_thread(refresh)
+
+# --- QUOTA GOVERNOR ---
+# A token bucket per model for requests and for tokens per minute, so we run close to the
+# quota instead of into a storm of 429s. Token use is estimated before a call and corrected
+# from usage_metadata after it. Interactive callers (Ask Nexus) go ahead of background ingestion:
+# while one is waiting, background calls don't take from the bucket.
+
+class QuotaGovernor:
+    def __init__(self, quotas, default, share=1.0):
+        self.quotas, self.default, self.share = quotas, default, share
+        self.buckets = {} # model name -> [requests left, tokens left, last refill]
+        self.interactive_waiting = 0
+
+    def limits(self, model_name):
+        rpm, tpm = self.quotas.get(model_name, self.default)
+        return max(rpm * self.share, 1), max(tpm * self.share, 1)
+
+    def refill(self, model_name):
+        rpm, tpm = self.limits(model_name)
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(model_name, [rpm, tpm, now])
+        elapsed = now - bucket[2]
+        bucket[0] = min(rpm, bucket[0] + elapsed * rpm / 60)
+        bucket[1] = min(tpm, bucket[1] + elapsed * tpm / 60)
+        bucket[2] = now
+        return bucket
+
+    async def acquire(self, model_name, tokens, interactive=False):
+        """Waits until the model has room for one request of ~tokens. Returns the tokens taken."""
+        rpm, tpm = self.limits(model_name)
+        tokens = min(tokens, tpm) # A bigger request would never fit
+        if interactive: self.interactive_waiting += 1
+        try:
+            while True:
+                bucket = self.refill(model_name)
+                if bucket[0] >= 1 and bucket[1] >= tokens and (interactive or not self.interactive_waiting):
+                    bucket[0] -= 1
+                    bucket[1] -= tokens
+                    return tokens
+                wait = max((1 - bucket[0]) * 60 / rpm, (tokens - bucket[1]) * 60 / tpm, 0.05)
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            if interactive: self.interactive_waiting -= 1
+
+    def settle(self, model_name, estimated, response):
+        """Charges the difference between the estimate and the real token count (may go into debt)."""
+        usage = getattr(response, "usage_metadata", None)
+        actual = getattr(usage, "total_token_count", None)
+        if not actual: return
+        self.refill(model_name)[1] -= actual - estimated
+
+    def pause(self, model_name, seconds):
+        """After a 429: empty the request bucket so nothing is sent for about `seconds`."""
+        rpm, _ = self.limits(model_name)
+        bucket = self.refill(model_name)
+        bucket[0] = min(bucket[0], -rpm * seconds / 60)
+        print(f"⏸️ Gemini quota hit on '{model_name}', pausing {seconds}s")
+
+governor = QuotaGovernor(GEMINI_QUOTAS, (GEMINI_RPM, GEMINI_TPM), GEMINI_QUOTA_SHARE)
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1024 # Prompt at ~4 chars per token, plus room for the answer
+
+# --- GEMINI FILE PIPELINE ---
+# Uploads are capped by a semaphore; server-side processing is polled with jittered
+# exponential backoff via asyncio.sleep, so waiting videos don't hold a thread each.
+# Every uploaded file is deleted in a finally block; sweep_orphan_files catches the rest
+# (e.g. a worker killed mid-analysis).
+
+UPLOAD_PREFIX = "nexus-"
+_upload_slots = None
+
+def get_upload_slots():
+    global _upload_slots
+    if _upload_slots is None: _upload_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENT_UPLOADS)
+    return _upload_slots
+
+async def delete_remote_file(name):
+    try: await asyncio.to_thread(get_genai().delete_file, name)
+    except Exception as e: print(f"⚠️ Gemini file cleanup failed ({name}): {e}")
 
-def upload_to_gemini_blocking(path, mime_type=None):
+async def upload_to_gemini(path, mime_type=None):
+    file = None
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
-        while file.state.name == "PROCESSING":
-            time.sleep(2)
-            file = genai.get_file(file.name)
-        if file.state.name == "FAILED": return None
+        async with metrics.timer("gemini_upload"):
+            async with get_upload_slots():
+                file = await asyncio.to_thread(
+                    get_genai().upload_file, path, mime_type=mime_type, display_name=f"{UPLOAD_PREFIX}{os.path.basename(path)}"
+                )
+
+        async with metrics.timer("gemini_processing"):
+            delay, deadline = 1.0, time.monotonic() + GEMINI_PROCESSING_TIMEOUT
+            while file.state.name == "PROCESSING":
+                if time.monotonic() > deadline: raise TimeoutError("Gemini processing timed out")
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, 15)
+                file = await asyncio.to_thread(get_genai().get_file, file.name)
+
+            if file.state.name == "FAILED": raise RuntimeError("Gemini processing failed")
         return file
-    except Exception: return None
+    except BaseException as e:
+        if file: await delete_remote_file(file.name)
+        if not isinstance(e, Exception): raise # Cancelled: clean up, then let it propagate
+        print(f"⚠️ Upload Error: {e}")
+        return None
+
+async def sweep_orphan_files():
+    """Deletes our uploads older than GEMINI_FILE_MAX_AGE_MINUTES that nobody cleaned up."""
+    def sweep():
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=GEMINI_FILE_MAX_AGE_MINUTES)
+        removed = 0
+        for f in get_genai().list_files():
+            if not (f.display_name or "").startswith(UPLOAD_PREFIX): continue
+            if f.create_time and f.create_time < cutoff:
+                try:
+                    get_genai().delete_file(f.name)
+                    removed += 1
+                except Exception: pass
+        return removed
+    try:
+        removed = await asyncio.to_thread(sweep)
+        if removed: print(f"🧹 Deleted {removed} orphaned Gemini files")
+    except Exception as e: print(f"⚠️ Gemini sweep failed: {e}")
 
-def analyze_with_video_blocking(video_path, title, description, url):
+async def analyze_with_video(video_path, title, description, url, mime_type="video/mp4"):
+    model = await asyncio.to_thread(get_model)
     if not model: return ("⚠️ AI Offline", "Inbox", None, None)
     
-    video_file = upload_to_gemini_blocking(video_path, mime_type="video/mp4")
+    video_file = await upload_to_gemini(video_path, mime_type=mime_type)
     if not video_file: return ("⚠️ Video processing failed.", "Inbox", None, None)
 
+    try:
+        prompt = build_analysis_prompt(title, description, url)
+        name = model_name_of(model)
+        estimated = await governor.acquire(name, GEMINI_VIDEO_TOKENS + estimate_tokens(prompt))
+        async with metrics.timer("analysis"):
+            response = await model.generate_content_async([video_file, prompt])
+        governor.settle(name, estimated, response)
+        return parse_analysis(response.text)
+    except Exception as e:
+        report_failure(model, e)
+        return ("⚠️ Analysis Failed.", "Inbox", None, None)
+    finally:
+        await delete_remote_file(video_file.name)
+
+def build_analysis_prompt(title, description, url):
     # ROBUST PROMPT FOR ALL CATEGORIES
     prompt = f"""
     Analyze this social media post (Video + Text).
@@ -82,36 +294,31 @@ def analyze_with_video_blocking(video_path, title, description, url):
     COORDINATES: [Lat, Lon OR None]
     SUMMARY: [Bulleted list of content or detailed paragraph]
     """
-    try:
-        response = model.generate_content([video_file, prompt])
-        text = response.text
-        try: genai.delete_file(video_file.name)
-        except: pass
-        
-        category, location_str, ai_coords, summary = "Inbox", None, None, text
-        
-        match = re.search(r'CATEGORY:\s*(.+)', text, re.IGNORECASE)
-        if match: 
-            raw_cat = match.group(1).strip().replace('*', '').replace('_', '').strip()
-            category = raw_cat.split(' ')[0].capitalize()
-        
-        match = re.search(r'LOCATION_NAME:\s*(.+)', text, re.IGNORECASE)
-        if match:
-            raw = match.group(1).strip().replace('*','').replace('_','').strip()
-            if raw.lower() not in ["none", "unknown", "n/a"] and len(raw) > 2: 
-                location_str = raw
-                
-        match = re.search(r'COORDINATES:\s*(-?\d+\.\d+),\s*(-?\d+\.\d+)', text)
-        if match: ai_coords = (float(match.group(1)), float(match.group(2)))
-        
-        summary = re.sub(r'(CATEGORY|LOCATION_NAME|COORDINATES):.*\n?', '', summary, flags=re.IGNORECASE).strip()
-        summary = re.sub(r'SUMMARY:\s*', '', summary, flags=re.IGNORECASE).strip()
-        return (summary, category, location_str, ai_coords)
-    except Exception: return ("⚠️ Analysis Failed.", "Inbox", None, None)
-
-def generate_rag_answer(query, context_text):
-    if not model: return "⚠️ AI Offline."
-    rag_prompt = f"""
+    return prompt
+
+def parse_analysis(text):
+    category, location_str, ai_coords, summary = "Inbox", None, None, text
+    
+    match = re.search(r'CATEGORY:\s*(.+)', text, re.IGNORECASE)
+    if match: 
+        raw_cat = match.group(1).strip().replace('*', '').replace('_', '').strip()
+        category = raw_cat.split(' ')[0].capitalize()
+    
+    match = re.search(r'LOCATION_NAME:\s*(.+)', text, re.IGNORECASE)
+    if match:
+        raw = match.group(1).strip().replace('*','').replace('_','').strip()
+        if raw.lower() not in ["none", "unknown", "n/a"] and len(raw) > 2: 
+            location_str = raw
+            
+    match = re.search(r'COORDINATES:\s*(-?\d+\.\d+),\s*(-?\d+\.\d+)', text)
+    if match: ai_coords = (float(match.group(1)), float(match.group(2)))
+    
+    summary = re.sub(r'(CATEGORY|LOCATION_NAME|COORDINATES):.*\n?', '', summary, flags=re.IGNORECASE).strip()
+    summary = re.sub(r'SUMMARY:\s*', '', summary, flags=re.IGNORECASE).strip()
+    return (summary, category, location_str, ai_coords)
+
+def build_rag_prompt(query, context_text):
+    return f"""
     You are Nexus, a personal knowledge assistant.
     User Question: "{query}"
     
@@ -119,8 +326,48 @@ def generate_rag_answer(query, context_text):
     
     TASK: Answer the user's question based ONLY on the items above.
     """
-    try:
-        response = model.generate_content(rag_prompt)
-        return response.text
-    except Exception:
-        return "⚠️ Error generating answer."
\ No newline at end of file
+
+class RagAnswer:
+    """
+    An answer streamed from Gemini: iterate it for the pieces as they arrive, so the reply can
+    start before it is complete. `complete` turns True once the whole answer came through
+    (not offline, blocked, empty or cut short), i.e. when it is worth caching.
+    """
+
+    def __init__(self, query, context_text):
+        self.query, self.context_text = query, context_text
+        self.complete = False
+
+    def __aiter__(self):
+        return self._stream()
+
+    async def _stream(self):
+        model = await asyncio.to_thread(get_model)
+        if not model:
+            yield "⚠️ AI Offline."
+            return
+        prompt = build_rag_prompt(self.query, self.context_text)
+        name = model_name_of(model)
+        estimated = await governor.acquire(name, estimate_tokens(prompt), interactive=True)
+        started, produced = time.perf_counter(), False
+        try:
+            async with metrics.timer("rag_generate"):
+                response = await model.generate_content_async(prompt, stream=True)
+                async for chunk in response:
+                    try: text = chunk.text
+                    except ValueError: continue # Chunk without text (e.g. only safety metadata)
+                    if not text: continue
+                    if not produced:
+                        metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="rag_first_token")
+                        produced = True
+                    yield text
+            governor.settle(name, estimated, response)
+            if not produced: yield "⚠️ Error generating answer." # Stream ended without any text (blocked or empty)
+            self.complete = produced
+        except Exception as e:
+            report_failure(model, e)
+            yield "\n\n⚠️ Answer cut short." if produced else "⚠️ Error generating answer."
+
+def stream_rag_answer(query, context_text):
+    """The answer to an Ask Nexus question over context_text, as a RagAnswer to iterate."""
+    return RagAnswer(query, context_text)
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import database
+import ai_engine
+import geo
+import scraper
+import media
+import embeddings
+import downloads
+import thumbnails
+import metadata
+
+# Reprocess links that are already saved, e.g. after changing the analysis prompt or the geocoder.
+#
+#   python backfill.py --task geocode --missing-coords
+#   python backfill.py --task analysis --user 12345 --category Travel --workers 4 --rate 0.5
+#   python backfill.py --task embedding --checkpoint embed.json   (re-run the same command to resume)
+#   python backfill.py --task thumbnail --missing-thumbnail         (covers of links saved before thumbnails)
+#
+# Rows are read oldest first in batches; each batch is processed concurrently (bounded by --workers,
+# paced by --rate), written back with batched UPDATEs, and then checkpointed. Links that failed are
+# kept in the checkpoint and retried first by the next run with it.
+
+TASKS = ("analysis", "geocode", "embedding", "thumbnail")
+
+class RateLimiter:
+    """Spaces item starts so that at most `rate` begin per second across all workers."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval: return
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0: await asyncio.sleep(delay)
+
+# --- PER-LINK WORK ---
+
+async def reanalyze(row):
+    data = await asyncio.to_thread(scraper.download_and_scrape_blocking, row['url'])
+    if not data['video_path']: return {}
+
+    upload_path = data['video_path']
+    try:
+        video_hash = await asyncio.to_thread(scraper.fingerprint_video, data['video_path'])
+        upload_path, mime_type = await asyncio.to_thread(media.reduce_video, data['video_path'])
+        summary, category, location_str, ai_coords = await ai_engine.analyze_with_video(
+            upload_path, data['title'] or row['title'], data['description'], row['url'], mime_type
+        )
+    finally:
+        downloads.release(data['video_path'])
+
+    # Never overwrite a good old analysis with a failed new one (and try again later)
+    if summary.startswith("⚠️"): raise RuntimeError(summary)
+
+    # Later saves of the same post (or video) must get this analysis, not the old one
+    cached = {'title': data['title'] or row['title'], 'description': data['description'],
+              'image': row['image_url'] or data['image'], 'thumbnail_key': row['thumbnail_key']}
+    await database.save_cached_analysis(
+        row['canonical_url'] or row['url'], video_hash, cached, summary, category, location_str, ai_coords
+    )
+
+    # Coordinates only from the new analysis (or geocoding its place in process()): an old pin
+    # the new analysis doesn't support goes away
+    fields = {'ai_summary': summary, 'category': category, 'location_str': location_str, 'lat': None, 'lon': None}
+    if location_str and ai_coords: fields['lat'], fields['lon'] = ai_coords
+    return fields
+
+async def capture_cover(row, save):
+    """
+    Stores a cover for a link saved before thumbnails existed: from its image URL, or from the
+    page if that CDN link has expired.
+    """
+    image = row['image_url']
+    key, data = await asyncio.to_thread(thumbnails.capture_thumbnail, image)
+    if not key:
+        page = await asyncio.to_thread(metadata.fetch_metadata, row['url'])
+        if page['image']:
+            key, data = await asyncio.to_thread(thumbnails.capture_thumbnail, page['image'])
+            if key: image = page['image']
+    if not key: raise RuntimeError("No cover could be fetched")
+    if save: await database.save_thumbnail(key, data)
+    return {'thumbnail_key': key, 'image_url': image}
+
+async def process(row, args):
+    fields = {}
+    if 'analysis' in args.task:
+        fields.update(await reanalyze(row))
+
+    if 'thumbnail' in args.task and not row['thumbnail_key']:
+        fields.update(await capture_cover(row, save=not args.dry_run))
+
+    location_str = fields.get('location_str', row['location_str'])
+    if ('geocode' in args.task or 'location_str' in fields) and location_str:
+        lat, lon = await asyncio.to_thread(geo.get_best_coordinates, location_str, args.refresh_geocode)
+        if lat and lon: fields.update(lat=lat, lon=lon, location_str=location_str)
+
+    if 'embedding' in args.task or 'ai_summary' in fields:
+        text = f"{row['title']}\n{fields.get('ai_summary', row['ai_summary'])}"
+        vector = await asyncio.to_thread(embeddings.embed_document, text)
+        if vector: fields['embedding'] = vector
+    return fields
+
+# --- CHECKPOINT ---
+
+def load_checkpoint(path, filters):
+    """(last_id, ids of links that failed) from a checkpoint file, or (0, [])."""
+    if not path or not os.path.exists(path): return 0, []
+    with open(path) as f: saved = json.load(f)
+    if saved.get('filters') != filters:
+        sys.exit(f"❌ Checkpoint {path} was written for different filters: {saved.get('filters')}")
+    failed_ids = saved.get('failed_ids', [])
+    print(f"↩️ Resuming after link {saved['last_id']}" + (f", retrying {len(failed_ids)} failed links" if failed_ids else ""))
+    return saved['last_id'], failed_ids
+
+def save_checkpoint(path, last_id, failed_ids, filters, stats):
+    if not path: return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'last_id': last_id, 'failed_ids': failed_ids, 'filters': filters, 'stats': stats}, f)
+    os.replace(tmp_path, path)
+
+# --- MAIN ---
+
+async def run(args):
+    filters = {
+        'user_id': args.user, 'category': args.category, 'since': args.since,
+        'until': args.until, 'missing_coords': args.missing_coords,
+        'missing_thumbnail': args.missing_thumbnail, 'task': sorted(args.task),
+    }
+    last_id, failed_ids = load_checkpoint(args.checkpoint, filters)
+    db_filters = {**filters,
+                  'since': datetime.fromisoformat(args.since) if args.since else None,
+                  'until': datetime.fromisoformat(args.until) if args.until else None}
+
+    # Blocking steps (download, ffmpeg, geocoding, embeddings) share one bounded thread pool
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.workers))
+    slots = asyncio.Semaphore(args.workers)
+    limiter = RateLimiter(args.rate)
+    stats = {'processed': 0, 'updated': 0, 'failed': 0}
+    started = time.monotonic()
+
+    async def guarded(row):
+        async with slots:
+            await limiter.wait()
+            try:
+                return row['id'], await process(row, args)
+            except Exception as e:
+                print(f"❌ Link {row['id']}: {e}")
+                return row['id'], None
+
+    async def process_batch(rows):
+        """Processes and writes back a batch. Returns the ids of the links that failed."""
+        results = await asyncio.gather(*(guarded(row) for row in rows))
+        updates = [(link_id, fields) for link_id, fields in results if fields]
+        if not args.dry_run: await database.update_links_batch(updates)
+        failed = [link_id for link_id, fields in results if fields is None]
+        stats['processed'] += len(rows)
+        stats['updated'] += len(updates)
+        stats['failed'] += len(failed)
+        return failed
+
+    # Links that failed last time first; the ones that fail again stay on the list
+    retry, failed_ids = failed_ids, []
+    for start in range(0, len(retry), args.batch_size):
+        ids = retry[start:start + args.batch_size]
+        rows = await database.fetch_backfill_batch({**db_filters, 'ids': ids}, 0, len(ids))
+        failed_ids += await process_batch(rows)
+        save_checkpoint(args.checkpoint, last_id, failed_ids + retry[start + len(ids):], filters, stats)
+
+    while not args.limit or stats['processed'] < args.limit:
+        batch_size = args.batch_size
+        if args.limit: batch_size = min(batch_size, args.limit - stats['processed'])
+        rows = await database.fetch_backfill_batch(db_filters, last_id, batch_size)
+        if not rows: break
+
+        failed_ids += await process_batch(rows)
+        last_id = rows[-1]['id']
+        save_checkpoint(args.checkpoint, last_id, failed_ids, filters, stats)
+
+        rate = stats['processed'] / max(time.monotonic() - started, 1e-6)
+        print(f"📦 {stats['processed']} processed, {stats['updated']} updated, "
+              f"{stats['failed']} failed ({rate:.1f}/s, last id {last_id})")
+        sys.stdout.flush()
+
+    if failed_ids:
+        retry_hint = "re-run with the same --checkpoint to retry them" if args.checkpoint else f"ids {failed_ids}"
+        print(f"⚠️ {len(failed_ids)} links failed: {retry_hint}")
+    print(f"✅ Backfill done: {stats}")
+    await database.close_async_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess saved links in bulk.")
+    parser.add_argument("--task", action="append", choices=TASKS, required=True,
+                        help="What to redo (repeatable). analysis also re-geocodes and re-embeds.")
+    parser.add_argument("--user", type=int, help="Only this Telegram user id")
+    parser.add_argument("--category", help="Only this category")
+    parser.add_argument("--since", help="Only links saved at/after this ISO date")
+    parser.add_argument("--until", help="Only links saved before this ISO date")
+    parser.add_argument("--missing-coords", action="store_true", help="Only links without lat/lon")
+    parser.add_argument("--missing-thumbnail", action="store_true", help="Only links without a stored cover")
+    parser.add_argument("--refresh-geocode", action="store_true", help="Ignore cached geocoding answers")
+    parser.add_argument("--workers", type=int, default=4, help="Links processed concurrently")
+    parser.add_argument("--rate", type=float, default=0, help="Max links started per second (0 = no limit)")
+    parser.add_argument("--batch-size", type=int, default=50, help="Links per read / UPDATE batch")
+    parser.add_argument("--limit", type=int, default=0, help="Stop after this many links")
+    parser.add_argument("--checkpoint", help="JSON file to resume from / save progress to")
+    parser.add_argument("--dry-run", action="store_true", help="Process but don't write anything")
+    args = parser.parse_args()
+
+    database.init_db()
+    downloads.sweep()
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
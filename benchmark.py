@@ -0,0 +1,494 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+# Replayable load test for the whole message path (bot.handle_message -> queue -> workers -> reply)
+# with local stand-ins for everything outside this repo: Telegram, the video download, Gemini and
+# the geocoders. Only Postgres (local), ffmpeg, the embedding model and our own code run for real.
+#
+#   python benchmark.py --rate 2 --messages 200 --out before.json
+#   python benchmark.py --schedule run.jsonl --out after.json --compare before.json
+#
+# Latencies of the fakes are configurable (--gemini-latency etc., lognormal around the mean).
+# Benchmark rows live under reserved user ids and are deleted before and after the run.
+
+# settings.py needs these; nothing talks to Telegram or Gemini here
+for key in ("TELEGRAM_BOT_TOKEN", "GEMINI_API_KEY"):
+    os.environ.setdefault(key, "benchmark")
+os.environ.setdefault("DB_SSLMODE", "prefer")
+
+import database
+import metrics
+import ai_engine
+import scraper
+import metadata
+import geo
+import downloads
+import worker
+import bot
+from settings import DATABASE_URL
+
+BENCH_USER_BASE = 9_000_000_000_000 # Far above real Telegram ids
+BENCH_CHAT_BASE = BENCH_USER_BASE + 1_000_000
+URL_MARKER = "NXBENCH"
+DEFAULT_MIX = "link=60,repost=10,duplicate=10,query=20"
+STATUS_PREFIXES = ("📥", "🔍") # Progress messages, not answers
+
+PLACES = [
+    ("Baga Beach, Goa, India", 15.5553, 73.7517),
+    ("Eiffel Tower, Paris, France", 48.8584, 2.2945),
+    ("Shibuya Crossing, Tokyo, Japan", 35.6595, 139.7005),
+    ("Hampi, Karnataka, India", 15.3350, 76.4600),
+    ("Some Hidden Cafe, Nowhere", None, None), # Geocoders don't know it
+]
+TOPICS = [
+    ("Recipe", None, "Ingredients: 200g pasta, garlic, olive oil. Steps: boil, fry garlic, toss."),
+    ("Tech", None, "Phone review: 120Hz screen, 5000mAh battery. Verdict: Good."),
+    ("Fitness", None, "Squats 4x10, push-ups 3x15, plank 3x60s."),
+    ("Travel", 0, "Sunset spot, best visited in winter, entry free."),
+    ("Travel", 1, "Go early to skip queues, tickets around 20 EUR."),
+    ("Travel", 2, "Busiest crossing in the world, best seen from the cafe above."),
+    ("Travel", 3, "Temple ruins and boulders, rent a bicycle."),
+    ("Travel", 4, "Tiny cafe with great cold brew."),
+]
+QUERIES = [
+    "pasta recipes", "where was that sunset beach", "phone reviews", "leg workout",
+    "places to visit in japan", "cafes", "what did I save about paris",
+]
+
+def jitter(mean):
+    """Lognormal sample with the given mean (sigma 0.5), so fakes have a realistic tail."""
+    if mean <= 0: return 0
+    return random.lognormvariate(math.log(mean) - 0.125, 0.5)
+
+# --- FAKE TELEGRAM ---
+
+class FakeBot:
+    """Stands in for telegram.Bot: every call costs a round trip, final replies are timestamped per chat."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.next_id = 0
+        self.calls = 0
+        self.answered = {} # chat_id -> perf_counter time of the answer
+
+    async def _call(self):
+        self.calls += 1
+        await asyncio.sleep(jitter(self.latency))
+        self.next_id += 1
+        return SimpleNamespace(message_id=self.next_id)
+
+    def _answer(self, chat_id):
+        self.answered.setdefault(chat_id, time.perf_counter())
+
+    async def send_message(self, chat_id, text, **kwargs):
+        message = await self._call()
+        if not text.startswith(STATUS_PREFIXES): self._answer(chat_id)
+        return message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        message = await self._call()
+        if text.startswith(("❌ Could not save", "⏳")): self._answer(chat_id)
+        return message
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        message = await self._call()
+        self._answer(chat_id)
+        return message
+
+    async def send_location(self, chat_id, latitude, longitude, **kwargs):
+        return await self._call()
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        return await self._call()
+
+def fake_update(user_id, chat_id, text):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id), effective_chat=SimpleNamespace(id=chat_id),
+        message=SimpleNamespace(text=text),
+    )
+
+# --- FAKE GEMINI ---
+
+class FakeFile:
+    def __init__(self, display_name, processing):
+        self.name = f"files/{uuid.uuid4().hex[:12]}"
+        self.display_name = display_name
+        self.create_time = datetime.now(timezone.utc)
+        self.ready_at = time.monotonic() + processing
+
+    @property
+    def state(self):
+        return SimpleNamespace(name="ACTIVE" if time.monotonic() >= self.ready_at else "PROCESSING")
+
+class FakeModel:
+    def __init__(self, args):
+        self.args = args
+
+    def count_tokens(self, text):
+        return SimpleNamespace(total_tokens=len(text.split()))
+
+    async def generate_content_async(self, parts, stream=False):
+        if stream: return self._stream_answer(parts)
+        await asyncio.sleep(jitter(self.args.gemini_latency))
+        category, place, summary = random.choice(TOPICS)
+        location, coords = "None", "None"
+        if place is not None:
+            location = PLACES[place][0]
+            if PLACES[place][1] is not None: coords = f"{PLACES[place][1]}, {PLACES[place][2]}"
+        return SimpleNamespace(text=f"CATEGORY: {category}\nLOCATION_NAME: {location}\nCOORDINATES: {coords}\nSUMMARY: {summary}")
+
+    async def _stream_answer(self, prompt):
+        # ~40 chunks spread over --rag-latency, like a streamed Gemini answer
+        words = ("Based on your saves: " + " ".join(prompt.split()[:200])).split(" ")
+        total = jitter(self.args.rag_latency)
+        for i in range(0, len(words), 5):
+            await asyncio.sleep(total / 40)
+            yield SimpleNamespace(text=" ".join(words[i:i + 5]) + " ")
+
+class FakeGenai:
+    """The slice of google.generativeai that ai_engine uses."""
+
+    def __init__(self, args):
+        self.args = args
+        self.files = {}
+
+    def GenerativeModel(self, model_name):
+        return FakeModel(self.args)
+
+    def upload_file(self, path, mime_type=None, display_name=None):
+        # Upload time follows file size, so video reduction shows up in the numbers
+        time.sleep(os.path.getsize(path) / (self.args.upload_mbps * 125_000) + jitter(0.05))
+        file = FakeFile(display_name, jitter(self.args.gemini_processing))
+        self.files[file.name] = file
+        return file
+
+    def get_file(self, name):
+        time.sleep(jitter(0.05))
+        return self.files[name]
+
+    def delete_file(self, name):
+        self.files.pop(name, None)
+
+    def list_files(self):
+        return list(self.files.values())
+
+# --- FAKE SCRAPER / GEOCODERS ---
+
+def video_trailer(video_key):
+    """An MP4 'free' box: keeps the file valid but gives every video its own hash."""
+    payload = video_key.encode()
+    return struct.pack(">I", 8 + len(payload)) + b"free" + payload
+
+def make_fake_scraper(args, videos, video_of):
+    def download_and_scrape_blocking(url, meta=None):
+        time.sleep(jitter(args.download_latency))
+        token = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+        video_key = video_of.get(token, token) # Reposts share the original's bytes
+        with downloads.download_slot() as job_dir:
+            path = os.path.join(job_dir, "video.mp4")
+            shutil.copyfile(videos[zlib.crc32(video_key.encode()) % len(videos)], path)
+            with open(path, "ab") as f: f.write(video_trailer(video_key))
+        return {"url": url, "title": f"Benchmark reel {token}", "image": "", "video_path": path,
+                "description": "Benchmark caption #nexus"}
+    return download_and_scrape_blocking
+
+def make_fake_metadata(args):
+    def fetch_metadata(url, timeout=None):
+        time.sleep(jitter(args.metadata_latency))
+        return {"title": "", "description": "", "image": ""} # No cover: thumbnails come from the download
+    return fetch_metadata
+
+def make_fake_geocoder(args, provider):
+    known = {geo.normalize_location(name): (lat, lon) for name, lat, lon in PLACES}
+    def get_coordinates(location_name):
+        time.sleep(jitter(args.geocode_latency))
+        # Ola only knows some places, so misses fall through to "OSM" like in production
+        lat, lon = known.get(geo.normalize_location(location_name), (None, None))
+        if provider == "ola" and zlib.crc32(location_name.encode()) % 2: return None, None
+        return lat, lon
+    return get_coordinates
+
+def install_fakes(args, videos, video_of):
+    genai = FakeGenai(args)
+    ai_engine._genai = genai
+    ai_engine._model = genai.GenerativeModel(ai_engine.GEMINI_MODELS[0])
+    ai_engine._model_name = ai_engine.GEMINI_MODELS[0]
+    # The fake model has no real quota; 0 measures the pipeline without the governor's pacing
+    rpm = args.gemini_rpm or 10**9
+    ai_engine.governor = ai_engine.QuotaGovernor({}, (rpm, 10**12))
+    scraper.download_and_scrape_blocking = make_fake_scraper(args, videos, video_of)
+    metadata.fetch_metadata = make_fake_metadata(args)
+    geo.get_coordinates_ola = make_fake_geocoder(args, "ola")
+    geo.get_coordinates_osm = make_fake_geocoder(args, "osm")
+
+def make_canned_video(scratch_dir, seconds):
+    """A small test-pattern MP4 with audio, so ffmpeg reduction has real work to do."""
+    if not shutil.which("ffmpeg"): sys.exit("❌ ffmpeg not found: install it or pass --video file.mp4")
+    path = os.path.join(scratch_dir, "canned.mp4")
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=size=720x1280:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path,
+    ], check=True)
+    return path
+
+# --- SCHEDULE ---
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("link", "repost", "duplicate", "query"): sys.exit(f"❌ Unknown message kind: {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def build_schedule(args):
+    """Poisson arrivals at --rate with kinds drawn from --mix. Deterministic for a given --seed."""
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*parse_mix(args.mix).items())
+    events, links, at = [], [], 0.0
+    for i in range(args.messages):
+        at += rng.expovariate(args.rate)
+        kind = rng.choices(kinds, weights)[0]
+        if kind in ("repost", "duplicate") and not links: kind = "link"
+        user = rng.randrange(args.users)
+        event = {'at': round(at, 4), 'kind': kind, 'user': user}
+        if kind == "link":
+            event['token'] = f"{i:06d}"
+            links.append(event)
+        elif kind == "repost":
+            # Same video under a new URL (another user sharing it): hits the video-hash cache
+            event['token'], event['video'] = f"{i:06d}", rng.choice(links)['token']
+        elif kind == "duplicate":
+            original = rng.choice(links)
+            event['token'], event['user'] = original['token'], original['user']
+        else:
+            event['text'] = rng.choice(QUERIES)
+        events.append(event)
+    return events
+
+def load_schedule(path):
+    with open(path) as f: return [json.loads(line) for line in f if line.strip()]
+
+def save_schedule(path, events):
+    with open(path, "w") as f:
+        for event in events: f.write(json.dumps(event) + "\n")
+
+def post_id(run_id, token):
+    """Instagram-style post id; unique per run so earlier runs never hit the analysis cache."""
+    return f"{URL_MARKER}{run_id}{token}"
+
+# --- DATABASE ---
+
+def check_local_database(allow_remote):
+    from psycopg.conninfo import conninfo_to_dict
+    host = conninfo_to_dict(DATABASE_URL).get("host") or "localhost"
+    if host not in ("localhost", "127.0.0.1", "::1") and not host.startswith("/") and not allow_remote:
+        sys.exit(f"❌ DATABASE_URL points at '{host}'. Run against a local Postgres or pass --allow-remote.")
+
+def cleanup():
+    """Deletes every row a benchmark run can leave behind (also after a crash)."""
+    places = [geo.normalize_location(name) for name, _, _ in PLACES]
+    with database.get_connection() as conn:
+        covers = [row[0] for row in conn.execute("""
+            SELECT thumbnail_key FROM links WHERE user_id >= %s AND thumbnail_key IS NOT NULL
+            UNION SELECT thumbnail_key FROM analysis_cache WHERE canonical_url LIKE %s AND thumbnail_key IS NOT NULL
+        """, (BENCH_USER_BASE, f"%/{URL_MARKER}%")).fetchall()]
+        conn.execute("DELETE FROM jobs WHERE user_id >= %s", (BENCH_USER_BASE,))
+        conn.execute("DELETE FROM links WHERE user_id >= %s", (BENCH_USER_BASE,))
+        conn.execute("DELETE FROM link_rewrites WHERE user_id >= %s", (BENCH_USER_BASE,))
+        conn.execute("DELETE FROM library_versions WHERE user_id >= %s", (BENCH_USER_BASE,))
+        conn.execute("DELETE FROM analysis_cache WHERE canonical_url LIKE %s", (f"%/{URL_MARKER}%",))
+        # Covers only the benchmark's links used (a real link may share one: same image bytes)
+        conn.execute("""
+            DELETE FROM thumbnails t
+            WHERE t.key = ANY(%s)
+              AND NOT EXISTS (SELECT 1 FROM links l WHERE l.thumbnail_key = t.key)
+              AND NOT EXISTS (SELECT 1 FROM analysis_cache a WHERE a.thumbnail_key = t.key)
+        """, (covers,))
+        conn.execute("DELETE FROM geocode_cache WHERE query = ANY(%s)", (places,))
+
+# --- RUN ---
+
+def percentiles(values):
+    if not values: return {'count': 0}
+    values = sorted(values)
+    def pick(q):
+        index = q * (len(values) - 1)
+        low, high = math.floor(index), math.ceil(index)
+        return values[low] + (values[high] - values[low]) * (index - low)
+    return {'count': len(values), 'mean': sum(values) / len(values),
+            'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1]}
+
+async def replay(args, events, run_id):
+    fake_bot = FakeBot(args.telegram_latency)
+    context = SimpleNamespace(bot=fake_bot)
+    workers = asyncio.create_task(worker.run_workers(fake_bot))
+    # python-telegram-bot handles updates one at a time unless concurrent_updates is set
+    handler_slots = asyncio.Semaphore(args.concurrent_updates)
+    sent, lag = {}, []
+
+    async def deliver(i, event):
+        chat_id = BENCH_CHAT_BASE + i
+        if event['kind'] == "query": text = event['text']
+        else: text = f"look at this https://www.instagram.com/reel/{post_id(run_id, event['token'])}/?igsh=bench"
+        sent[chat_id] = (event['kind'], time.perf_counter())
+        async with handler_slots:
+            await bot.handle_message(fake_update(BENCH_USER_BASE + event['user'], chat_id, text), context)
+        # Queries and duplicates are answered inside the handler; links by the workers
+        if event['kind'] in ("query", "duplicate"): fake_bot._answer(chat_id)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, event in enumerate(events):
+        delay = started + event['at'] - time.perf_counter()
+        if delay > 0: await asyncio.sleep(delay)
+        else: lag.append(-delay)
+        tasks.append(asyncio.create_task(deliver(i, event)))
+    await asyncio.gather(*tasks)
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while len(fake_bot.answered) < len(sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.25)
+    elapsed = time.perf_counter() - started
+    workers.cancel()
+    await ai_engine.sweep_orphan_files()
+
+    end_to_end = {}
+    for chat_id, (kind, sent_at) in sent.items():
+        if chat_id in fake_bot.answered:
+            end_to_end.setdefault(kind, []).append(fake_bot.answered[chat_id] - sent_at)
+    return fake_bot, sent, end_to_end, elapsed, lag
+
+async def run(args, events, videos):
+    run_id = uuid.uuid4().hex[:6]
+    video_of = {post_id(run_id, e['token']): post_id(run_id, e['video']) for e in events if e['kind'] == "repost"}
+    install_fakes(args, videos, video_of)
+
+    samples = {}
+    observe = metrics.STAGE_SECONDS.observe
+    def recording_observe(value, **labels):
+        samples.setdefault(labels.get('stage'), []).append(value)
+        observe(value, **labels)
+    metrics.STAGE_SECONDS.observe = recording_observe
+
+    fake_bot, sent, end_to_end, elapsed, lag = await replay(args, events, run_id)
+    await database.close_async_pool()
+
+    completed = sum(len(v) for v in end_to_end.values())
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ("out", "compare", "save_schedule")},
+        'messages': len(sent),
+        'completed': completed,
+        'unfinished': len(sent) - completed,
+        'elapsed_s': elapsed,
+        'throughput_per_s': completed / elapsed if elapsed else 0,
+        'schedule_lag_s': percentiles(lag),
+        'telegram_calls': fake_bot.calls,
+        'jobs': {f"{dict(k)['stage']}:{dict(k)['outcome']}": v for k, v in metrics.JOBS.values.items()},
+        'end_to_end': {kind: percentiles(values) for kind, values in sorted(end_to_end.items())},
+        'stages': {stage: percentiles(values) for stage, values in sorted(samples.items())},
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+# --- REPORT ---
+
+def print_report(report, previous=None):
+    def delta(path, value):
+        if previous is None: return ""
+        old = previous
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else {}
+        if not isinstance(old, (int, float)) or not old: return ""
+        return f" ({(value - old) / old * 100:+.0f}%)"
+
+    print(f"\n📊 {report['completed']}/{report['messages']} messages answered in {report['elapsed_s']:.1f}s "
+          f"→ {report['throughput_per_s']:.2f} msg/s{delta(['throughput_per_s'], report['throughput_per_s'])}")
+    if report['unfinished']: print(f"⚠️ {report['unfinished']} messages never got an answer (see --drain-timeout)")
+    print(f"🧠 Peak RSS {report['peak_rss_mb']:.0f} MB{delta(['peak_rss_mb'], report['peak_rss_mb'])}, "
+          f"ffmpeg peak {report['peak_children_rss_mb']:.0f} MB")
+    print(f"⚙️ Jobs: {report['jobs']}")
+
+    for section in ("end_to_end", "stages"):
+        print(f"\n{section:<22}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for name, stats in report[section].items():
+            if not stats['count']: continue
+            print(f"{name:<22}{stats['count']:>7}{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}"
+                  f"{delta([section, name, 'p95'], stats['p95'])}")
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a message mix through the bot and workers with local fakes.")
+    parser.add_argument("--messages", type=int, default=100, help="Messages to send")
+    parser.add_argument("--rate", type=float, default=1.0, help="Average messages per second (Poisson)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weights per kind (default {DEFAULT_MIX})")
+    parser.add_argument("--users", type=int, default=5, help="Distinct benchmark users")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated schedule")
+    parser.add_argument("--schedule", help="Replay this JSONL schedule instead of generating one")
+    parser.add_argument("--save-schedule", help="Write the schedule used to this JSONL file")
+    parser.add_argument("--video", action="append", help="Canned MP4(s) to serve as downloads (repeatable)")
+    parser.add_argument("--video-seconds", type=int, default=20, help="Length of the generated canned video")
+    parser.add_argument("--concurrent-updates", type=int, default=1, help="Telegram updates handled at once")
+    parser.add_argument("--telegram-latency", type=float, default=0.08, help="Mean seconds per Bot API call")
+    parser.add_argument("--download-latency", type=float, default=1.5, help="Mean seconds per video download")
+    parser.add_argument("--upload-mbps", type=float, default=40, help="Upload bandwidth to Gemini")
+    parser.add_argument("--gemini-processing", type=float, default=2.0, help="Mean seconds until an upload is ACTIVE")
+    parser.add_argument("--gemini-latency", type=float, default=4.0, help="Mean seconds per video analysis")
+    parser.add_argument("--rag-latency", type=float, default=1.5, help="Mean seconds per RAG answer")
+    parser.add_argument("--gemini-rpm", type=int, default=0, help="Gemini requests/minute to pace at (0 = no limit)")
+    parser.add_argument("--metadata-latency", type=float, default=0.3, help="Mean seconds per page head fetch")
+    parser.add_argument("--geocode-latency", type=float, default=0.3, help="Mean seconds per geocoder call")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="Max seconds to wait for the queue to empty")
+    parser.add_argument("--keep-data", action="store_true", help="Don't delete benchmark rows afterwards")
+    parser.add_argument("--allow-remote", action="store_true", help="Allow a non-local DATABASE_URL")
+    parser.add_argument("--out", help="Write the report as JSON")
+    parser.add_argument("--compare", help="Previous JSON report to diff against")
+    args = parser.parse_args()
+
+    check_local_database(args.allow_remote)
+    events = load_schedule(args.schedule) if args.schedule else build_schedule(args)
+    if args.save_schedule: save_schedule(args.save_schedule, events)
+
+    scratch_dir = tempfile.mkdtemp(prefix="nexus-bench-")
+    try:
+        videos = args.video or [make_canned_video(scratch_dir, args.video_seconds)]
+        database.init_db()
+        cleanup()
+        print(f"🏁 Replaying {len(events)} messages (~{args.rate}/s)...")
+        sys.stdout.flush()
+        report = asyncio.run(run(args, events, videos))
+    finally:
+        if not args.keep_data:
+            try: cleanup()
+            except Exception as e: print(f"⚠️ Cleanup failed: {e}")
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f: previous = json.load(f)
+    print_report(report, previous)
+    if args.out:
+        with open(args.out, "w") as f: json.dump(report, f, indent=2)
+        print(f"💾 Report written to {args.out}")
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,35 @@
+import time
+STARTUP_T0 = time.perf_counter()
+
 import logging
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
+from telegram.error import RetryAfter, BadRequest
 import asyncio
 import re
 import os
 import sys
 import threading
-import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import metrics
 
 # --- CUSTOM MODULES ---
-import database
-import geo
-import ai_engine
-import scraper
+# Heavy libraries (yt-dlp, google.generativeai, geopy, fastembed, PIL) are imported
+# inside these modules on first use, not here. `python startup_report.py` shows import costs.
+try:
+    import database
+    import geo
+    import ai_engine
+    import worker
+    import embeddings
+    import urls
+    import importer
+    from cache import TTLCache
+    from settings import EMBEDDED_WORKERS, RAG_EDIT_INTERVAL, RAG_CACHE_SIZE, RAG_CACHE_TTL, WEBHOOK_URL
+    modules_loaded = True
+except Exception as e:
+    print(f"❌ IMPORT ERROR: {e}")
+    modules_loaded = False
+IMPORTS_DONE = time.perf_counter()
 
 # --- SECRET MANAGEMENT ---
 try:
@@ -27,37 +43,13 @@ VIEWER_URL = os.getenv("VIEWER_URL", "https://nexus-viewer.onrender.com/")
 if not TELEGRAM_BOT_TOKEN:
     print("❌ CRITICAL: TELEGRAM_BOT_TOKEN missing.")
 
-# --- HEALTH CHECK ---
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Nexus Bot is Alive")
-    def log_message(self, format, *args): pass 
+# --- HEALTH CHECK + METRICS ---
+# Same port as before; GET /metrics returns Prometheus text, anything else the health check.
+# In webhook mode (WEBHOOK_URL set) webhook.py serves all of this on the same port instead.
+PORT = int(os.environ.get("PORT", 8080))
 
 def start_health_server():
-    try:
-        port = int(os.environ.get("PORT", 8080))
-        server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
-        print(f"✅ Health check server listening on port {port}")
-        sys.stdout.flush()
-        server.serve_forever()
-    except Exception as e:
-        print(f"❌ Failed to start health server: {e}")
-        sys.stdout.flush()
-
-threading.Thread(target=start_health_server, daemon=True).start()
-
-# --- MODULE IMPORT CHECK ---
-try:
-    import database
-    import geo
-    import ai_engine
-    import scraper
-    modules_loaded = True
-except Exception as e:
-    print(f"❌ IMPORT ERROR: {e}")
-    modules_loaded = False
+    metrics.start_http_server(PORT)
 
 # --- ERROR HANDLER ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -73,7 +65,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"1. **Register:** `/register [username] [password]`\n"
         f"2. **Save:** Send any Link\n"
         f"3. **View:** `/site` to get your link\n"
-        f"4. **Change Pass:** `/password [new_pass]`"
+        f"4. **Change Pass:** `/password [new_pass]`\n"
+        f"5. **Import:** `/import` your Instagram/TikTok saves"
     )
     await context.bot.send_message(chat_id=update.effective_chat.id, text=msg, parse_mode='Markdown')
 
@@ -87,7 +80,7 @@ async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = context.args[1]
     
     # Run DB operation in thread
-    success, msg = await asyncio.to_thread(database.register_user, user_id, username, password)
+    success, msg = await database.register_user(user_id, username, password)
     
     if success:
         await context.bot.send_message(
@@ -112,7 +105,7 @@ async def password_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     new_pass = context.args[0]
-    success = await asyncio.to_thread(database.update_password, user_id, new_pass)
+    success = await database.update_password(user_id, new_pass)
     
     if success:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="✅ Password Updated.")
@@ -127,13 +120,97 @@ async def geotest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if lat and lon: await context.bot.send_location(chat_id=update.effective_chat.id, latitude=lat, longitude=lon)
     else: await context.bot.send_message(chat_id=update.effective_chat.id, text="❌ Failed.")
 
+# --- STREAMING REPLIES ---
+
+TELEGRAM_LIMIT = 4096
+CURSOR = " ▌"
+
+def split_message(text, limit=TELEGRAM_LIMIT):
+    """Splits text into Telegram-sized parts, at a line break (or space) where possible."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2: cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2: cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return parts
+
+class StreamingReply:
+    """
+    Shows a streamed answer in the status message. Chunks are coalesced into at most one
+    edit per RAG_EDIT_INTERVAL; past 4096 characters the answer continues in new messages.
+    """
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot, self.chat_id = bot, chat_id
+        self.message_ids = [message_id]
+        self.shown = [None] # Text currently displayed in each message
+        self.text = ""
+        self.next_edit = 0.0
+
+    async def append(self, chunk):
+        self.text += chunk
+        if time.monotonic() >= self.next_edit: await self.flush(final=False)
+
+    async def flush(self, final=True):
+        if not self.text: return # Nothing to show yet; keep the status message
+        parts = split_message(self.text, TELEGRAM_LIMIT - len(CURSOR))
+        if not final: parts[-1] += CURSOR
+        self.next_edit = time.monotonic() + RAG_EDIT_INTERVAL
+        for i, part in enumerate(parts):
+            if i < len(self.shown) and self.shown[i] == part: continue
+            try:
+                if i < len(self.message_ids):
+                    await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_ids[i], text=part)
+                else:
+                    message = await self.bot.send_message(chat_id=self.chat_id, text=part)
+                    self.message_ids.append(message.message_id)
+                    self.shown.append(None)
+                self.shown[i] = part
+            except RetryAfter as e:
+                # Flood control: back off; the text is kept and shown by a later (or the final) flush
+                delay = e.retry_after
+                if hasattr(delay, "total_seconds"): delay = delay.total_seconds() # timedelta in newer PTB
+                self.next_edit = time.monotonic() + delay
+                if not final: return
+                await asyncio.sleep(delay)
+                return await self.flush(final)
+            except BadRequest as e:
+                if "not modified" not in str(e): print(f"⚠️ Reply Edit Error: {e}")
+                self.shown[i] = part
+
+# --- ANSWER CACHE ---
+# Repeat questions ("recipes") are answered from memory. Keys include the user's library
+# version, so anything saved or deleted since simply misses and is answered fresh.
+
+_answer_cache = TTLCache(maxsize=RAG_CACHE_SIZE, ttl=RAG_CACHE_TTL) if modules_loaded else None
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query.lower()).strip(' ?!.,')
+
 # --- MESSAGE HANDLERS ---
 
 async def handle_chat_query(update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
+    async with metrics.timer("rag_total"):
+        await answer_chat_query(update, context, query)
+
+async def answer_chat_query(update, context, query):
     user_id = update.effective_user.id
+    cache_key = (user_id, normalize_query(query), await database.get_library_version(user_id))
+    cached = _answer_cache.get(cache_key)
+    metrics.CACHE_LOOKUPS.inc(cache="rag_answer", result="hit" if cached else "miss")
+    if cached:
+        async with metrics.timer("telegram_reply"):
+            for part in split_message(cached):
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=part)
+        return
+
     status_msg = await context.bot.send_message(chat_id=update.effective_chat.id, text="🔍 **Searching Nexus...**", parse_mode='Markdown')
     
-    results = await asyncio.to_thread(database.search_nexus_memory, user_id, query)
+    async with metrics.timer("rag_search"):
+        results = await embeddings.search_nexus_memory(user_id, query)
     
     if not results:
         await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=status_msg.message_id, text=f"❌ No matching links found.")
@@ -145,79 +222,128 @@ async def handle_chat_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
         loc_info = f"(Location: {lat}, {lon})" if lat else ""
         context_text += f"ITEM {i+1}:\nTitle: {title}\nCategory: {category}\nSummary: {summary}\nURL: {url} {loc_info}\n\n"
 
-    answer = await asyncio.to_thread(ai_engine.generate_rag_answer, query, context_text)
-    await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=status_msg.message_id, text=answer)
+    reply = StreamingReply(context.bot, update.effective_chat.id, status_msg.message_id)
+    answer = ai_engine.stream_rag_answer(query, context_text)
+    async for chunk in answer:
+        await reply.append(chunk)
+    async with metrics.timer("telegram_reply"):
+        await reply.flush()
+    # Failed or cut-short answers are not worth repeating
+    if answer.complete: _answer_cache.set(cache_key, reply.text)
+
+async def handle_links(update, context, found):
+    """Several links in one message: dedupe them in one query and queue them as one group."""
+    user_id, chat_id = update.effective_user.id, update.effective_chat.id
+    canonical = await asyncio.to_thread(lambda: [urls.canonicalize_url(url) for url in found])
+    unique = {}
+    for url, canonical_url in zip(found, canonical): unique.setdefault(canonical_url, url)
+    saved = await database.find_saved(user_id, list(unique.values()), list(unique))
+    links = [(urls.download_url(url), canonical_url) for canonical_url, url in unique.items() if canonical_url not in saved]
+    if not links:
+        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ All {len(unique)} links are already saved.")
+        return
+
+    try: status_msg = await context.bot.send_message(chat_id=chat_id, text=f"📥 **Queued {len(links)} links...**")
+    except: return
+    # One progress message for all of them; the workers run up to MESSAGE_MAX_CONCURRENCY at once
+    job_ids = await database.enqueue_jobs(user_id, chat_id, links, quiet=False, progress_message_id=status_msg.message_id)
+    text = f"📥 Saving {len(job_ids)} links: 0/{len(job_ids)} finished"
+    if saved: text += f" ({len(saved)} already saved)"
+    if not job_ids: text = "⏳ Already in the queue."
+    try: await context.bot.edit_message_text(chat_id=chat_id, message_id=status_msg.message_id, text=text)
+    except: pass
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = update.effective_user.id 
-    url_match = re.search(r'(https?://\S+)', text)
+    found = list(dict.fromkeys(re.findall(r'https?://\S+', text)))
     
-    if not url_match:
+    if not found:
         await handle_chat_query(update, context, text)
         return
-
-    url = url_match.group(0)
-    if database.is_duplicate(url, user_id):
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Already Saved.")
+    if len(found) > 1:
+        await handle_links(update, context, found)
         return
 
-    try: status_msg = await context.bot.send_message(chat_id=update.effective_chat.id, text="📥 **Downloading...**")
+    url = found[0]
+    canonical_url = await asyncio.to_thread(urls.canonicalize_url, url)
+    try: status_msg = await context.bot.send_message(chat_id=update.effective_chat.id, text="📥 **Queued...**")
     except: return 
 
-    data = await asyncio.to_thread(scraper.download_and_scrape_blocking, url)
-    
-    lat, lon = None, None
-    ai_summary, ai_category, location_str = "Error", "Inbox", None
-    
-    if data['video_path']:
-        try: await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=status_msg.message_id, text="🧠 **Watching...**")
-        except: pass 
-
-        ai_summary, ai_category, location_str, ai_coords = await asyncio.to_thread(
-            ai_engine.analyze_with_video_blocking, 
-            data['video_path'], data['title'], data['description'], data['url']
-        )
-        
-        if location_str:
-            lat, lon = await asyncio.to_thread(geo.get_best_coordinates, location_str)
-            if not lat and ai_coords: lat, lon = ai_coords
-        
-        try: os.remove(data['video_path'])
+    # The ingest workers (worker.py) take it from here: download -> analyze -> finalize.
+    # The duplicate check happens in the same statement as the insert.
+    job_id, already_saved = await database.enqueue_job(
+        user_id, update.effective_chat.id, status_msg.message_id, urls.download_url(url), canonical_url
+    )
+    if not job_id:
+        text = "⚠️ Already Saved." if already_saved else "⏳ Already in the queue."
+        try: await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=status_msg.message_id, text=text)
         except: pass
-    else:
-        ai_summary, ai_category = ("⚠️ Restricted/Unreachable content.", "Inbox")
 
-    save_data = {
-        'url': data['url'], 'title': data['title'], 'image': data['image'],
-        'ai_summary': ai_summary, 'category': ai_category, 'user_id': user_id,
-        'lat': lat, 'lon': lon
-    }
-    database.save_link(save_data)
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['awaiting_import'] = True
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="📦 Send me your export as a file: the Instagram or TikTok data download (.zip, .json or .html) "
+             "or a .txt list of links. Everything new gets saved in the background."
+    )
 
-    try: await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status_msg.message_id)
-    except: pass
-    
-    display_text = f"📂 {ai_category}\n{data['title']}\n\n"
-    if location_str and lat: display_text += f"📍 Found: {location_str}\n"
-    if ai_summary: display_text += f"📝 Analysis:\n{ai_summary[:200]}..."
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    document = update.message.document
+    caption = update.message.caption or ""
+    if not context.user_data.pop('awaiting_import', False) and not caption.startswith("/import"):
+        await context.bot.send_message(chat_id=chat_id, text="📦 To bulk-import links from a file, send /import first.")
+        return
+    if document.file_size and document.file_size > 20 * 1024 * 1024: # Bot API download limit
+        await context.bot.send_message(chat_id=chat_id, text="❌ File too big (max 20 MB). Send the relevant .json or a link list instead.")
+        return
 
+    status_msg = await context.bot.send_message(chat_id=chat_id, text="📦 Reading your export...")
     try:
-        if lat and lon:
-            try: await context.bot.send_location(chat_id=update.effective_chat.id, latitude=lat, longitude=lon)
-            except: pass
-        if data['image']: await context.bot.send_photo(chat_id=update.effective_chat.id, photo=data['image'], caption=display_text[:1000])
-        else: await context.bot.send_message(chat_id=update.effective_chat.id, text=display_text[:1000])
-    except: await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Saved: {data['title']}")
+        telegram_file = await document.get_file()
+        data = bytes(await telegram_file.download_as_bytearray())
+    except Exception as e:
+        print(f"❌ Import Download Error: {e}")
+        await context.bot.edit_message_text(chat_id=chat_id, message_id=status_msg.message_id, text=f"❌ Could not download that file: {e}")
+        return
+    try:
+        summary = await importer.import_file(update.effective_user.id, chat_id, document.file_name, data)
+    except Exception as e:
+        print(f"❌ Import Error: {e}")
+        await context.bot.edit_message_text(chat_id=chat_id, message_id=status_msg.message_id, text="❌ Could not read that file.")
+        return
+    await context.bot.edit_message_text(chat_id=chat_id, message_id=status_msg.message_id, text=importer.describe(summary))
+    if not summary['job_ids']: return
+
+    async def report(done, failed, total, finished):
+        text = f"{importer.describe(summary)}\n\n{'✅ Done' if finished else '⏳ Working'}: {done}/{total} saved"
+        if failed: text += f", {failed} failed"
+        try: await context.bot.edit_message_text(chat_id=chat_id, message_id=status_msg.message_id, text=text)
+        except Exception: pass
+    context.application.create_task(importer.watch_progress(summary['job_ids'], report))
+
+async def post_init(application):
+    # Pick the AI model in the background so startup never waits on a Gemini round trip
+    application.bot_data['model_warmup'] = asyncio.create_task(asyncio.to_thread(ai_engine.get_model))
+    application.bot_data['model_health'] = asyncio.create_task(ai_engine.model_health_loop())
+    if EMBEDDED_WORKERS:
+        application.bot_data['workers'] = asyncio.create_task(worker.run_workers(application.bot))
+
+async def post_shutdown(application):
+    await database.close_async_pool()
 
 if __name__ == '__main__':
+    use_webhook = modules_loaded and TELEGRAM_BOT_TOKEN and WEBHOOK_URL
+    if not use_webhook: threading.Thread(target=start_health_server, daemon=True).start()
     if modules_loaded and TELEGRAM_BOT_TOKEN:
         try:
             print("🔄 Connecting to Database...")
+            db_t0 = time.perf_counter()
             database.init_db()
             print("✅ Database Connected")
             
-            application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).connect_timeout(30.0).read_timeout(30.0).write_timeout(30.0).build()
+            application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).connect_timeout(30.0).read_timeout(30.0).write_timeout(30.0).post_init(post_init).post_shutdown(post_shutdown).build()
             application.add_error_handler(error_handler)
             
             # Register Handlers
@@ -226,11 +352,20 @@ if __name__ == '__main__':
             application.add_handler(CommandHandler('password', password_command))
             application.add_handler(CommandHandler('site', site_command)) # NEW
             application.add_handler(CommandHandler('geotest', geotest))
+            application.add_handler(CommandHandler('import', import_command))
+            application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
             application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
             
             print("🤖 Nexus Modular Bot is online...")
+            print(f"⏱️ Startup: imports {(IMPORTS_DONE - STARTUP_T0) * 1000:.0f} ms, "
+                  f"database {(time.perf_counter() - db_t0) * 1000:.0f} ms, "
+                  f"total {(time.perf_counter() - STARTUP_T0) * 1000:.0f} ms")
             sys.stdout.flush()
-            application.run_polling()
+            if use_webhook:
+                import webhook
+                asyncio.run(webhook.serve(application, PORT, post_init, post_shutdown))
+            else:
+                application.run_polling()
         except Exception as e:
             print(f"❌ Runtime Error: {e}")
             sys.stdout.flush()
@@ -1,98 +1,118 @@
-import psycopg2
 import hashlib
-from settings import DATABASE_URL
+import re
+import asyncio
+import threading
+import migrations
+from collections import Counter
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
+from settings import (
+    DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_PREPARE_THRESHOLD, DB_SSLMODE,
+    JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_MAX_TOTAL_ATTEMPTS, MESSAGE_MAX_CONCURRENCY, FAIR_IMPORT_COST,
+    FAIR_CLAIM_CANDIDATES,
+)
 
-def get_connection():
+# --- CONNECTION POOLS ---
+# One pooled TLS connection is reused for many queries instead of a handshake per query.
+# The bot and workers use the async pool; the viewer and one-off scripts use the sync pool.
+# Both share the same settings, so prepared statements (off unless DB_PREPARE_THRESHOLD is set)
+# behave the same everywhere.
+
+CONNECTION_KWARGS = {'sslmode': DB_SSLMODE, 'prepare_threshold': DB_PREPARE_THRESHOLD}
+
+_pool = None
+_pool_lock = threading.Lock()
+_async_pool = None
+_async_pool_lock = asyncio.Lock()
+
+def create_pool():
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL is missing.")
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+    return ConnectionPool(
+        DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT, kwargs=CONNECTION_KWARGS, open=True
+    )
+
+def get_pool():
+    """The process-wide sync pool (created on first use)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = create_pool()
+    return _pool
+
+def get_connection():
+    """Borrows a connection from the sync pool. Use as `with get_connection() as conn:` (commits on exit)."""
+    return get_pool().connection()
+
+async def get_async_pool():
+    global _async_pool
+    async with _async_pool_lock:
+        if _async_pool is None:
+            if not DATABASE_URL:
+                raise ValueError("DATABASE_URL is missing.")
+            pool = AsyncConnectionPool(
+                DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_POOL_TIMEOUT, kwargs=CONNECTION_KWARGS, open=False
+            )
+            await pool.open()
+            _async_pool = pool
+    return _async_pool
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
 
 def init_db():
-    conn = get_connection()
-    c = conn.cursor()
-    
-    # 1. Links Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS links (
-            id SERIAL PRIMARY KEY,
-            url TEXT,
-            title TEXT,
-            image_url TEXT,
-            category TEXT DEFAULT 'Inbox',
-            ai_summary TEXT,
-            user_id BIGINT,
-            lat DOUBLE PRECISION,
-            lon DOUBLE PRECISION
-        );
-    ''')
-    
-    # 2. Users Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            password_hash TEXT
-        );
-    ''')
-    
-    # 3. Migration: Add username column if it doesn't exist
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN username TEXT UNIQUE")
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback() # Column exists, ignore
-    except Exception as e:
-        print(f"Migration Note: {e}")
-        conn.rollback()
-    
-    conn.commit()
-    conn.close()
+    """Brings the schema up to date (see migrations.py)."""
+    with get_connection() as conn:
+        migrations.migrate(conn)
 
 # --- AUTHENTICATION ---
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-def register_user(user_id, username, plain_password):
+async def register_user(user_id, username, plain_password):
     """
     Sets username and password for a Telegram ID.
     Returns: (Success: bool, Message: str)
     """
-    conn = get_connection()
-    c = conn.cursor()
     hashed = hash_password(plain_password)
-    
+    pool = await get_async_pool()
     try:
-        # Check if username is taken by SOMEONE ELSE
-        c.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-        existing = c.fetchone()
-        if existing and existing[0] != user_id:
-            return False, "Username already taken."
-
-        # Upsert (Insert or Update)
-        c.execute("""
-            INSERT INTO users (user_id, username, password_hash) 
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET username = EXCLUDED.username, password_hash = EXCLUDED.password_hash
-        """, (user_id, username, hashed))
-        conn.commit()
-        return True, "Account updated successfully."
+        async with pool.connection() as conn:
+            # Check if username is taken by SOMEONE ELSE
+            cur = await conn.execute("SELECT user_id FROM users WHERE username = %s", (username,))
+            existing = await cur.fetchone()
+            if existing and existing[0] != user_id:
+                return False, "Username already taken."
+
+            # Upsert (Insert or Update)
+            await conn.execute("""
+                INSERT INTO users (user_id, username, password_hash)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id)
+                DO UPDATE SET username = EXCLUDED.username, password_hash = EXCLUDED.password_hash
+            """, (user_id, username, hashed))
+            return True, "Account updated successfully."
     except Exception as e:
         return False, f"Error: {e}"
-    finally:
-        conn.close()
 
-def login_user(username, plain_password):
+async def login_user(username, plain_password):
     """
     Checks credentials and returns the Telegram USER_ID if valid.
     This allows the viewer to load the correct data.
     """
-    conn = get_connection()
-    c = conn.cursor()
     hashed = hash_password(plain_password)
+    pool = await get_async_pool()
     try:
-        c.execute("SELECT user_id, password_hash FROM users WHERE username = %s", (username,))
-        result = c.fetchone()
-        
+        async with pool.connection() as conn:
+            cur = await conn.execute("SELECT user_id, password_hash FROM users WHERE username = %s", (username,))
+            result = await cur.fetchone()
+
         if result:
             db_id, db_hash = result
             if db_hash == hashed:
@@ -101,69 +121,687 @@ def login_user(username, plain_password):
     except Exception as e:
         print(f"Login Error: {e}")
         return None
-    finally:
-        conn.close()
 
-def update_password(user_id, new_password):
-    conn = get_connection()
-    c = conn.cursor()
+async def update_password(user_id, new_password):
     hashed = hash_password(new_password)
-    try:
-        c.execute("UPDATE users SET password_hash = %s WHERE user_id = %s", (hashed, user_id))
-        if c.rowcount == 0:
-            return False # User doesn't exist yet
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("UPDATE users SET password_hash = %s WHERE user_id = %s", (hashed, user_id))
+        return cur.rowcount > 0 # False if user doesn't exist yet
+
+# --- LIBRARY VERSIONS ---
+# Caches of anything derived from a user's links (RAG answers, viewer pages) are keyed on this
+# number, so they can never serve results from before the latest save, update or delete.
+# Deletes, and updates that change an embedding, also bump rewrites and log the link ids under
+# the new rewrites number (link_rewrites), so the vector index can patch those rows by id instead
+# of rebuilding. The bump runs in the same transaction as the write.
+
+# Params: user_id, [link ids]
+BUMP_REWRITE_SQL = """
+    WITH bump AS (
+        INSERT INTO library_versions (user_id, version, rewrites, updated_at) VALUES (%s, 1, 1, now())
+        ON CONFLICT (user_id) DO UPDATE SET version = library_versions.version + 1,
+            rewrites = library_versions.rewrites + 1, updated_at = now()
+        RETURNING user_id, rewrites
+    )
+    INSERT INTO link_rewrites (user_id, rewrites, link_id)
+    SELECT user_id, rewrites, unnest(%s::bigint[]) FROM bump
+"""
+
+async def fetch_rewritten_ids(user_id, after_rewrites, upto_rewrites):
+    """{rewrites: [link ids]} logged for a user's rewrites in (after_rewrites, upto_rewrites]."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            SELECT rewrites, link_id FROM link_rewrites
+            WHERE user_id = %s AND rewrites > %s AND rewrites <= %s
+        """, (user_id, after_rewrites, upto_rewrites))
+        logged = {}
+        for rewrites, link_id in await cur.fetchall(): logged.setdefault(rewrites, []).append(link_id)
+        return logged
+
+def prune_rewrite_log(hours):
+    """Forgets logged rewrites older than `hours` (an index that old is rebuilt). Returns the count."""
+    with get_connection() as conn:
+        cur = conn.execute("DELETE FROM link_rewrites WHERE created_at < now() - make_interval(hours => %s)", (hours,))
+        return cur.rowcount
+
+async def get_library_version(user_id):
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("SELECT version FROM library_versions WHERE user_id = %s", (user_id,))
+        row = await cur.fetchone()
+        return row[0] if row else 0
+
+async def get_library_rewrites(user_id):
+    """(version, rewrites) of a user's library."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("SELECT version, rewrites FROM library_versions WHERE user_id = %s", (user_id,))
+        row = await cur.fetchone()
+        return tuple(row) if row else (0, 0)
+
+def delete_link(user_id, link_id):
+    """Sync (viewer). Returns True if the link existed and belonged to the user."""
+    with get_connection() as conn:
+        deleted = conn.execute("DELETE FROM links WHERE id = %s AND user_id = %s RETURNING id", (link_id, user_id)).fetchone()
+        if deleted: conn.execute(BUMP_REWRITE_SQL, (user_id, [link_id]))
+        return deleted is not None
 
 # --- EXISTING LINK LOGIC ---
 
-def save_link(data_dict):
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute(
-            """
-            INSERT INTO links 
-            (url, title, image_url, ai_summary, category, user_id, lat, lon) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, 
-            (data_dict['url'], data_dict['title'], data_dict['image'], data_dict['ai_summary'], 
-             data_dict['category'], data_dict['user_id'], data_dict['lat'], data_dict['lon'])
+LINK_INSERT_COLUMNS = (
+    "url, title, image_url, ai_summary, category, user_id, lat, lon, embedding, thumbnail_key, canonical_url, location_str"
+)
+
+def _link_values(data_dict):
+    return (data_dict['url'], data_dict['title'], data_dict['image'], data_dict['ai_summary'],
+            data_dict['category'], data_dict['user_id'], data_dict['lat'], data_dict['lon'],
+            data_dict.get('embedding'), data_dict.get('thumbnail_key'), data_dict.get('canonical_url'),
+            data_dict.get('location_str'))
+
+async def save_links(items):
+    """
+    Saves many finalized links in one transaction: one multi-row INSERT, one library version
+    bump per user and their jobs marked done. items: list of (job or None, data_dict), where job
+    is (job_id, worker_id): only jobs still running under that worker are marked done.
+    A link the user already has (same canonical URL) is skipped by the unique index, not an error.
+    Returns one flag per item: True if it was inserted.
+    Raises on error (nothing is written), so the caller can retry row by row.
+    """
+    if not items: return []
+    rows = [_link_values(data_dict) for _, data_dict in items]
+    row_sql = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    jobs = [job for job, _ in items if job]
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            f"""
+            INSERT INTO links ({LINK_INSERT_COLUMNS}) VALUES {', '.join([row_sql] * len(rows))}
+            ON CONFLICT (user_id, canonical_url) DO NOTHING
+            RETURNING user_id, canonical_url
+            """,
+            [value for row in rows for value in row]
         )
-        conn.commit()
-    except Exception as e:
-        print(f"❌ Database Save Error: {e}")
-    finally:
-        conn.close()
+        inserted = Counter(await cur.fetchall())
+        if inserted:
+            await conn.execute("""
+                INSERT INTO library_versions (user_id, version, updated_at)
+                SELECT unnest(%s::bigint[]), 1, now()
+                ON CONFLICT (user_id) DO UPDATE SET version = library_versions.version + 1, updated_at = now()
+            """, (sorted({user_id for user_id, _ in inserted}),))
+        if jobs:
+            await conn.execute("""
+                UPDATE jobs SET status = 'done', locked_by = NULL, locked_at = NULL, updated_at = now()
+                FROM unnest(%s::bigint[], %s::text[]) AS mine(id, worker_id)
+                WHERE jobs.id = mine.id AND jobs.status = 'running' AND jobs.locked_by = mine.worker_id
+            """, ([job_id for job_id, _ in jobs], [worker_id for _, worker_id in jobs]))
+    # Same key twice in one batch: the first one got in
+    flags = []
+    for _, data_dict in items:
+        key = (data_dict['user_id'], data_dict.get('canonical_url'))
+        flags.append(inserted[key] > 0)
+        inserted[key] -= 1
+    return flags
 
-def is_duplicate(url, user_id):
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute("SELECT id FROM links WHERE url=%s AND user_id=%s", (url, user_id))
-        result = c.fetchone()
-        return result is not None
-    finally:
-        conn.close()
-
-def search_nexus_memory(user_id, query):
-    conn = get_connection()
-    c = conn.cursor()
-    sql_query = """
-        SELECT title, ai_summary, category, url, lat, lon
-        FROM links 
-        WHERE user_id=%s AND (
-            title ILIKE %s OR 
-            ai_summary ILIKE %s OR 
-            category ILIKE %s
-        ) ORDER BY id DESC LIMIT 10
-    """
-    wildcard_query = f"%{query}%"
-    try:
-        c.execute(sql_query, (user_id, wildcard_query, wildcard_query, wildcard_query))
-        results = c.fetchall()
-        return results
-    finally:
-        conn.close()
\ No newline at end of file
+async def find_saved(user_id, urls, canonical_urls):
+    """
+    Set-based duplicate check for bulk imports: which of these (url, canonical_url) pairs the
+    user already has. Returns the set of canonical URLs found.
+    """
+    if not urls: return set()
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            SELECT u.canonical_url FROM unnest(%s::text[], %s::text[]) AS u(url, canonical_url)
+            WHERE EXISTS (SELECT 1 FROM links l WHERE l.user_id = %s AND l.canonical_url = u.canonical_url)
+               OR EXISTS (SELECT 1 FROM links l WHERE l.user_id = %s AND l.url = u.url)
+        """, (list(urls), list(canonical_urls), user_id, user_id))
+        return {row[0] for row in await cur.fetchall()}
+
+# --- SHARED ANALYSIS CACHE ---
+# When many users save the same viral post, it is downloaded and analyzed only once.
+
+ANALYSIS_COLUMNS = "title, description, image_url, thumbnail_key, ai_summary, category, location_str, ai_coords"
+
+async def get_cached_analysis(canonical_url=None, video_hash=None):
+    """Looks up a previous analysis by canonical URL or by the hash of the downloaded video."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(f"""
+            SELECT {ANALYSIS_COLUMNS} FROM analysis_cache
+            WHERE canonical_url = %s OR video_hash = %s
+            ORDER BY created_at DESC LIMIT 1
+        """, (canonical_url, video_hash))
+        row = await cur.fetchone()
+        return dict(zip([col.strip() for col in ANALYSIS_COLUMNS.split(",")], row)) if row else None
+
+async def save_cached_analysis(canonical_url, video_hash, data, ai_summary, category, location_str, ai_coords):
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        await conn.execute(f"""
+            INSERT INTO analysis_cache (canonical_url, video_hash, {ANALYSIS_COLUMNS})
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (canonical_url) DO UPDATE
+            SET video_hash = EXCLUDED.video_hash, ai_summary = EXCLUDED.ai_summary,
+                category = EXCLUDED.category, location_str = EXCLUDED.location_str,
+                ai_coords = EXCLUDED.ai_coords, created_at = now()
+        """, (canonical_url, video_hash, data['title'], data['description'], data['image'],
+              data.get('thumbnail_key'), ai_summary, category, location_str, Jsonb(ai_coords)))
+
+# --- THUMBNAILS ---
+
+# Re-saving a cover that is already stored refreshes created_at, so the garbage collector's
+# grace period counts from the latest capture
+THUMBNAIL_INSERT_SQL = """
+    INSERT INTO thumbnails (key, data) VALUES (%s, %s)
+    ON CONFLICT (key) DO UPDATE SET created_at = now()
+"""
+
+async def save_thumbnail(key, data):
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        await conn.execute(THUMBNAIL_INSERT_SQL, (key, data))
+
+async def touch_thumbnail(key):
+    """
+    Restarts a stored cover's grace period (a new link is about to use it). Returns False if
+    the garbage collector already deleted it.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("UPDATE thumbnails SET created_at = now() WHERE key = %s", (key,))
+        return cur.rowcount > 0
+
+async def set_cached_thumbnail(canonical_url, key, image_url):
+    """Gives a cached analysis a freshly captured cover (its old one was garbage-collected)."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        await conn.execute(
+            "UPDATE analysis_cache SET thumbnail_key = %s, image_url = %s WHERE canonical_url = %s",
+            (key, image_url, canonical_url)
+        )
+
+def load_thumbnail(key):
+    """Sync read used to fill the thumbnail disk cache (viewer / HTTP threads)."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT data FROM thumbnails WHERE key = %s", (key,)).fetchone()
+        return bytes(row[0]) if row else None
+
+def delete_orphan_thumbnails(grace_hours):
+    """
+    Deletes stored covers no link references (deleted or deduplicated links) once older than
+    grace_hours. The analysis cache forgets them too; a later save of that post captures the
+    cover again (see worker.cached_cover). Returns the number deleted.
+    """
+    with get_connection() as conn:
+        return conn.execute("""
+            WITH orphans AS (
+                DELETE FROM thumbnails t
+                WHERE t.created_at < now() - make_interval(hours => %s)
+                  AND NOT EXISTS (SELECT 1 FROM links l WHERE l.thumbnail_key = t.key)
+                RETURNING t.key
+            ), forgotten AS (
+                UPDATE analysis_cache SET thumbnail_key = NULL
+                WHERE thumbnail_key IN (SELECT key FROM orphans)
+            )
+            SELECT count(*) FROM orphans
+        """, (grace_hours,)).fetchone()[0]
+
+# --- GEOCODE CACHE ---
+# Sync on purpose: geo.py runs inside worker threads.
+
+def get_cached_geocode(query, ttl_days, negative_ttl_days):
+    """Returns (lat, lon, provider) for a fresh cache entry, or None."""
+    with get_connection() as conn:
+        return conn.execute("""
+            SELECT lat, lon, provider FROM geocode_cache
+            WHERE query = %s
+              AND updated_at > now() - make_interval(days => CASE WHEN found THEN %s ELSE %s END)
+        """, (query, ttl_days, negative_ttl_days)).fetchone()
+
+def put_cached_geocode(query, lat, lon, provider):
+    with get_connection() as conn:
+        conn.execute("""
+            INSERT INTO geocode_cache (query, lat, lon, provider, found, updated_at)
+            VALUES (%s, %s, %s, %s, %s, now())
+            ON CONFLICT (query) DO UPDATE
+            SET lat = EXCLUDED.lat, lon = EXCLUDED.lon, provider = EXCLUDED.provider,
+                found = EXCLUDED.found, updated_at = now()
+        """, (query, lat, lon, provider, lat is not None))
+
+# --- SEARCH ---
+
+# Column order shared by every query that returns links to the viewer
+LINK_COLUMNS = "id, title, image_url, url, category, ai_summary, lat, lon, thumbnail_key"
+
+def prefix_terms(query):
+    """'sush plac' -> 'sush:* & plac:*' (only word characters, so nothing in it is tsquery syntax)."""
+    words = re.findall(r'\w+', query or "")
+    return " & ".join(f"{word}:*" for word in words) or None
+
+def _tsquery(match_any, prefix=False):
+    if prefix:
+        return "to_tsquery('english', %(q)s)"
+    if match_any:
+        return "replace(plainto_tsquery('english', %(q)s)::text, '&', '|')::tsquery"
+    return "websearch_to_tsquery('english', %(q)s)"
+
+def build_search_query(user_id, query, category=None, limit=10, match_any=False, prefix=False):
+    """
+    Ranked full-text search over title, category and summary (GIN indexed).
+    Returns (sql, params) so the bot (async pool) and the viewer (sync pool) run the same query.
+    match_any=True ORs the words together, which suits questions ("where was that sushi place").
+    prefix=True matches words as typed so far ("sush" finds sushi), for search-as-you-type.
+    """
+    if prefix: query = prefix_terms(query)
+    sql = f"""
+        SELECT {LINK_COLUMNS}
+        FROM links, {_tsquery(match_any, prefix)} AS query
+        WHERE user_id = %(user_id)s AND search_vector @@ query
+          AND (%(category)s::text IS NULL OR category = %(category)s)
+        ORDER BY ts_rank(search_vector, query) DESC, id DESC
+        LIMIT %(limit)s
+    """
+    return sql, {'q': query, 'user_id': user_id, 'category': category, 'limit': limit}
+
+def build_page_query(user_id, category=None, before_id=None, limit=20):
+    """
+    One page of a user's links, newest first, using keyset pagination on (user_id, id):
+    pass the last id of the previous page as before_id. Returns (sql, params).
+    Searches don't page: they use build_search_query (ranked by relevance).
+    """
+    conditions = ["user_id = %(user_id)s"]
+    if before_id: conditions.append("id < %(before_id)s")
+    if category: conditions.append("category = %(category)s")
+    sql = f"""
+        SELECT {LINK_COLUMNS} FROM links
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id DESC
+        LIMIT %(limit)s
+    """
+    return sql, {'user_id': user_id, 'before_id': before_id, 'category': category, 'limit': limit}
+
+def build_map_query(user_id, south, west, north, east, cell_deg, category=None, limit=500):
+    """
+    One user's points inside a bounding box (links_geo_idx), clustered on a grid of cell_deg
+    degrees so a zoomed-out map gets a few hundred clusters instead of every point.
+    west > east means the box crosses the antimeridian. Returns (sql, params); rows are
+    (count, lat, lon, id, title, url, category), the last four only meaningful when count == 1.
+    """
+    lon_filter = "lon BETWEEN %(west)s AND %(east)s" if west <= east else "(lon >= %(west)s OR lon <= %(east)s)"
+    conditions = ["user_id = %(user_id)s", "lat BETWEEN %(south)s AND %(north)s", lon_filter, "lon IS NOT NULL"]
+    if category: conditions.append("category = %(category)s")
+    sql = f"""
+        SELECT count(*), avg(lat), avg(lon), min(id), min(title), min(url), min(category)
+        FROM links
+        WHERE {' AND '.join(conditions)}
+        GROUP BY floor(lat / %(cell)s), floor(lon / %(cell)s)
+        ORDER BY count(*) DESC
+        LIMIT %(limit)s
+    """
+    return sql, {'user_id': user_id, 'south': south, 'west': west, 'north': north, 'east': east,
+                 'cell': cell_deg, 'category': category, 'limit': limit}
+
+async def search_links(user_id, query, category=None, limit=10, match_any=False):
+    sql, params = build_search_query(user_id, query, category, limit, match_any)
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(sql, params)
+        return await cur.fetchall()
+
+async def fetch_links(user_id, link_ids):
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            f"SELECT {LINK_COLUMNS} FROM links WHERE user_id = %s AND id = ANY(%s)", (user_id, list(link_ids))
+        )
+        return await cur.fetchall()
+
+async def fetch_embeddings(user_id, after_id=0, ids=None):
+    """
+    (id, embedding) of a user's links that have one, oldest first: those with id > after_id,
+    or with ids given, those of them that still exist.
+    """
+    condition = "id = ANY(%s)" if ids is not None else "id > %s"
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(f"""
+            SELECT id, embedding FROM links
+            WHERE user_id = %s AND {condition} AND embedding IS NOT NULL
+            ORDER BY id
+        """, (user_id, list(ids) if ids is not None else after_id))
+        return await cur.fetchall()
+
+# --- BACKFILL / REPROCESSING ---
+
+BACKFILL_COLUMNS = "id, user_id, url, title, ai_summary, category, location_str, canonical_url, image_url, thumbnail_key"
+UPDATABLE_COLUMNS = {'ai_summary', 'category', 'location_str', 'lat', 'lon', 'embedding', 'thumbnail_key', 'image_url'}
+
+async def fetch_backfill_batch(filters, after_id, limit):
+    """
+    Next batch of links (id > after_id, oldest first) matching the backfill filters:
+    user_id, category, since, until (on created_at), missing_coords and missing_thumbnail; ids
+    limits it to those links (retrying failures). location_str falls back to the shared analysis
+    cache for rows saved before it was stored.
+    """
+    conditions = ["l.id > %(after_id)s"]
+    if filters.get('ids'): conditions.append("l.id = ANY(%(ids)s)")
+    if filters.get('user_id'): conditions.append("l.user_id = %(user_id)s")
+    if filters.get('category'): conditions.append("l.category = %(category)s")
+    if filters.get('since'): conditions.append("l.created_at >= %(since)s")
+    if filters.get('until'): conditions.append("l.created_at < %(until)s")
+    if filters.get('missing_coords'): conditions.append("l.lat IS NULL")
+    if filters.get('missing_thumbnail'): conditions.append("l.thumbnail_key IS NULL")
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(f"""
+            SELECT l.id, l.user_id, l.url, l.title, l.ai_summary, l.category,
+                   COALESCE(l.location_str, a.location_str), l.canonical_url, l.image_url, l.thumbnail_key
+            FROM links l
+            LEFT JOIN analysis_cache a ON a.canonical_url = l.canonical_url
+            WHERE {' AND '.join(conditions)}
+            ORDER BY l.id
+            LIMIT %(limit)s
+        """, {**filters, 'after_id': after_id, 'limit': limit})
+        rows = await cur.fetchall()
+        return [dict(zip([col.strip() for col in BACKFILL_COLUMNS.split(",")], row)) for row in rows]
+
+async def update_links_batch(updates):
+    """
+    Writes many link updates at once. updates: list of (link_id, {column: value}).
+    Rows touching the same columns are sent as one pipelined executemany.
+    """
+    groups = {}
+    for link_id, fields in updates:
+        columns = tuple(sorted(fields))
+        if not columns: continue
+        if not set(columns) <= UPDATABLE_COLUMNS: raise ValueError(f"Not updatable: {columns}")
+        groups.setdefault(columns, []).append([fields[c] for c in columns] + [link_id])
+    if not groups: return
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            for columns, params in groups.items():
+                sets = ", ".join(f"{c} = %s" for c in columns)
+                await cur.executemany(f"UPDATE links SET {sets} WHERE id = %s", params)
+            # Only new embeddings concern the vector index; other updates are a plain version bump
+            await cur.execute("""
+                WITH touched AS (
+                    SELECT id, user_id, id = ANY(%s) AS reembedded FROM links
+                    WHERE id = ANY(%s) AND user_id IS NOT NULL
+                ), bump AS (
+                    INSERT INTO library_versions (user_id, version, rewrites, updated_at)
+                    SELECT user_id, 1, bool_or(reembedded)::int, now() FROM touched GROUP BY user_id
+                    ON CONFLICT (user_id) DO UPDATE SET version = library_versions.version + 1,
+                        rewrites = library_versions.rewrites + EXCLUDED.rewrites, updated_at = now()
+                    RETURNING user_id, rewrites
+                )
+                INSERT INTO link_rewrites (user_id, rewrites, link_id)
+                SELECT b.user_id, b.rewrites, t.id FROM touched t JOIN bump b USING (user_id)
+                WHERE t.reembedded
+            """, ([link_id for link_id, fields in updates if 'embedding' in fields],
+                  [link_id for link_id, fields in updates if fields]))
+
+# --- INGEST JOB QUEUE ---
+
+JOB_COLUMNS = (
+    "id, stage, user_id, chat_id, status_message_id, url, canonical_url, payload, attempts, total_attempts, quiet, progress_message_id, locked_by"
+)
+
+class LeaseLost(Exception):
+    """The job is no longer running under this worker (lease expired and reclaimed, or rescued)."""
+
+def _job_from_row(row):
+    return dict(zip([col.strip() for col in JOB_COLUMNS.split(",")], row))
+
+async def enqueue_job(user_id, chat_id, status_message_id, url, canonical_url):
+    """
+    Queues a link for the ingest workers, unless the user already saved it: one round trip,
+    atomic thanks to the unique index on waiting/running jobs.
+    Returns (job_id, already_saved); job_id is None if the link is saved or already queued.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            WITH saved AS (
+                SELECT 1 FROM links
+                WHERE user_id = %(user_id)s AND (canonical_url = %(canonical_url)s OR url = %(url)s)
+                LIMIT 1
+            ), queued AS (
+                INSERT INTO jobs (user_id, chat_id, status_message_id, url, canonical_url)
+                SELECT %(user_id)s, %(chat_id)s, %(status_message_id)s, %(url)s, %(canonical_url)s
+                WHERE NOT EXISTS (SELECT 1 FROM saved)
+                ON CONFLICT (user_id, canonical_url) WHERE status IN ('queued', 'running') DO NOTHING
+                RETURNING id
+            )
+            SELECT (SELECT id FROM queued), EXISTS (SELECT 1 FROM saved)
+        """, {
+            'user_id': user_id, 'chat_id': chat_id, 'status_message_id': status_message_id,
+            'url': url, 'canonical_url': canonical_url,
+        })
+        return tuple(await cur.fetchone())
+
+async def enqueue_jobs(user_id, chat_id, links, quiet=True, progress_message_id=None):
+    """
+    Queues many links at once, without per-link status messages.
+    Bulk imports are quiet (no per-link reply either); the links of one multi-link message
+    share progress_message_id, which also bounds how many of them run at once.
+    links: list of (url, canonical_url). Links already waiting in the queue are skipped.
+    Returns the new job ids.
+    """
+    if not links: return []
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            INSERT INTO jobs (user_id, chat_id, url, canonical_url, quiet, progress_message_id)
+            SELECT %s, %s, u.url, u.canonical_url, %s, %s
+            FROM unnest(%s::text[], %s::text[]) AS u(url, canonical_url)
+            ON CONFLICT (user_id, canonical_url) WHERE status IN ('queued', 'running') DO NOTHING
+            RETURNING id
+        """, (user_id, chat_id, quiet, progress_message_id, [url for url, _ in links], [c for _, c in links]))
+        return [row[0] for row in await cur.fetchall()]
+
+async def job_progress(job_ids):
+    """{status: count} for a set of jobs (e.g. one import)."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            "SELECT status, count(*) FROM jobs WHERE id = ANY(%s) GROUP BY status", (list(job_ids),)
+        )
+        return dict(await cur.fetchall())
+
+async def group_progress(chat_id, progress_message_id):
+    """{status: count} for the links of one multi-link message."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            SELECT status, count(*) FROM jobs
+            WHERE chat_id = %s AND progress_message_id = %s GROUP BY status
+        """, (chat_id, progress_message_id))
+        return dict(await cur.fetchall())
+
+async def claim_job(stage, worker_id, node):
+    """
+    Locks the next runnable job of a stage for this worker.
+    Jobs whose lease expired (worker crashed mid-job) are picked up again.
+    Links of a multi-link message wait while MESSAGE_MAX_CONCURRENCY of them are running.
+
+    Users take turns (weighted round-robin): a user's n-th queued job ranks at
+    (jobs of theirs already running + n), times FAIR_IMPORT_COST for bulk-imported links,
+    so one user's 5,000-link import can't starve everyone else's single link.
+    A user's later jobs always rank behind their earlier ones, so only the oldest
+    FAIR_CLAIM_CANDIDATES runnable jobs per user are ranked: the users with queued jobs are found
+    with a skip scan (one index probe per user) and each one's head of the queue read with a
+    LIMIT, so a claim costs O(users), not O(queued jobs).
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute(f"""
+            WITH RECURSIVE waiting AS (
+                (SELECT user_id FROM jobs
+                 WHERE stage = %(stage)s AND status = 'queued' AND user_id IS NOT NULL
+                 ORDER BY user_id LIMIT 1)
+                UNION ALL
+                SELECT (SELECT j.user_id FROM jobs j
+                        WHERE j.stage = %(stage)s AND j.status = 'queued' AND j.user_id > w.user_id
+                        ORDER BY j.user_id LIMIT 1)
+                FROM waiting w WHERE w.user_id IS NOT NULL
+            ), runnable AS (
+                SELECT c.id, w.user_id, c.quiet, row_number() OVER (PARTITION BY w.user_id ORDER BY c.id) AS turn
+                FROM waiting w
+                CROSS JOIN LATERAL (
+                    SELECT j.id, j.quiet FROM jobs j
+                    WHERE j.stage = %(stage)s AND j.status = 'queued' AND j.user_id = w.user_id
+                      AND (j.not_before IS NULL OR j.not_before <= now())
+                      AND (j.node IS NULL OR j.node = %(node)s)
+                      AND (j.progress_message_id IS NULL OR (
+                          SELECT count(*) FROM jobs g
+                          WHERE g.chat_id = j.chat_id AND g.progress_message_id = j.progress_message_id
+                            AND g.status = 'running'
+                      ) < %(group_limit)s)
+                    ORDER BY j.id
+                    LIMIT %(per_user)s
+                ) c
+                WHERE w.user_id IS NOT NULL
+                UNION ALL
+                -- Expired leases: at most one per worker, and they go first
+                SELECT id, user_id, quiet, 0 FROM jobs
+                WHERE stage = %(stage)s AND status = 'running'
+                  AND locked_at < now() - make_interval(secs => %(lease)s)
+                  AND (node IS NULL OR node = %(node)s)
+            ), busy AS (
+                SELECT user_id, count(*) AS running FROM jobs
+                WHERE status = 'running' GROUP BY user_id
+            )
+            UPDATE jobs
+            SET status = 'running', locked_by = %(worker_id)s, locked_at = now(),
+                attempts = attempts + 1, total_attempts = total_attempts + 1, updated_at = now()
+            WHERE id = (
+                SELECT j.id FROM jobs j
+                JOIN runnable r ON r.id = j.id
+                LEFT JOIN busy b ON b.user_id = r.user_id
+                -- Re-checked on the locked row in case another worker just took it
+                WHERE j.stage = %(stage)s
+                  AND (j.status = 'queued'
+                       OR (j.status = 'running' AND j.locked_at < now() - make_interval(secs => %(lease)s)))
+                ORDER BY (coalesce(b.running, 0) + r.turn) * CASE WHEN r.quiet THEN %(import_cost)s ELSE 1 END, r.id
+                FOR UPDATE OF j SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING {JOB_COLUMNS}
+        """, {
+            'worker_id': worker_id, 'stage': stage, 'lease': JOB_LEASE_SECONDS, 'node': node,
+            'group_limit': MESSAGE_MAX_CONCURRENCY, 'import_cost': FAIR_IMPORT_COST,
+            'per_user': FAIR_CLAIM_CANDIDATES,
+        })
+        row = await cur.fetchone()
+        return _job_from_row(row) if row else None
+
+# Job updates only apply while the job is still running under the worker that claimed it:
+# after its lease expired another worker may own it, and a job marked done stays done.
+
+async def advance_job(job_id, worker_id, next_stage, payload, node=None):
+    """
+    Hands a job over to the next stage (node pins it to the host holding its files).
+    Raises LeaseLost if the worker no longer owns the job.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            UPDATE jobs
+            SET stage = %s, status = 'queued', payload = %s, node = %s,
+                attempts = 0, locked_by = NULL, locked_at = NULL, updated_at = now()
+            WHERE id = %s AND status = 'running' AND locked_by = %s
+        """, (next_stage, Jsonb(payload), node, job_id, worker_id))
+        if not cur.rowcount: raise LeaseLost(job_id)
+
+async def renew_lease(job_id, worker_id):
+    """
+    Keeps the lease of a job that is still being worked on, so waits longer than
+    JOB_LEASE_SECONDS (quota, upload slots) don't get it rescued or claimed by another worker.
+    Raises LeaseLost if the worker no longer owns the job.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            UPDATE jobs SET locked_at = now()
+            WHERE id = %s AND status = 'running' AND locked_by = %s
+        """, (job_id, worker_id))
+        if not cur.rowcount: raise LeaseLost(job_id)
+
+async def fail_job(job_id, worker_id, error):
+    """
+    Puts a job back in the queue, or marks it failed once it ran out of attempts (in this stage
+    or over its whole life).
+    Returns True if the failure is final; a job this worker no longer owns (or that is
+    already done) is left alone.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            UPDATE jobs
+            SET status = CASE WHEN attempts >= %s OR total_attempts >= %s THEN 'failed' ELSE 'queued' END,
+                last_error = %s, locked_by = NULL, locked_at = NULL, updated_at = now()
+            WHERE id = %s AND status = 'running' AND locked_by = %s
+            RETURNING status
+        """, (JOB_MAX_ATTEMPTS, JOB_MAX_TOTAL_ATTEMPTS, str(error)[:1000], job_id, worker_id))
+        row = await cur.fetchone()
+        return bool(row) and row[0] == 'failed'
+
+async def defer_job(job_id, worker_id, delay, reason):
+    """
+    Puts a job back in the queue for at least `delay` seconds without counting the claim as an
+    attempt: it could not start (e.g. this node has no scratch space), it did not fail.
+    Raises LeaseLost if the worker no longer owns the job.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            UPDATE jobs
+            SET status = 'queued', attempts = greatest(attempts - 1, 0),
+                total_attempts = greatest(total_attempts - 1, 0),
+                not_before = now() + make_interval(secs => %s), last_error = %s,
+                locked_by = NULL, locked_at = NULL, updated_at = now()
+            WHERE id = %s AND status = 'running' AND locked_by = %s
+        """, (delay, str(reason)[:1000], job_id, worker_id))
+        if not cur.rowcount: raise LeaseLost(job_id)
+
+async def heartbeat(node):
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        await conn.execute("""
+            INSERT INTO worker_nodes (node, seen_at) VALUES (%s, now())
+            ON CONFLICT (node) DO UPDATE SET seen_at = now()
+        """, (node,))
+
+async def rescue_pinned_jobs(dead_after):
+    """
+    Jobs pinned to a node (analyze: the video is on its disk) whose lease expired, or whose node
+    sent no heartbeat for dead_after seconds, go back to the download stage unpinned: the file is
+    fetched again on whichever node claims them. Returns the rescued job ids.
+    """
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cur = await conn.execute("""
+            UPDATE jobs j
+            SET stage = 'download', status = 'queued', node = NULL, payload = '{}'::jsonb,
+                locked_by = NULL, locked_at = NULL, updated_at = now()
+            WHERE j.node IS NOT NULL AND j.status IN ('queued', 'running')
+              AND ((j.status = 'running' AND j.locked_at < now() - make_interval(secs => %s))
+                   OR NOT EXISTS (
+                       SELECT 1 FROM worker_nodes n
+                       WHERE n.node = j.node AND n.seen_at > now() - make_interval(secs => %s)
+                   ))
+            RETURNING j.id
+        """, (JOB_LEASE_SECONDS, dead_after))
+        return [row[0] for row in await cur.fetchall()]
+
+def queue_depth():
+    """Sync (called from the metrics HTTP thread): {(stage, status): count} of unfinished jobs."""
+    with get_connection() as conn:
+        rows = conn.execute("""
+            SELECT stage, status, count(*) FROM jobs
+            WHERE status IN ('queued', 'running') GROUP BY stage, status
+        """).fetchall()
+        return {(stage, status): count for stage, status, count in rows}
@@ -0,0 +1,136 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from settings import (
+    DOWNLOAD_DIR, DOWNLOAD_BUDGET_MB, DOWNLOAD_MAX_FILE_MB, DOWNLOAD_MAX_CONCURRENT,
+    DOWNLOAD_BUDGET_WAIT, DOWNLOAD_MAX_AGE_MINUTES,
+)
+
+# --- DOWNLOAD SCRATCH SPACE ---
+# Every download gets its own directory under one scratch root (tmpfs when it has room),
+# so parallel jobs never share file names and cleanup is a single rmtree.
+# A download slot is only handed out while fewer than DOWNLOAD_MAX_CONCURRENT downloads run and
+# the files already on disk (by any process on this node) plus one worst-case download fit
+# in DOWNLOAD_BUDGET_MB. Directories are named <pid>-<id>, so the janitor can tell which ones
+# belong to a process that died.
+
+_root = None
+_root_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(DOWNLOAD_MAX_CONCURRENT)
+_budget = threading.Condition()
+_reserved = 0 # Bytes promised to downloads running in this process
+
+class DownloadBusy(TimeoutError):
+    """No slot or scratch space within DOWNLOAD_BUDGET_WAIT: the job should be retried later."""
+
+def budget_bytes():
+    return DOWNLOAD_BUDGET_MB * 1024 * 1024
+
+def max_file_bytes():
+    return min(DOWNLOAD_MAX_FILE_MB * 1024 * 1024, budget_bytes())
+
+def get_root():
+    """DOWNLOAD_DIR, else /dev/shm if it can hold the whole budget, else the system temp dir."""
+    global _root
+    with _root_lock:
+        if _root is None:
+            root = DOWNLOAD_DIR
+            if not root:
+                shm = "/dev/shm"
+                try:
+                    on_tmpfs = os.access(shm, os.W_OK) and shutil.disk_usage(shm).free >= budget_bytes()
+                except OSError:
+                    on_tmpfs = False
+                root = os.path.join(shm if on_tmpfs else tempfile.gettempdir(), "nexus-downloads")
+            os.makedirs(root, exist_ok=True)
+            print(f"📂 Download scratch space: {root}")
+            _root = root
+    return _root
+
+def disk_usage():
+    total = 0
+    for root, _, names in os.walk(get_root()):
+        for name in names:
+            try: total += os.path.getsize(os.path.join(root, name))
+            except OSError: pass
+    return total
+
+@contextmanager
+def download_slot():
+    """
+    Blocks until a download may start, then yields a fresh job directory.
+    The directory is NOT removed on exit: the file in it lives on until release() (after analysis).
+    Raises DownloadBusy if the budget stays full for DOWNLOAD_BUDGET_WAIT seconds.
+    """
+    global _reserved
+    deadline = time.monotonic() + DOWNLOAD_BUDGET_WAIT
+    if not _slots.acquire(timeout=DOWNLOAD_BUDGET_WAIT):
+        raise DownloadBusy("No free download slot")
+    try:
+        need = max_file_bytes()
+        with _budget:
+            # Re-check every second: other processes on this node free space too
+            while disk_usage() + _reserved + need > budget_bytes():
+                if time.monotonic() > deadline: raise DownloadBusy("Download scratch space is full")
+                _budget.wait(1.0)
+            _reserved += need
+        try:
+            yield create_job_dir()
+        finally:
+            with _budget:
+                _reserved -= need
+                _budget.notify_all()
+    finally:
+        _slots.release()
+
+def create_job_dir():
+    path = os.path.join(get_root(), f"{os.getpid()}-{uuid.uuid4().hex[:12]}")
+    os.makedirs(path)
+    return path
+
+def release(path):
+    """Deletes a downloaded file together with its job directory (and anything derived from it)."""
+    if not path: return
+    job_dir = os.path.dirname(os.path.abspath(path)) if not os.path.isdir(path) else path
+    if os.path.dirname(job_dir) == os.path.abspath(get_root()):
+        shutil.rmtree(job_dir, ignore_errors=True)
+    else:
+        try: os.remove(path)
+        except OSError: pass
+    with _budget: _budget.notify_all()
+
+# --- JANITOR ---
+
+def _pid_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except (PermissionError, OSError): return True
+    return True
+
+def sweep():
+    """
+    Removes job directories left behind by crashed processes, and any older than
+    DOWNLOAD_MAX_AGE_MINUTES (a job that never reached the analyze stage). Returns the count.
+    """
+    cutoff = time.time() - DOWNLOAD_MAX_AGE_MINUTES * 60
+    removed = 0
+    with os.scandir(get_root()) as entries:
+        for entry in entries:
+            if not entry.is_dir(): continue
+            pid = entry.name.split("-", 1)[0]
+            try: dead = pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid))
+            except Exception: dead = False
+            try: old = entry.stat().st_mtime < cutoff
+            except OSError: continue
+            if dead or old:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    if removed:
+        print(f"🧹 Removed {removed} leftover download directories")
+        with _budget: _budget.notify_all()
+    return removed
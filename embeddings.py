@@ -0,0 +1,181 @@
+import threading
+import asyncio
+from collections import OrderedDict
+import numpy as np
+
+import database
+import metrics
+from settings import EMBEDDING_MODEL, EMBEDDING_CACHE_DIR, EMBEDDING_INDEX_MB, EMBEDDING_INDEX_OVERLAP
+
+# --- LOCAL EMBEDDING MODEL ---
+# Runs on CPU through ONNX (fastembed). The model files are baked into the Docker image,
+# so nothing goes over the network at runtime. Without fastembed, search is keyword-only.
+
+_model = None
+_model_lock = threading.Lock()
+_model_failed = False
+
+def get_model():
+    global _model, _model_failed
+    if _model is not None or _model_failed: return _model
+    with _model_lock:
+        if _model is None and not _model_failed:
+            try:
+                from fastembed import TextEmbedding
+                _model = TextEmbedding(EMBEDDING_MODEL, cache_dir=EMBEDDING_CACHE_DIR, threads=1)
+                print(f"✅ Embedding model loaded: {EMBEDDING_MODEL}")
+            except Exception as e:
+                print(f"⚠️ Embeddings disabled (keyword search only): {e}")
+                _model_failed = True
+    return _model
+
+def embed_document(text):
+    """Returns the float32 embedding of a saved item as bytes (for the links.embedding column)."""
+    model = get_model()
+    if not model or not text: return None
+    vector = next(iter(model.passage_embed([text])))
+    return _normalize(np.asarray(vector, dtype=np.float32)).tobytes()
+
+def embed_query(text):
+    model = get_model()
+    if not model: return None
+    vector = next(iter(model.query_embed(text)))
+    return _normalize(np.asarray(vector, dtype=np.float32))
+
+def _normalize(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# --- PER-USER VECTOR INDEX ---
+# Tagged with the user's library version and rewrites (see database.py). A new version with the
+# same rewrites only added links: their rows (id above the newest indexed one, minus an overlap
+# for saves committed out of id order) are appended. New rewrites are patched in by link id from
+# the rewrite log: those rows are dropped and re-read if they still exist. Only a log that no
+# longer covers the index's age (or a patch touching most of it) means a rebuild.
+# The cache is bounded by the bytes of all matrices together, not by a number of users.
+
+class UserIndex:
+    """All of one user's vectors in a single contiguous float32 matrix (one row per link)."""
+
+    def __init__(self, version, rewrites, rows):
+        self.version, self.rewrites = version, rewrites
+        self.ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        self.vectors = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) if rows else None
+        self.max_id = int(self.ids.max()) if rows else 0
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + (self.vectors.nbytes if self.vectors is not None else 0)
+
+    def updated(self, version, rewrites, rows, replaced=()):
+        """
+        A new index with the rows of `replaced` ids dropped (rewritten or deleted) and the rows not
+        indexed yet added (this one is shared, so left as is).
+        """
+        ids, vectors = self.ids, self.vectors
+        if replaced and vectors is not None:
+            keep = ~np.isin(ids, np.fromiter(replaced, dtype=np.int64, count=len(replaced)))
+            ids, vectors = ids[keep], vectors[keep]
+        known = set(ids.tolist()) if rows else set()
+        index = UserIndex(version, rewrites, [row for row in rows if row[0] not in known])
+        if vectors is not None and len(ids):
+            if index.vectors is not None:
+                index.ids = np.concatenate([ids, index.ids])
+                index.vectors = np.vstack([vectors, index.vectors])
+            else:
+                index.ids, index.vectors = ids, vectors
+        index.max_id = max(self.max_id, index.max_id)
+        return index
+
+    def top_k(self, query_vector, k):
+        """Ids of the k most similar links, best first (vectors are normalized, so dot = cosine)."""
+        if self.vectors is None or not len(self.ids): return []
+        scores = self.vectors @ query_vector
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return self.ids[best].tolist()
+
+_indexes = OrderedDict()
+_indexes_bytes = 0
+_indexes_lock = threading.Lock()
+
+def _cached_index(user_id):
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is not None: _indexes.move_to_end(user_id)
+        return index
+
+def _store_index(user_id, index):
+    global _indexes_bytes
+    with _indexes_lock:
+        previous = _indexes.pop(user_id, None)
+        if previous is not None: _indexes_bytes -= previous.nbytes
+        _indexes[user_id] = index
+        _indexes_bytes += index.nbytes
+        # Evict least recently used users until the matrices fit (the one just stored always stays)
+        while _indexes_bytes > EMBEDDING_INDEX_MB * 1024 * 1024 and len(_indexes) > 1:
+            _, evicted = _indexes.popitem(last=False)
+            _indexes_bytes -= evicted.nbytes
+
+async def refresh_index(user_id, index, version, rewrites):
+    """Brings a user's cached index (or None) up to date. Returns (index, how: hit/append/patch/rebuild)."""
+    if index is not None and index.rewrites != rewrites:
+        logged = await database.fetch_rewritten_ids(user_id, index.rewrites, rewrites)
+        replaced = {link_id for link_ids in logged.values() for link_id in link_ids}
+        # Patch only if the log still has every rewrite since the index was built, and it touches
+        # less than half of the index (else reading everything is about as cheap)
+        if set(logged) == set(range(index.rewrites + 1, rewrites + 1)) and len(replaced) <= len(index.ids) // 2:
+            rows = list(await database.fetch_embeddings(user_id, ids=replaced))
+            rows += await database.fetch_embeddings(user_id, max(index.max_id - EMBEDDING_INDEX_OVERLAP, 0))
+            return await asyncio.to_thread(index.updated, version, rewrites, rows, replaced), "patch"
+        index = None
+    if index is None:
+        rows = await database.fetch_embeddings(user_id)
+        return await asyncio.to_thread(UserIndex, version, rewrites, rows), "rebuild"
+    if index.version != version:
+        rows = await database.fetch_embeddings(user_id, max(index.max_id - EMBEDDING_INDEX_OVERLAP, 0))
+        return await asyncio.to_thread(index.updated, version, rewrites, rows), "append"
+    return index, "hit"
+
+async def semantic_search(user_id, query, k=10):
+    """Vector top-k over a user's library. Only vectors saved or changed since the last query are read."""
+    query_vector = await asyncio.to_thread(embed_query, query)
+    if query_vector is None: return []
+
+    version, rewrites = await database.get_library_rewrites(user_id)
+    cached = _cached_index(user_id)
+    index, how = await refresh_index(user_id, cached, version, rewrites)
+    metrics.CACHE_LOOKUPS.inc(cache="vector_index", result=how)
+    if index is not cached: _store_index(user_id, index)
+    return await asyncio.to_thread(index.top_k, query_vector, k)
+
+# --- HYBRID RETRIEVAL (Ask Nexus) ---
+
+async def search_nexus_memory(user_id, query, limit=10):
+    """
+    Blends keyword hits and semantic hits with reciprocal rank fusion,
+    so "sushi place" also finds a summary that only says "omakase restaurant".
+    Returns rows of (title, ai_summary, category, url, lat, lon).
+    """
+    keyword_rows = await database.search_links(user_id, query, limit=limit, match_any=True)
+    try:
+        semantic_ids = await semantic_search(user_id, query, k=limit)
+    except Exception as e:
+        print(f"⚠️ Semantic search failed: {e}")
+        semantic_ids = []
+
+    scores = {}
+    for ranking in ([row[0] for row in keyword_rows], semantic_ids):
+        for rank, link_id in enumerate(ranking):
+            scores[link_id] = scores.get(link_id, 0.0) + 1.0 / (60 + rank)
+    best_ids = sorted(scores, key=scores.get, reverse=True)[:limit]
+
+    rows = {row[0]: row for row in keyword_rows}
+    missing = [link_id for link_id in best_ids if link_id not in rows]
+    if missing:
+        for row in await database.fetch_links(user_id, missing): rows[row[0]] = row
+
+    # Ids of links deleted since they were indexed simply don't come back from the DB
+    return [(title, summary, category, url, lat, lon)
+            for _, title, _, url, category, summary, lat, lon, _ in (rows[i] for i in best_ids if i in rows)]
@@ -1,42 +1,116 @@
+import re
+import threading
 import requests
-from geopy.geocoders import Nominatim
-from settings import OLA_MAPS_API_KEY # UPDATED IMPORT
+import database
+from cache import TTLCache
+from settings import OLA_MAPS_API_KEY, GEOCODE_TTL_DAYS, GEOCODE_NEGATIVE_TTL_DAYS # UPDATED IMPORT
+
+# --- GEOCODE CACHE ---
+# Same places come up again and again across users ("Goa, India"), so answers are kept in
+# Postgres (shared by every process) with an in-process LRU in front. Misses are cached too,
+# for a shorter time, so unknown places stop costing two providers' timeouts. Only a provider
+# answering "no results" counts as a miss: timeouts, 429s and other errors are never cached.
+
+_memory_cache = TTLCache(maxsize=4096, ttl=3600)
+_geolocator = None
+_geolocator_lock = threading.Lock()
+LOOKUP_FAILED = "error" # Provider value of a lookup that failed (not a miss)
+
+class GeocodeError(Exception):
+    """A provider could not answer (network error, rate limit, bad response)."""
+
+def normalize_location(location_name):
+    text = re.sub(r'\s+', ' ', location_name.strip().lower())
+    return re.sub(r'\s*,\s*', ', ', text).strip(' ,.')
+
+def get_geolocator():
+    global _geolocator
+    with _geolocator_lock:
+        if _geolocator is None:
+            from geopy.geocoders import Nominatim # Loaded on first use
+            _geolocator = Nominatim(user_agent="NexusBot_v1")
+    return _geolocator
 
 def get_coordinates_ola(location_name):
     if not OLA_MAPS_API_KEY: return None, None
     print(f"📍 Trying Ola Maps for: '{location_name}'")
     try:
-        base_url = "https://api.olamaps.io/places/v1/geocode" 
+        base_url = "https://api.olamaps.io/places/v1/geocode"
         params = {"address": location_name, "api_key": OLA_MAPS_API_KEY}
         response = requests.get(base_url, params=params, timeout=5)
+        if response.status_code != 200: raise GeocodeError(f"HTTP {response.status_code}")
         data = response.json()
-        if "geocodingResults" in data and len(data["geocodingResults"]) > 0:
-            result = data["geocodingResults"][0]
-            lat = result.get("geometry", {}).get("location", {}).get("lat")
-            lng = result.get("geometry", {}).get("location", {}).get("lng")
-            if lat and lng: return lat, lng
-    except Exception as e: print(f"⚠️ Ola Maps Error: {e}")
+    except GeocodeError: raise
+    except Exception as e: raise GeocodeError(f"Ola Maps: {e}") from e
+    if "geocodingResults" not in data: raise GeocodeError(f"Ola Maps: unexpected response {str(data)[:200]}")
+    if len(data["geocodingResults"]) > 0:
+        result = data["geocodingResults"][0]
+        lat = result.get("geometry", {}).get("location", {}).get("lat")
+        lng = result.get("geometry", {}).get("location", {}).get("lng")
+        if lat and lng: return lat, lng
     return None, None
 
 def get_coordinates_osm(location_name):
     if not location_name or location_name.lower() == "none": return None, None
-    geolocator = Nominatim(user_agent="NexusBot_v1")
+    geolocator = get_geolocator()
     attempts = [location_name]
     if "," in location_name:
         parts = [p.strip() for p in location_name.split(",")]
         if len(parts) >= 2: attempts.append(f"{parts[0]}, {parts[1]}")
-        attempts.append(parts[0]) 
+        attempts.append(parts[0])
+    error = None
     for search_query in attempts:
         try:
             print(f"📍 Trying OSM: '{search_query}'...")
             location = geolocator.geocode(search_query, timeout=5)
             if location: return location.latitude, location.longitude
-        except Exception as e: print(f"   ❌ OSM Error: {e}")
+        except Exception as e:
+            print(f"   ❌ OSM Error: {e}")
+            error = e
+    # A failed attempt might have found it: only "nothing found" everywhere is a real miss
+    if error: raise GeocodeError(f"OSM: {error}") from error
     return None, None
 
-def get_best_coordinates(location_name):
-    lat, lon = get_coordinates_ola(location_name)
-    if lat and lon: return lat, lon
-    lat, lon = get_coordinates_osm(location_name)
-    if lat and lon: return lat, lon
-    return None, None
\ No newline at end of file
+def lookup_providers(location_name):
+    """
+    Asks the providers in order. Returns (lat, lon, provider), (None, None, None) if none knows
+    the place, or (None, None, LOOKUP_FAILED) if one of them couldn't answer.
+    """
+    failed = False
+    for provider, lookup in (("ola", get_coordinates_ola), ("osm", get_coordinates_osm)):
+        try: lat, lon = lookup(location_name)
+        except GeocodeError as e:
+            print(f"⚠️ Geocoding Error: {e}")
+            failed = True
+            continue
+        if lat and lon: return lat, lon, provider
+    return None, None, (LOOKUP_FAILED if failed else None)
+
+def get_best_coordinates(location_name, refresh=False):
+    """refresh=True skips the caches (but still updates them), e.g. after changing providers."""
+    if not location_name: return None, None
+    key = normalize_location(location_name)
+
+    if not refresh:
+        # 1. In-process LRU
+        hit = _memory_cache.get(key)
+        if hit: return hit[0], hit[1]
+
+        # 2. Shared Postgres cache (expired rows are ignored)
+        try:
+            hit = database.get_cached_geocode(key, GEOCODE_TTL_DAYS, GEOCODE_NEGATIVE_TTL_DAYS)
+        except Exception as e:
+            print(f"⚠️ Geocode Cache Error: {e}")
+            hit = None
+        if hit:
+            _memory_cache.set(key, hit)
+            return hit[0], hit[1]
+
+    # 3. Providers (network)
+    lat, lon, provider = lookup_providers(location_name)
+    if provider == LOOKUP_FAILED: return None, None # Try again next time
+    result = (lat, lon, provider)
+    _memory_cache.set(key, result)
+    try: database.put_cached_geocode(key, lat, lon, provider)
+    except Exception as e: print(f"⚠️ Geocode Cache Error: {e}")
+    return lat, lon
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import io
+import os
+import re
+import sys
+import zipfile
+
+import database
+import urls
+from settings import IMPORT_MAX_LINKS, IMPORT_PROGRESS_INTERVAL
+
+# Bulk import of saved posts: an Instagram / TikTok data export (.zip, .json or .html) or a
+# plain list of links (.txt / .csv). Used by the bot's /import command and from the shell:
+#
+#   python importer.py --user 12345 instagram-export.zip
+#   python importer.py --user 12345 links.txt --dry-run
+#
+# Links are canonicalized, checked against the user's library in one query and queued in one
+# INSERT as quiet jobs; the normal ingest workers do the rest.
+
+URL_RE = re.compile(r'https?://[^\s"\'<>\\]+')
+# In exports only post links count (they also contain profile, music and policy links)
+POST_RE = re.compile(
+    r'instagram\.com/(?:[\w.]+/)?(?:p|reels?|tv)/|tiktokv?\.com/.*video/\d|(?:vm|vt)\.tiktok\.com/'
+    r'|youtube\.com/(?:shorts/|watch)|youtu\.be/'
+)
+EXPORT_SUFFIXES = (".json", ".html", ".htm")
+LIST_SUFFIXES = (".txt", ".csv")
+MAX_MEMBER_BYTES = 50 * 1024 * 1024
+
+# --- PARSING ---
+
+def urls_in_text(text, posts_only):
+    text = text.replace("\\/", "/") # JSON exports may escape slashes
+    found = (m.group(0).rstrip('.,;)]}') for m in URL_RE.finditer(text))
+    return [url for url in found if not posts_only or POST_RE.search(url)]
+
+def extract_urls(filename, data):
+    """All post links in an export file (zip of the data download, or one file out of it) or URL list."""
+    name = (filename or "").lower()
+    found = []
+    if name.endswith(".zip") or data[:4] == b"PK\x03\x04":
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for member in archive.infolist():
+                member_name = member.filename.lower()
+                if member.is_dir() or member.file_size > MAX_MEMBER_BYTES: continue
+                if not member_name.endswith(EXPORT_SUFFIXES + LIST_SUFFIXES): continue
+                text = archive.read(member).decode("utf-8", errors="ignore")
+                found += urls_in_text(text, posts_only=member_name.endswith(EXPORT_SUFFIXES))
+    else:
+        found = urls_in_text(data.decode("utf-8", errors="ignore"), posts_only=name.endswith(EXPORT_SUFFIXES))
+    return list(dict.fromkeys(found)) # Dedupe, keep export order
+
+# --- QUEUEING ---
+
+async def import_urls(user_id, chat_id, raw_urls, dry_run=False):
+    """
+    Queues the links the user doesn't have yet. Returns a summary dict:
+    found, duplicates (in the file), saved (already in the library), queued, job_ids.
+    """
+    canonical = await asyncio.to_thread(lambda: [urls.canonicalize_url(url) for url in raw_urls])
+    # The canonical form is only the dedup key; the download uses the link from the export
+    unique = {}
+    for url, canonical_url in zip(raw_urls, canonical): unique.setdefault(canonical_url, url)
+    truncated = len(unique) > IMPORT_MAX_LINKS
+    if truncated: unique = dict(list(unique.items())[:IMPORT_MAX_LINKS])
+
+    saved = await database.find_saved(user_id, list(unique.values()), list(unique))
+    links = [(urls.download_url(url), canonical_url) for canonical_url, url in unique.items() if canonical_url not in saved]
+    job_ids = [] if dry_run else await database.enqueue_jobs(user_id, chat_id, links)
+    return {
+        'found': len(raw_urls), 'duplicates': len(raw_urls) - len(unique), 'saved': len(saved),
+        'queued': len(job_ids) if not dry_run else len(links), 'job_ids': job_ids,
+        'truncated': truncated,
+    }
+
+async def import_file(user_id, chat_id, filename, data, dry_run=False):
+    raw_urls = await asyncio.to_thread(extract_urls, filename, data)
+    return await import_urls(user_id, chat_id, raw_urls, dry_run)
+
+def describe(summary):
+    text = (f"📦 Found {summary['found']} links: {summary['queued']} queued, "
+            f"{summary['saved']} already saved, {summary['duplicates']} repeated in the file.")
+    if summary['truncated']: text += f"\n⚠️ Only the first {IMPORT_MAX_LINKS} links were taken."
+    return text
+
+async def watch_progress(job_ids, on_progress, interval=IMPORT_PROGRESS_INTERVAL):
+    """Calls on_progress(done, failed, total, finished) every interval seconds until all jobs are over."""
+    total = len(job_ids)
+    while True:
+        await asyncio.sleep(interval)
+        try: counts = await database.job_progress(job_ids)
+        except Exception as e:
+            print(f"⚠️ Import progress check failed: {e}")
+            continue
+        done, failed = counts.get('done', 0), counts.get('failed', 0)
+        finished = done + failed >= total
+        await on_progress(done, failed, total, finished)
+        if finished: return
+
+# --- CLI ---
+
+async def run(args):
+    raw_urls = []
+    for path in args.files:
+        with open(path, "rb") as f: raw_urls += await asyncio.to_thread(extract_urls, os.path.basename(path), f.read())
+    summary = await import_urls(args.user, args.chat or args.user, list(dict.fromkeys(raw_urls)), args.dry_run)
+    print(describe(summary))
+    sys.stdout.flush()
+
+    if summary['job_ids'] and not args.no_wait:
+        async def report(done, failed, total, finished):
+            print(f"⏳ {done + failed}/{total} processed ({failed} failed)")
+            sys.stdout.flush()
+        print("⚙️ Waiting for the ingest workers (bot with EMBEDDED_WORKERS or worker.py must be running)...")
+        await watch_progress(summary['job_ids'], report, args.interval)
+        print("✅ Import finished")
+    await database.close_async_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-import saved posts from an export file or a URL list.")
+    parser.add_argument("files", nargs="+", help="Export .zip/.json/.html or .txt/.csv URL list(s)")
+    parser.add_argument("--user", type=int, required=True, help="Telegram user id to import for")
+    parser.add_argument("--chat", type=int, help="Chat id stored on the jobs (default: the user id)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be queued")
+    parser.add_argument("--no-wait", action="store_true", help="Queue and exit without waiting")
+    parser.add_argument("--interval", type=int, default=IMPORT_PROGRESS_INTERVAL, help="Seconds between progress lines")
+    args = parser.parse_args()
+
+    database.init_db()
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
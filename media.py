@@ -0,0 +1,58 @@
+import os
+import mimetypes
+import subprocess
+from settings import VIDEO_REDUCTION_MODE, VIDEO_MAX_HEIGHT, VIDEO_REDUCTION_MIN_MB
+
+# --- PRE-UPLOAD VIDEO REDUCTION ---
+# Gemini samples video at about 1 frame per second and only needs speech-quality audio,
+# so a small re-encode loses almost nothing while cutting upload size and processing time.
+#   transcode: low resolution / low bitrate copy of the whole clip
+#   keyframes: 1 frame per second + mono audio (what the model actually looks at)
+#   audio:     mono audio only (smallest, but on-screen text is lost)
+#   off:       upload the download as-is
+
+MODES = ("transcode", "keyframes", "audio", "off")
+
+def _scale_filter():
+    return f"scale=-2:'min({VIDEO_MAX_HEIGHT},ih)'"
+
+def _ffmpeg_args(mode, src, dst):
+    audio = ["-c:a", "aac", "-b:a", "48k", "-ac", "1"]
+    if mode == "transcode":
+        video = ["-vf", _scale_filter(), "-c:v", "libx264", "-preset", "veryfast", "-crf", "32"]
+    elif mode == "keyframes":
+        video = ["-vf", f"fps=1,{_scale_filter()}", "-c:v", "libx264", "-preset", "veryfast", "-crf", "30"]
+    else:
+        video = ["-vn"]
+    return ["ffmpeg", "-y", "-loglevel", "error", "-i", src, *video, *audio, "-movflags", "+faststart", dst]
+
+def original_mime_type(path):
+    """MIME type of the download itself (yt-dlp may hand back webm or mkv, not only mp4)."""
+    return mimetypes.guess_type(path)[0] or "video/mp4"
+
+def reduce_video(path, mode=None):
+    """
+    Returns (path, mime_type) of the file to upload. Falls back to the original file
+    if ffmpeg is missing, fails, or doesn't make the file smaller.
+    """
+    mode = mode or VIDEO_REDUCTION_MODE
+    if mode not in MODES or mode == "off": return path, original_mime_type(path)
+    if os.path.getsize(path) < VIDEO_REDUCTION_MIN_MB * 1024 * 1024 and mode != "audio":
+        return path, original_mime_type(path)
+
+    base, _ = os.path.splitext(path)
+    dst = f"{base}.{mode}.{'m4a' if mode == 'audio' else 'mp4'}"
+    mime_type = "audio/mp4" if mode == "audio" else "video/mp4"
+    try:
+        subprocess.run(_ffmpeg_args(mode, path, dst), check=True, timeout=180, capture_output=True)
+        before, after = os.path.getsize(path), os.path.getsize(dst)
+        if after >= before:
+            os.remove(dst)
+            return path, original_mime_type(path)
+        print(f"🎞️ Reduced video ({mode}): {before // 1024} KB -> {after // 1024} KB")
+        return dst, mime_type
+    except Exception as e:
+        print(f"⚠️ Video reduction failed ({mode}): {e}")
+        try: os.remove(dst)
+        except: pass
+        return path, original_mime_type(path)
@@ -0,0 +1,126 @@
+import re
+import sys
+import json
+import html
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from settings import METADATA_TIMEOUT, METADATA_MAX_HEAD_KB, METADATA_THREADS
+
+# --- PAGE METADATA ---
+# Title, cover and caption of a post from its OpenGraph tags, without the video.
+# The page is streamed and reading stops at </head> (the og: tags are always in the head, the
+# body is most of the bytes), and the head is scanned with a few regexes instead of building
+# a soup. One keep-alive session per host, so repeat lookups skip the TCP + TLS handshake.
+# prefetch() runs it next to the yt-dlp download; scraper uses the result as its fallback.
+#
+#   python metadata.py https://www.instagram.com/reel/... [more urls]
+
+HEAD_END_RE = re.compile(rb'</head\s*>|<body[\s>]', re.IGNORECASE)
+META_RE = re.compile(r'<meta\s[^>]*>', re.IGNORECASE)
+ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+TITLE_RE = re.compile(r'<title[^>]*>(.*?)</title', re.IGNORECASE | re.DOTALL)
+CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+DRAIN_LIMIT = 64 * 1024 # Read small leftovers to keep the connection reusable; drop bigger ones
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_pool = None
+
+def get_session(host):
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            from scraper import get_random_user_agent
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=METADATA_THREADS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                'User-Agent': get_random_user_agent(),
+                'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'en-US,en;q=0.9',
+                'Referer': 'https://www.google.com/',
+            })
+            _sessions[host] = session
+    return session
+
+def read_head(response):
+    """Bytes up to </head> (or the first METADATA_MAX_HEAD_KB)."""
+    limit = METADATA_MAX_HEAD_KB * 1024
+    buffer = b""
+    for chunk in response.iter_content(16 * 1024):
+        buffer += chunk
+        # Look a little behind the new chunk in case the tag was split across two
+        match = HEAD_END_RE.search(buffer, max(0, len(buffer) - len(chunk) - 16))
+        if match: return buffer[:match.start()], True
+        if len(buffer) >= limit: return buffer[:limit], True
+    return buffer, False
+
+def parse_head(text):
+    """{'og:title': ..., 'description': ..., 'title': <title>} from the meta tags of an HTML head."""
+    tags = {}
+    for tag in META_RE.findall(text):
+        attrs = {}
+        for m in ATTR_RE.finditer(tag):
+            attrs[m.group(1).lower()] = next(value for value in m.groups()[1:] if value is not None)
+        key = (attrs.get("property") or attrs.get("name") or "").lower()
+        if key and "content" in attrs and key not in tags: tags[key] = html.unescape(attrs["content"]).strip()
+    match = TITLE_RE.search(text)
+    if match: tags["title"] = html.unescape(match.group(1)).strip()
+    return tags
+
+def fetch_metadata(url, timeout=METADATA_TIMEOUT):
+    """
+    {'title', 'description', 'image'} of a page ('' where missing); all empty if it can't be read.
+    Blocking; safe to call from many threads at once.
+    """
+    data = {"title": "", "description": "", "image": ""}
+    try:
+        session = get_session(urlsplit(url).netloc.lower())
+        with session.get(url, stream=True, timeout=timeout) as response:
+            if response.status_code != 200: return data
+            head, stopped = read_head(response)
+            if stopped:
+                length = int(response.headers.get("Content-Length") or 0)
+                if 0 < length - len(head) <= DRAIN_LIMIT:
+                    for _ in response.iter_content(16 * 1024): pass
+                else: response.close() # Not worth downloading the rest just to reuse the socket
+        match = CHARSET_RE.search(head)
+        encoding = response.encoding if "charset" in response.headers.get("Content-Type", "").lower() else None
+        if not encoding: encoding = match.group(1).decode() if match else "utf-8"
+        try: text = head.decode(encoding, errors="replace")
+        except LookupError: text = head.decode("utf-8", errors="replace")
+    except Exception as e:
+        print(f"❌ Metadata Error: {e}")
+        return data
+
+    tags = parse_head(text)
+    data["title"] = tags.get("og:title") or tags.get("twitter:title") or tags.get("title", "")
+    data["description"] = tags.get("og:description") or tags.get("description", "")
+    data["image"] = tags.get("og:image") or tags.get("og:image:url") or tags.get("twitter:image", "")
+
+    # Clean up the title if it's junk: on Instagram the OG description is usually the caption
+    if "instagram" in data["title"].lower():
+        if data["description"]:
+            data["title"] = (data["description"][:50] + '...') if len(data["description"]) > 50 else data["description"]
+        elif tags.get("title"):
+            data["title"] = tags["title"].replace("Instagram", "").strip()
+    return data
+
+def prefetch(url):
+    """Starts fetch_metadata in the background; returns a concurrent.futures.Future."""
+    global _pool
+    with _sessions_lock:
+        if _pool is None: _pool = ThreadPoolExecutor(METADATA_THREADS, thread_name_prefix="metadata")
+    return _pool.submit(fetch_metadata, url)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2: sys.exit("usage: python metadata.py URL [URL ...]")
+    futures = [(url, prefetch(url)) for url in sys.argv[1:]]
+    for url, future in futures:
+        print(json.dumps({"url": url, **future.result()}, ensure_ascii=False))
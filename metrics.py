@@ -0,0 +1,144 @@
+import sys
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# --- METRICS ---
+# Minimal Prometheus-style counters, gauges and histograms (text exposition format 0.0.4),
+# kept in process memory and served on /metrics next to the health check.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_collectors = []
+
+def _label_str(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name, self.help, self.kind = name, help_text, "counter"
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock: self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock: return [(self.name, key, value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock: self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.kind = name, help_text, "histogram"
+        self.buckets = tuple(buckets)
+        self.series = {} # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None: series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        """{labels: (bucket_counts, sum, count)} with cumulative bucket counts."""
+        with self.lock:
+            return {key: (series[:-2], series[-2], series[-1]) for key, series in self.series.items()}
+
+    def samples(self):
+        out = []
+        for key, (counts, total, count) in self.snapshot().items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                out.append((f"{self.name}_bucket", key + (("le", bound),), bucket_count))
+            out.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+            out.append((f"{self.name}_sum", key, total))
+            out.append((f"{self.name}_count", key, count))
+        return out
+
+# --- NEXUS METRICS ---
+
+STAGE_SECONDS = Histogram("nexus_stage_duration_seconds", "Time spent in each ingest / RAG stage")
+STAGE_ERRORS = Counter("nexus_stage_errors_total", "Stages that raised an error")
+JOBS = Counter("nexus_jobs_total", "Ingest jobs handled per stage and outcome")
+QUEUE_DEPTH = Gauge("nexus_queue_depth", "Ingest jobs waiting or running per stage")
+CACHE_LOOKUPS = Counter("nexus_cache_lookups_total", "Cache lookups per cache and result (hit/miss, vector_index: hit/append/patch/rebuild)")
+
+class timer:
+    """
+    Times a stage into STAGE_SECONDS (and counts errors). Works as `with` and `async with`:
+        with metrics.timer("geocode"): ...
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.started, stage=self.stage)
+        if exc_type is not None and issubclass(exc_type, Exception): STAGE_ERRORS.inc(stage=self.stage)
+        return False
+
+    async def __aenter__(self): return self.__enter__()
+    async def __aexit__(self, exc_type, exc, tb): return self.__exit__(exc_type, exc, tb)
+
+def register_collector(fn):
+    """fn() is called before each scrape, e.g. to refresh gauges read from the database."""
+    _collectors.append(fn)
+
+def render():
+    for fn in _collectors:
+        try: fn()
+        except Exception as e: print(f"⚠️ Metrics collector failed: {e}")
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_label_str(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+# --- HTTP (health check + /metrics) ---
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"Nexus Bot is Alive")
+    def log_message(self, format, *args): pass
+
+def start_http_server(port):
+    """Blocking: serves /health and /metrics on the given port (run it in a daemon thread)."""
+    try:
+        server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
+        print(f"✅ Health check server listening on port {port}")
+        sys.stdout.flush()
+        server.serve_forever()
+    except Exception as e:
+        print(f"❌ Failed to start health server: {e}")
+        sys.stdout.flush()
@@ -0,0 +1,262 @@
+# --- SCHEMA MIGRATIONS ---
+# Numbered, append-only list of schema changes. init_db() applies the ones not yet recorded in
+# schema_migrations, in order and in one transaction, under an advisory lock so the bot and
+# several workers starting at once don't race. Steps 1-16 are idempotent: databases created
+# before versioning simply run them once more and get recorded.
+# Never edit an applied migration; add a new one at the end.
+
+LOCK_ID = 0x6E657875 # pg_advisory_xact_lock key ("nexu")
+
+MIGRATIONS = [
+    (1, "Links table", [
+        """
+        CREATE TABLE IF NOT EXISTS links (
+            id SERIAL PRIMARY KEY,
+            url TEXT,
+            title TEXT,
+            image_url TEXT,
+            category TEXT DEFAULT 'Inbox',
+            ai_summary TEXT,
+            user_id BIGINT,
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION
+        );
+        """,
+    ]),
+    (2, "Users table", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            password_hash TEXT
+        );
+        """,
+    ]),
+    (3, "Ingest job queue", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            stage TEXT NOT NULL DEFAULT 'download',
+            status TEXT NOT NULL DEFAULT 'queued',
+            user_id BIGINT,
+            chat_id BIGINT,
+            status_message_id BIGINT,
+            url TEXT,
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            node TEXT,
+            locked_by TEXT,
+            locked_at TIMESTAMPTZ,
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS jobs_claim_idx ON jobs (stage, status, id)",
+    ]),
+    (4, "Username column", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT UNIQUE",
+    ]),
+    (5, "Full-text search vector (kept up to date by Postgres) + GIN index", [
+        """
+        ALTER TABLE links ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(category, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(ai_summary, '')), 'C')
+        ) STORED
+        """,
+        "CREATE INDEX IF NOT EXISTS links_search_idx ON links USING GIN (search_vector)",
+    ]),
+    (6, "Local embedding of each item (float32 bytes) for semantic search", [
+        "ALTER TABLE links ADD COLUMN IF NOT EXISTS embedding BYTEA",
+    ]),
+    (7, "Index for per-user listing / keyset pagination", [
+        "CREATE INDEX IF NOT EXISTS links_user_id_idx ON links (user_id, id DESC)",
+    ]),
+    (8, "Thumbnails captured at save time (content-addressed WebP)", [
+        """
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            key TEXT PRIMARY KEY,
+            data BYTEA NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "ALTER TABLE links ADD COLUMN IF NOT EXISTS thumbnail_key TEXT",
+    ]),
+    (9, "Geocode cache (found = FALSE rows are cached \"not found\" answers)", [
+        """
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query TEXT PRIMARY KEY,
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION,
+            provider TEXT,
+            found BOOLEAN NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+    ]),
+    (10, "Canonical URLs + analysis shared across users (keyed on URL and on video hash)", [
+        "ALTER TABLE links ADD COLUMN IF NOT EXISTS canonical_url TEXT",
+        "CREATE INDEX IF NOT EXISTS links_canonical_idx ON links (user_id, canonical_url)",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS canonical_url TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            canonical_url TEXT PRIMARY KEY,
+            video_hash TEXT,
+            title TEXT,
+            description TEXT,
+            image_url TEXT,
+            thumbnail_key TEXT,
+            ai_summary TEXT,
+            category TEXT,
+            location_str TEXT,
+            ai_coords JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS analysis_cache_video_idx ON analysis_cache (video_hash)",
+    ]),
+    (11, "Keep what reprocessing needs (older rows have NULLs here)", [
+        "ALTER TABLE links ADD COLUMN IF NOT EXISTS location_str TEXT",
+        # Added without a default (that would stamp every existing row), then defaulted for new rows
+        "ALTER TABLE links ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ",
+        "ALTER TABLE links ALTER COLUMN created_at SET DEFAULT now()",
+    ]),
+    (12, "Library version per user, bumped by every write to their links (cache invalidation)", [
+        """
+        CREATE TABLE IF NOT EXISTS library_versions (
+            user_id BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+    ]),
+    (13, "Map viewport queries: one user's points inside a lat/lon box", [
+        "CREATE INDEX IF NOT EXISTS links_geo_idx ON links (user_id, lat, lon) WHERE lat IS NOT NULL",
+    ]),
+    (14, "Bulk-imported jobs don't reply per link", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS quiet BOOLEAN NOT NULL DEFAULT FALSE",
+    ]),
+    (15, "Links of one multi-link message share a progress message (their group)", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS progress_message_id BIGINT",
+        """
+        CREATE INDEX IF NOT EXISTS jobs_group_idx ON jobs (chat_id, progress_message_id, status)
+        WHERE progress_message_id IS NOT NULL
+        """,
+    ]),
+    (16, "Fair scheduling: running jobs per user, counted on every claim", [
+        "CREATE INDEX IF NOT EXISTS jobs_running_idx ON jobs (user_id) WHERE status = 'running'",
+    ]),
+    (17, "Hot-path indexes: duplicate check by URL, categories per user", [
+        "CREATE INDEX IF NOT EXISTS links_user_url_idx ON links (user_id, url)",
+        "CREATE INDEX IF NOT EXISTS links_user_category_idx ON links (user_id, category)",
+    ]),
+    (18, "One saved link per (user, canonical URL): drop existing duplicates, keep the oldest", [
+        """
+        WITH removed AS (
+            DELETE FROM links l USING links keep
+            WHERE l.user_id = keep.user_id AND l.canonical_url = keep.canonical_url AND l.id > keep.id
+            RETURNING l.user_id
+        )
+        INSERT INTO library_versions (user_id, version, updated_at)
+        SELECT DISTINCT user_id, 1, now() FROM removed
+        ON CONFLICT (user_id) DO UPDATE SET version = library_versions.version + 1, updated_at = now()
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS links_user_canonical_key ON links (user_id, canonical_url)",
+        "DROP INDEX IF EXISTS links_canonical_idx",
+    ]),
+    (19, "One waiting or running job per (user, canonical URL)", [
+        """
+        UPDATE jobs j SET status = 'failed', last_error = 'Duplicate of job ' || keep.id, updated_at = now()
+        FROM jobs keep
+        WHERE j.user_id = keep.user_id AND j.canonical_url = keep.canonical_url AND j.id > keep.id
+          AND j.status IN ('queued', 'running') AND keep.status IN ('queued', 'running')
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_url_key ON jobs (user_id, canonical_url)
+        WHERE status IN ('queued', 'running')
+        """,
+    ]),
+    (20, "Worker node heartbeats (jobs pinned to a node that went away are rescued)", [
+        """
+        CREATE TABLE IF NOT EXISTS worker_nodes (
+            node TEXT PRIMARY KEY,
+            seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (21, "Instagram sound pages were all canonicalized to /reel/audio/: forget that key", [
+        "UPDATE links SET canonical_url = NULL WHERE canonical_url = 'https://www.instagram.com/reel/audio/'",
+        "DELETE FROM analysis_cache WHERE canonical_url = 'https://www.instagram.com/reel/audio/'",
+    ]),
+    (22, "Thumbnail garbage collection: which covers are still referenced", [
+        "CREATE INDEX IF NOT EXISTS links_thumbnail_key_idx ON links (thumbnail_key) WHERE thumbnail_key IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS analysis_cache_thumbnail_idx ON analysis_cache (thumbnail_key) WHERE thumbnail_key IS NOT NULL",
+    ]),
+    (23, "Job claims over all stages (attempts restarts at every stage)", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS total_attempts INT NOT NULL DEFAULT 0",
+    ]),
+    (24, "Rewrites per user: updates and deletes, which an append-only vector index can't follow", [
+        "ALTER TABLE library_versions ADD COLUMN IF NOT EXISTS rewrites BIGINT NOT NULL DEFAULT 0",
+    ]),
+    (25, "Jobs put off until later (e.g. no download scratch space) without spending an attempt", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS not_before TIMESTAMPTZ",
+    ]),
+    (26, "Instagram paths with a /p/ or /tv/ segment anywhere got a post's key: forget those keys", [
+        # Same rule as urls.INSTAGRAM_POST_RE, on the link as it was sent
+        r"""
+        CREATE TEMP TABLE misfiled_links ON COMMIT DROP AS
+        SELECT id, canonical_url FROM links
+        WHERE canonical_url LIKE 'https://www.instagram.com/reel/%'
+          AND url ~* '^https?://([a-z0-9-]+\.)*instagram\.com/'
+          AND url !~* '^https?://([a-z0-9-]+\.)*instagram\.com/([\w.]+/)?(p|reels?|tv)/[A-Za-z0-9_-]+/?([?#].*)?[].,;)>]*$'
+        """,
+        "DELETE FROM analysis_cache WHERE canonical_url IN (SELECT canonical_url FROM misfiled_links)",
+        "UPDATE links SET canonical_url = NULL WHERE id IN (SELECT id FROM misfiled_links)",
+    ]),
+    (27, "Fair claims: skip scan over the users with queued jobs and each one's head of the queue", [
+        "CREATE INDEX IF NOT EXISTS jobs_user_claim_idx ON jobs (stage, status, user_id, id)",
+    ]),
+    (28, "Links each rewrite touched, so the vector index can patch them by id", [
+        """
+        CREATE TABLE IF NOT EXISTS link_rewrites (
+            user_id BIGINT NOT NULL,
+            rewrites BIGINT NOT NULL,
+            link_id BIGINT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, rewrites, link_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS link_rewrites_created_idx ON link_rewrites (created_at)",
+    ]),
+]
+
+def migrate(conn):
+    """Applies pending migrations on a sync connection. Returns the versions applied."""
+    conn.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+    done = []
+    for version, name, statements in MIGRATIONS:
+        if version in applied: continue
+        for sql in statements: conn.execute(sql)
+        conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        print(f"🗄️ Migration {version}: {name}")
+        done.append(version)
+    return done
+
+def current_version(conn):
+    row = conn.execute("SELECT max(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+if __name__ == '__main__':
+    import database
+    with database.get_connection() as conn:
+        applied = migrate(conn)
+        print(f"✅ Schema at version {current_version(conn)} ({len(applied)} applied now)")
@@ -1,10 +1,10 @@
-import yt_dlp
-import time
-import glob
 import os
-import requests
-from bs4 import BeautifulSoup
 import random
+import hashlib
+import metrics
+import metadata
+import downloads
+from settings import VIDEO_REDUCTION_MODE, VIDEO_MAX_HEIGHT, DOWNLOAD_FRAGMENT_CONCURRENCY, METADATA_TIMEOUT
 
 def get_random_user_agent():
     # Rotate User Agents to avoid simple IP blocks
@@ -16,16 +16,30 @@ def get_random_user_agent():
     ]
     return random.choice(agents)
 
-def download_and_scrape_blocking(url):
-    filename = f"temp_{int(time.time())}"
-    
+def download_and_scrape_blocking(url, meta=None):
+    """
+    Downloads the video into its own scratch directory and collects title / cover / caption.
+    meta: optional metadata.prefetch(url) future already running, used if yt-dlp comes up short.
+    """
+    # Heavy imports, loaded on the first download instead of at startup
+    import yt_dlp
+
+    # Smallest format that is still good enough for the analysis (see media.reduce_video)
+    if VIDEO_REDUCTION_MODE == "audio":
+        video_format = 'bestaudio[ext=m4a]/bestaudio/best[ext=mp4]/best'
+    else:
+        video_format = 'best[ext=mp4]/best'
+
     # --- ANONYMOUS CONFIGURATION ---
     ydl_opts = {
-        'format': 'best[ext=mp4]/best', 
-        'outtmpl': f'{filename}.%(ext)s', 
+        'format': video_format, 
+        # Prefer the highest resolution up to VIDEO_MAX_HEIGHT, then the smallest file
+        'format_sort': [f'res:{VIDEO_MAX_HEIGHT}', '+size', '+br'],
+        'outtmpl': 'video.%(ext)s', # Inside this job's own scratch directory (see downloads.py)
         'quiet': True, 
         'no_warnings': True, 
-        'max_filesize': 50*1024*1024, # 50MB Limit
+        'max_filesize': downloads.max_file_bytes(),
+        'concurrent_fragment_downloads': DOWNLOAD_FRAGMENT_CONCURRENCY,
         'ignoreerrors': True,         # Don't crash on restrictions
         'nocheckcertificate': True,
         # Spoof Headers to look like a generic browser request
@@ -41,9 +55,12 @@ def download_and_scrape_blocking(url):
     
     # 1. Try Heavy Video Download (Anonymous yt-dlp)
     print("📥 Attempting Anonymous Download...")
+    job_dir = None
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        with downloads.download_slot() as job_dir, metrics.timer("download"):
+            ydl_opts['paths'] = {'home': job_dir, 'temp': job_dir}
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=True)
             
             if info:
                 data['title'] = info.get('title', '')
@@ -55,59 +72,44 @@ def download_and_scrape_blocking(url):
                 if not data['title'] or "instagram" in str(data['title']).lower():
                      if "instagram" in url: data['title'] = "Instagram Reel"
                 
-                # Check for file
-                files = glob.glob(f"{filename}.*")
+                # Check for file (partial downloads keep a .part suffix)
+                files = [f for f in os.listdir(job_dir) if not f.endswith((".part", ".ytdl"))]
                 if files: 
-                    data['video_path'] = files[0]
-                    print(f"✅ Download Success: {files[0]}")
+                    data['video_path'] = os.path.join(job_dir, files[0])
+                    print(f"✅ Download Success: {data['video_path']}")
             else:
                 print("⚠️ yt-dlp: Content restricted or blocked.")
 
+    except downloads.DownloadBusy:
+        raise # The job is put off and retried later (see worker.stage_worker) instead of saving it without a video
     except Exception as e:
         print(f"❌ yt-dlp Error: {e}")
-        # Cleanup
-        for f in glob.glob(f"{filename}*"):
-            try: os.remove(f)
-            except: pass
+
+    # Nothing usable downloaded: give the scratch space back right away
+    if job_dir and not data['video_path']: downloads.release(job_dir)
 
     # 2. ROBUST FALLBACK (Metadata Only)
     # If video failed (Restricted), grab what we can so the user can still save the link.
+    # The page's head was usually fetched while yt-dlp was busy (see metadata.prefetch).
     if not data['title'] or data['title'] == "Instagram Reel" or not data['video_path']:
-        print("⚠️ Falling back to HTML scraping (Metadata Only)...")
-        try:
-            # Requests Headers
-            headers = {
-                'User-Agent': get_random_user_agent(),
-                'Accept-Language': 'en-US,en;q=0.9',
-                'Referer': 'https://www.google.com/'
-            }
-            response = requests.get(url, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
-                # Strategy 1: OpenGraph (OG) Tags - The most reliable source
-                og_title = soup.find("meta", property="og:title")
-                og_desc = soup.find("meta", property="og:description")
-                og_image = soup.find("meta", property="og:image")
-                
-                if og_title: data['title'] = og_title.get("content", "")
-                if og_desc: data['description'] = og_desc.get("content", "")
-                if og_image: data['image'] = og_image.get("content", "")
-                
-                # Strategy 2: Clean up the title if it's junk
-                if "instagram" in data['title'].lower():
-                    # Sometimes the description in OG tags is actually the caption
-                    if data['description']:
-                        # Use first 50 chars of description as title if title is generic
-                        data['title'] = (data['description'][:50] + '...') if len(data['description']) > 50 else data['description']
-                    elif soup.title:
-                        data['title'] = soup.title.string.replace("Instagram", "").strip()
+        print("⚠️ Falling back to page metadata...")
+        with metrics.timer("fallback_scrape"):
+            try: page = (meta or metadata.prefetch(url)).result(timeout=METADATA_TIMEOUT * 2)
+            except Exception as e:
+                print(f"❌ Fallback Error: {e}")
+                page = {}
+            if page.get('title'): data['title'] = page['title']
+            if page.get('description'): data['description'] = page['description']
+            if page.get('image'): data['image'] = page['image']
 
-        except Exception as e:
-            print(f"❌ Fallback Error: {e}")
-            
     if not data['title']:
         data['title'] = "Saved Link (Restricted)"
 
-    return data
\ No newline at end of file
+    return data
+
+def fingerprint_video(path):
+    """SHA-256 of the downloaded file, used to recognise the same video posted under another URL."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""): digest.update(chunk)
+    return digest.hexdigest()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import socket
 
 # 1. Try loading from local file (Dev)
 try:
@@ -20,4 +21,174 @@ if not TELEGRAM_BOT_TOKEN or not GEMINI_API_KEY:
     raise ValueError("CRITICAL: API Keys missing.")
 
 if not DATABASE_URL:
-    raise ValueError("CRITICAL: DATABASE_URL is missing. Set it in config.py or Environment Variables.")
\ No newline at end of file
+    raise ValueError("CRITICAL: DATABASE_URL is missing. Set it in config.py or Environment Variables.")
+
+# --- INGEST QUEUE ---
+# Number of concurrent workers per pipeline stage (download -> analyze -> finalize).
+# Scale out by running extra `python worker.py` processes on this or other nodes.
+INGEST_DOWNLOAD_WORKERS = int(os.getenv("INGEST_DOWNLOAD_WORKERS", "2"))
+INGEST_ANALYZE_WORKERS = int(os.getenv("INGEST_ANALYZE_WORKERS", "2"))
+INGEST_FINALIZE_WORKERS = int(os.getenv("INGEST_FINALIZE_WORKERS", "4"))
+# Links from one multi-link message processed at the same time (soft bound, checked at claim time)
+MESSAGE_MAX_CONCURRENCY = int(os.getenv("MESSAGE_MAX_CONCURRENCY", "3"))
+# Users take turns for workers; a bulk-imported link costs this many turns (interactive links 1)
+FAIR_IMPORT_COST = int(os.getenv("FAIR_IMPORT_COST", "3"))
+# Runnable jobs per user ranked at each claim (their oldest ones); more than one so concurrent
+# claims can skip past jobs another worker is locking
+FAIR_CLAIM_CANDIDATES = int(os.getenv("FAIR_CLAIM_CANDIDATES", "4"))
+# Threads for the workers' blocking calls (yt-dlp, ffmpeg, geocoding, embeddings). Kept apart from
+# the default pool so Ask Nexus queries never wait behind a batch of downloads.
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", "8"))
+# Finalize workers' saves are group-committed: one transaction per batch or time window
+FINALIZE_BATCH_SIZE = int(os.getenv("FINALIZE_BATCH_SIZE", "50"))
+FINALIZE_BATCH_WINDOW = float(os.getenv("FINALIZE_BATCH_WINDOW", "0.2"))
+# Run the workers inside bot.py as well (single-container deployments like Render free tier)
+EMBEDDED_WORKERS = os.getenv("EMBEDDED_WORKERS", "1") == "1"
+# Downloaded videos live on local disk, so the analyze stage is pinned to the node that downloaded
+NODE_NAME = os.getenv("NODE_NAME") or socket.gethostname()
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+# Renewed every third of it while a job runs; a worker that stops renewing is presumed dead
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Attempts restart at every stage hand-over; this cap counts claims over the job's whole life
+# (e.g. analyze sending a job whose file vanished back to download, again and again)
+JOB_MAX_TOTAL_ATTEMPTS = int(os.getenv("JOB_MAX_TOTAL_ATTEMPTS", "10"))
+# Every worker process reports its node this often; a node silent for NODE_DEAD_AFTER seconds
+# (e.g. a container replaced on redeploy, which gets a new hostname) loses its pinned jobs
+NODE_HEARTBEAT_INTERVAL = int(os.getenv("NODE_HEARTBEAT_INTERVAL", "30"))
+NODE_DEAD_AFTER = int(os.getenv("NODE_DEAD_AFTER", "120"))
+
+# --- DATABASE POOL ---
+# Shared by the bot/workers (async pool) and the viewer (sync pool)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Executions before a query becomes a server-side prepared statement. Off by default: transaction
+# poolers (Supabase on port 6543, PgBouncer) don't keep them between transactions. With a direct
+# connection (e.g. port 5432), set it to a number such as 0 (prepare at once) or 5.
+_prepare = os.getenv("DB_PREPARE_THRESHOLD", "none").lower()
+DB_PREPARE_THRESHOLD = None if _prepare in ("none", "") else int(_prepare)
+# Hosted Postgres needs TLS; a local database (e.g. for benchmark.py) may not offer it
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+
+# --- SEMANTIC SEARCH ---
+# Small CPU embedding model (384 dims). Pre-downloaded into EMBEDDING_CACHE_DIR by the Dockerfile.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "models")
+# Memory for the per-user vector matrices held at once (~1.5 KB per saved link), least recently used evicted
+EMBEDDING_INDEX_MB = int(os.getenv("EMBEDDING_INDEX_MB", "512"))
+# New rows are appended to a cached index by id; this many ids below its newest one are re-read
+# too, for saves that committed after a higher id did (concurrent batches)
+EMBEDDING_INDEX_OVERLAP = int(os.getenv("EMBEDDING_INDEX_OVERLAP", "1000"))
+# Updated / deleted link ids are logged for cached indexes to patch; an index older than this is rebuilt
+EMBEDDING_REWRITE_LOG_HOURS = int(os.getenv("EMBEDDING_REWRITE_LOG_HOURS", "72"))
+
+# --- VIEWER ---
+VIEWER_PAGE_SIZE = int(os.getenv("VIEWER_PAGE_SIZE", "20"))
+# A dashboard search shows this many best matches, ranked by relevance (no Load more)
+VIEWER_SEARCH_LIMIT = int(os.getenv("VIEWER_SEARCH_LIMIT", "100"))
+# Per-user cache of categories and pages (per viewer process), valid for one library version
+VIEWER_CACHE_USERS = int(os.getenv("VIEWER_CACHE_USERS", "200"))
+VIEWER_CACHE_TTL = int(os.getenv("VIEWER_CACHE_TTL", "600"))
+# Seconds between checks for new saves from the bot (refresh always checks)
+VIEWER_VERSION_CHECK = int(os.getenv("VIEWER_VERSION_CHECK", "30"))
+# Map tab: grid cells per 256px map tile used for clustering, and max clusters per viewport
+MAP_CELLS_PER_TILE = int(os.getenv("MAP_CELLS_PER_TILE", "4"))
+MAP_MAX_CLUSTERS = int(os.getenv("MAP_MAX_CLUSTERS", "500"))
+
+# --- THUMBNAILS ---
+# Local disk cache of the WebP covers stored in Postgres
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", "thumbnails")
+THUMBNAIL_CACHE_MB = int(os.getenv("THUMBNAIL_CACHE_MB", "200"))
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "480"))
+# Stored covers no link uses any more are deleted once they are this old (a cover is stored
+# at download time, its link only at finalize)
+THUMBNAIL_GC_GRACE_HOURS = int(os.getenv("THUMBNAIL_GC_GRACE_HOURS", "24"))
+
+# --- GEOCODING ---
+GEOCODE_TTL_DAYS = int(os.getenv("GEOCODE_TTL_DAYS", "90"))
+# "Not found" answers are cached too, but retried sooner
+GEOCODE_NEGATIVE_TTL_DAYS = int(os.getenv("GEOCODE_NEGATIVE_TTL_DAYS", "3"))
+
+# --- VIDEO REDUCTION (before upload to Gemini) ---
+# transcode | keyframes | audio | off  (see media.py)
+VIDEO_REDUCTION_MODE = os.getenv("VIDEO_REDUCTION_MODE", "keyframes")
+VIDEO_MAX_HEIGHT = int(os.getenv("VIDEO_MAX_HEIGHT", "480"))
+# Files smaller than this are uploaded as-is
+VIDEO_REDUCTION_MIN_MB = float(os.getenv("VIDEO_REDUCTION_MIN_MB", "2"))
+
+# --- DOWNLOADS ---
+# Scratch root for per-job download directories; empty = /dev/shm if it can hold the budget, else the temp dir
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "")
+# Max bytes of downloads on disk at once (per node), and per file
+DOWNLOAD_BUDGET_MB = int(os.getenv("DOWNLOAD_BUDGET_MB", "400"))
+DOWNLOAD_MAX_FILE_MB = int(os.getenv("DOWNLOAD_MAX_FILE_MB", "50"))
+DOWNLOAD_MAX_CONCURRENT = int(os.getenv("DOWNLOAD_MAX_CONCURRENT", "3"))
+# yt-dlp fragments (DASH/HLS) fetched in parallel per download
+DOWNLOAD_FRAGMENT_CONCURRENCY = int(os.getenv("DOWNLOAD_FRAGMENT_CONCURRENCY", "4"))
+# Seconds a download waits for budget before the job is retried later
+DOWNLOAD_BUDGET_WAIT = int(os.getenv("DOWNLOAD_BUDGET_WAIT", "300"))
+# A job that got no slot or space goes back to the queue for this many seconds (no attempt spent)
+DOWNLOAD_BUSY_RETRY_DELAY = int(os.getenv("DOWNLOAD_BUSY_RETRY_DELAY", "60"))
+# Job directories older than this are treated as leaked by the janitor
+DOWNLOAD_MAX_AGE_MINUTES = int(os.getenv("DOWNLOAD_MAX_AGE_MINUTES", "120"))
+
+# --- GEMINI FILES ---
+GEMINI_MAX_CONCURRENT_UPLOADS = int(os.getenv("GEMINI_MAX_CONCURRENT_UPLOADS", "4"))
+GEMINI_PROCESSING_TIMEOUT = int(os.getenv("GEMINI_PROCESSING_TIMEOUT", "300"))
+# Uploads older than this are treated as leaked and deleted by the sweeper
+GEMINI_FILE_MAX_AGE_MINUTES = int(os.getenv("GEMINI_FILE_MAX_AGE_MINUTES", "60"))
+
+# --- AI MODELS ---
+# In order of preference; ai_engine fails over down the list and back
+GEMINI_MODELS = [m.strip() for m in os.getenv("GEMINI_MODELS", "gemini-2.0-flash,gemini-2.5-flash-lite").split(",") if m.strip()]
+MODEL_HEALTH_INTERVAL = int(os.getenv("MODEL_HEALTH_INTERVAL", "600"))
+
+# --- GEMINI QUOTA ---
+# Per-model requests/tokens per minute, e.g. "gemini-2.0-flash=15/1000000,gemini-2.5-flash-lite=15/250000".
+# Models not listed use GEMINI_RPM / GEMINI_TPM.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_QUOTAS = {
+    name.strip(): tuple(int(n) for n in limits.split("/"))
+    for name, limits in (item.split("=") for item in os.getenv("GEMINI_QUOTAS", "").split(",") if "=" in item)
+}
+# Quotas are per API key: with N processes sharing a key, give each 1/N
+GEMINI_QUOTA_SHARE = float(os.getenv("GEMINI_QUOTA_SHARE", "1.0"))
+# Token estimate for one video analysis before the real count is known (~30 s of video)
+GEMINI_VIDEO_TOKENS = int(os.getenv("GEMINI_VIDEO_TOKENS", "8000"))
+# After a 429, no calls to that model for this many seconds
+GEMINI_RATE_LIMIT_PAUSE = int(os.getenv("GEMINI_RATE_LIMIT_PAUSE", "30"))
+
+# --- RAG REPLIES ---
+# Minimum seconds between edits of a streaming answer (Telegram rate-limits message edits)
+RAG_EDIT_INTERVAL = float(os.getenv("RAG_EDIT_INTERVAL", "1.0"))
+# Answers cached per (user, question, library version); a new save makes old entries unreachable
+RAG_CACHE_SIZE = int(os.getenv("RAG_CACHE_SIZE", "1000"))
+RAG_CACHE_TTL = int(os.getenv("RAG_CACHE_TTL", "21600"))
+
+# --- BULK IMPORT ---
+IMPORT_MAX_LINKS = int(os.getenv("IMPORT_MAX_LINKS", "5000"))
+# Seconds between progress updates of a running import
+IMPORT_PROGRESS_INTERVAL = int(os.getenv("IMPORT_PROGRESS_INTERVAL", "60"))
+
+# --- METRICS ---
+# Standalone workers (python worker.py) serve /metrics on this port; 0 = off.
+# The bot serves /metrics on PORT next to its health check.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# --- WEBHOOK ---
+# Public base URL of the bot (e.g. https://nexus-bot.onrender.com). When set, Telegram pushes
+# updates to <url>/telegram on PORT instead of the bot polling; empty = polling.
+# Render sets RENDER_EXTERNAL_URL itself, so WEBHOOK_MODE=1 is enough there.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or (os.getenv("RENDER_EXTERNAL_URL", "") if os.getenv("WEBHOOK_MODE") == "1" else "")
+# Telegram sends this back in a header on every update; derived from the bot token if unset,
+# so all replicas agree without extra config
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# --- PAGE METADATA ---
+# Title / cover / caption read from the page's <head> while the video downloads
+METADATA_TIMEOUT = float(os.getenv("METADATA_TIMEOUT", "4"))
+# Stop reading a page after this much even if </head> never came
+METADATA_MAX_HEAD_KB = int(os.getenv("METADATA_MAX_HEAD_KB", "512"))
+METADATA_THREADS = int(os.getenv("METADATA_THREADS", "4"))
@@ -0,0 +1,42 @@
+import os
+import re
+import subprocess
+import sys
+
+# Startup-time report: where does `import bot` spend its time?
+# Usage: python startup_report.py [module] [top_n]
+# Runs the import in a fresh interpreter with `-X importtime` and sums the cost per top-level package.
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else "bot"
+    top_n = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+    # settings.py refuses to import without these; the values are never used for network calls here
+    env = dict(os.environ)
+    for key in ("TELEGRAM_BOT_TOKEN", "GEMINI_API_KEY", "DATABASE_URL"):
+        env.setdefault(key, "startup-report")
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=env)
+
+    packages, total = {}, 0
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)', line)
+        if not match: continue
+        self_us, name = int(match.group(1)), match.group(4)
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+        total += self_us
+
+    if not packages:
+        print(result.stderr or "No import timings captured.")
+        return
+
+    print(f"⏱️ import {module}: {total / 1000:.0f} ms total")
+    for package, us in sorted(packages.items(), key=lambda kv: kv[1], reverse=True)[:top_n]:
+        print(f"  {us / 1000:8.1f} ms  {us * 100 / total:5.1f}%  {package}")
+    if result.returncode != 0:
+        print(f"⚠️ import {module} failed:\n{result.stderr.splitlines()[-1]}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+import ai_engine
+
+class NotFound(Exception):
+    """Named like the google.api_core error that triggers a failover."""
+
+def test_failover_does_not_wait_for_a_running_probe(monkeypatch):
+    probing, release = threading.Event(), threading.Event()
+    current = object()
+
+    def slow_probe(model_name):
+        probing.set()
+        release.wait(5)
+        return f"model:{model_name}"
+
+    monkeypatch.setattr(ai_engine, "probe_model", slow_probe)
+    monkeypatch.setattr(ai_engine, "_model", None)
+    monkeypatch.setattr(ai_engine, "_model_name", None)
+    monkeypatch.setattr(ai_engine, "_unhealthy", {})
+    selecting = threading.Thread(target=ai_engine.get_model)
+    selecting.start()
+    try:
+        assert probing.wait(5)
+        started = time.monotonic()
+        ai_engine.report_failure(current, NotFound("gone")) # What the event loop does on an error
+        assert time.monotonic() - started < 0.5
+    finally:
+        release.set()
+        selecting.join(5)
+    assert ai_engine._model == f"model:{ai_engine.GEMINI_MODELS[0]}"
+
+def test_failure_drops_the_current_model(monkeypatch):
+    monkeypatch.setattr(ai_engine, "_model", "current")
+    monkeypatch.setattr(ai_engine, "_model_name", "gemini-x")
+    monkeypatch.setattr(ai_engine, "_unhealthy", {})
+    ai_engine.report_failure("current", NotFound("gone"))
+    assert ai_engine._model is None and "gemini-x" in ai_engine._unhealthy
+
+    # Errors that say nothing about the model (e.g. a blocked prompt) keep it
+    monkeypatch.setattr(ai_engine, "_model", "current")
+    ai_engine.report_failure("current", ValueError("blocked"))
+    assert ai_engine._model == "current"
+
+class Chunk:
+    def __init__(self, text): self.text = text
+
+class StreamingModel:
+    model_name = "models/test-model"
+
+    def __init__(self, texts, error=None): self.texts, self.error = texts, error
+
+    async def generate_content_async(self, prompt, stream=False):
+        async def chunks():
+            for text in self.texts: yield Chunk(text)
+            if self.error: raise self.error
+        return chunks()
+
+def answer_with(monkeypatch, model):
+    monkeypatch.setattr(ai_engine, "get_model", lambda: model)
+    monkeypatch.setattr(ai_engine, "report_failure", lambda model, error: None)
+    answer = ai_engine.stream_rag_answer("pasta?", "Database Results: ...")
+    async def collect(): return [piece async for piece in answer]
+    return asyncio.run(collect()), answer.complete
+
+def test_a_whole_answer_is_complete(monkeypatch):
+    pieces, complete = answer_with(monkeypatch, StreamingModel(["Carbonara ", "and cacio e pepe."]))
+    assert "".join(pieces) == "Carbonara and cacio e pepe." and complete
+
+def test_failed_empty_or_cut_short_answers_are_not_complete(monkeypatch):
+    pieces, complete = answer_with(monkeypatch, StreamingModel(["Carbonara "], error=RuntimeError("reset")))
+    assert pieces[-1].endswith("Answer cut short.") and not complete
+    pieces, complete = answer_with(monkeypatch, StreamingModel([]))
+    assert pieces == ["⚠️ Error generating answer."] and not complete
+    pieces, complete = answer_with(monkeypatch, None)
+    assert pieces == ["⚠️ AI Offline."] and not complete
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import json
+import pytest
+import backfill
+import database
+
+class Links:
+    """fetch_backfill_batch / update_links_batch over a list of link ids."""
+
+    def __init__(self, monkeypatch, ids):
+        self.ids, self.updated = ids, []
+        monkeypatch.setattr(database, "fetch_backfill_batch", self.fetch_backfill_batch)
+        monkeypatch.setattr(database, "update_links_batch", self.update_links_batch)
+        async def close(): pass
+        monkeypatch.setattr(database, "close_async_pool", close)
+
+    async def fetch_backfill_batch(self, filters, after_id, limit):
+        ids = [i for i in self.ids if i > after_id and (not filters.get('ids') or i in filters['ids'])]
+        return [{'id': i} for i in ids[:limit]]
+
+    async def update_links_batch(self, updates):
+        self.updated += [link_id for link_id, _ in updates]
+
+def args_for(checkpoint, task="embedding"):
+    return argparse.Namespace(
+        task=[task], user=None, category=None, since=None, until=None, missing_coords=False,
+        missing_thumbnail=False, refresh_geocode=False, workers=2, rate=0, batch_size=2, limit=0,
+        checkpoint=str(checkpoint) if checkpoint else None, dry_run=False,
+    )
+
+def test_failed_links_stay_in_the_checkpoint_and_are_retried(monkeypatch, tmp_path):
+    checkpoint = tmp_path / "embed.json"
+    links = Links(monkeypatch, [1, 2, 3, 4, 5])
+    failing = {2, 4}
+    async def process(row, args):
+        if row['id'] in failing: raise RuntimeError("Gemini said no")
+        return {'embedding': b"v"}
+    monkeypatch.setattr(backfill, "process", process)
+
+    asyncio.run(backfill.run(args_for(checkpoint)))
+    saved = json.loads(checkpoint.read_text())
+    assert links.updated == [1, 3, 5]
+    assert saved['last_id'] == 5 and saved['failed_ids'] == [2, 4]
+
+    # Next run: only 4 still fails
+    failing.discard(2)
+    links.updated.clear()
+    asyncio.run(backfill.run(args_for(checkpoint)))
+    saved = json.loads(checkpoint.read_text())
+    assert links.updated == [2]
+    assert saved['last_id'] == 5 and saved['failed_ids'] == [4]
+
+def test_legacy_cover_is_captured_from_the_page_once_its_cdn_link_expired(monkeypatch):
+    stored = {}
+    async def save_thumbnail(key, data): stored[key] = data
+    monkeypatch.setattr(database, "save_thumbnail", save_thumbnail)
+    live = {"https://cdn/new.jpg"}
+    monkeypatch.setattr(backfill.thumbnails, "capture_thumbnail",
+                        lambda url: (f"key-of-{url}", b"webp") if url in live else (None, None))
+    monkeypatch.setattr(backfill.metadata, "fetch_metadata",
+                        lambda url: {'title': "", 'description': "", 'image': "https://cdn/new.jpg"})
+
+    args = args_for(None, task="thumbnail")
+    row = {'id': 1, 'url': "https://www.instagram.com/p/X/", 'image_url': "https://cdn/old.jpg", 'thumbnail_key': None,
+           'location_str': None}
+    fields = asyncio.run(backfill.process(row, args))
+    assert fields == {'thumbnail_key': "key-of-https://cdn/new.jpg", 'image_url': "https://cdn/new.jpg"}
+    assert list(stored) == [fields['thumbnail_key']]
+
+    # Links that already have a cover are left alone; no cover anywhere is a failure to retry
+    assert asyncio.run(backfill.process({**row, 'thumbnail_key': "k"}, args)) == {}
+    live.clear()
+    with pytest.raises(RuntimeError):
+        asyncio.run(backfill.process(row, args))
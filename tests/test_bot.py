@@ -0,0 +1,38 @@
+import asyncio
+from types import SimpleNamespace
+import bot
+from bot import split_message, normalize_query
+
+def test_short_text_is_one_part():
+    assert split_message("hello", limit=10) == ["hello"]
+
+def test_splits_at_line_breaks_within_the_limit():
+    text = "first line\nsecond line\nthird"
+    parts = split_message(text, limit=15)
+    assert parts == ["first line", "second line", "third"]
+    assert all(len(part) <= 15 for part in parts)
+
+def test_falls_back_to_spaces_then_a_hard_cut():
+    assert split_message("aaaa bbbb cccc", limit=10) == ["aaaa bbbb", "cccc"]
+    assert split_message("x" * 25, limit=10) == ["x" * 10, "x" * 10, "x" * 5]
+
+def test_nothing_is_lost_but_whitespace_at_the_cuts():
+    text = "word " * 2000
+    parts = split_message(text, limit=4096)
+    assert all(len(part) <= 4096 for part in parts)
+    assert "".join(parts).replace(" ", "") == text.replace(" ", "")
+
+def test_normalize_query():
+    assert normalize_query("  Pasta   RECIPES?? ") == "pasta recipes"
+
+def test_import_reports_a_failed_download(monkeypatch):
+    edits = []
+    async def send_message(chat_id, text): return SimpleNamespace(message_id=10)
+    async def edit_message_text(chat_id, message_id, text): edits.append(text)
+    async def get_file(): raise TimeoutError("Timed out")
+    document = SimpleNamespace(file_size=100, file_name="saved_posts.json", get_file=get_file)
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=7), effective_user=SimpleNamespace(id=7),
+                             message=SimpleNamespace(document=document, caption="/import"))
+    context = SimpleNamespace(user_data={}, bot=SimpleNamespace(send_message=send_message, edit_message_text=edit_message_text))
+    asyncio.run(bot.handle_document(update, context))
+    assert edits == ["❌ Could not download that file: Timed out"]
@@ -0,0 +1,139 @@
+import asyncio
+import pytest
+import database
+
+# --- QUERY BUILDERS ---
+
+def test_first_page_has_no_keyset_condition():
+    sql, params = database.build_page_query(7, limit=20)
+    assert "id < %(before_id)s" not in sql and "category" not in sql.split("WHERE")[1]
+    assert "ORDER BY id DESC" in sql
+    assert params['user_id'] == 7 and params['limit'] == 20
+
+def test_next_page_continues_below_the_last_id():
+    sql, params = database.build_page_query(7, category="Travel", before_id=120, limit=20)
+    assert "id < %(before_id)s" in sql and "category = %(category)s" in sql
+    assert params['before_id'] == 120 and params['category'] == "Travel"
+
+def test_search_query_modes():
+    sql, params = database.build_search_query(7, "sushi place", match_any=True)
+    assert "plainto_tsquery" in sql and "'&', '|'" in sql
+    assert params['q'] == "sushi place"
+    sql, _ = database.build_search_query(7, "sushi place")
+    assert "websearch_to_tsquery" in sql
+
+def test_prefix_search_only_passes_words_to_tsquery():
+    sql, params = database.build_search_query(7, "sush pl:*!&", prefix=True)
+    assert "to_tsquery('english', %(q)s)" in sql
+    assert params['q'] == "sush:* & pl:*"
+    assert database.prefix_terms("  !! ") is None
+
+def test_map_query_across_the_antimeridian():
+    sql, _ = database.build_map_query(7, -10, 170, 10, -170, 1.0)
+    assert "(lon >= %(west)s OR lon <= %(east)s)" in sql
+    sql, _ = database.build_map_query(7, -10, 10, 10, 20, 1.0)
+    assert "lon BETWEEN %(west)s AND %(east)s" in sql
+
+# --- JOB QUEUE: LEASES AND ATTEMPTS ---
+
+def test_claim_counts_an_attempt_in_the_stage_and_over_the_jobs_life(fake_db):
+    asyncio.run(database.claim_job("download", "w1", "node-a"))
+    claim = fake_db.statements("UPDATE jobs")[0]
+    assert "attempts = attempts + 1" in claim and "total_attempts = total_attempts + 1" in claim
+    assert "locked_by = %(worker_id)s" in claim
+    # Expired leases are claimable again
+    assert "locked_at < now() - make_interval(secs => %(lease)s)" in claim
+
+def test_claim_ranks_only_each_users_head_of_the_queue(fake_db):
+    asyncio.run(database.claim_job("download", "w1", "node-a"))
+    sql, params = fake_db.executed[-1]
+    assert "WITH RECURSIVE waiting" in sql and "CROSS JOIN LATERAL" in sql
+    assert "LIMIT %(per_user)s" in sql and params['per_user'] == database.FAIR_CLAIM_CANDIDATES
+
+def test_advance_only_applies_under_the_workers_lease(fake_db):
+    fake_db.respond = lambda sql, params: ([], 1)
+    asyncio.run(database.advance_job(1, "w1", "analyze", {'data': {}}, "node-a"))
+    sql, params = fake_db.executed[-1]
+    assert "status = 'running' AND locked_by = %s" in sql and params[-1] == "w1"
+    assert "attempts = 0" in sql # A new stage gets its own attempts
+
+    fake_db.respond = lambda sql, params: ([], 0)
+    with pytest.raises(database.LeaseLost):
+        asyncio.run(database.advance_job(1, "w1", "finalize", {}))
+    with pytest.raises(database.LeaseLost):
+        asyncio.run(database.renew_lease(1, "w1"))
+
+def test_fail_job_reports_whether_the_failure_is_final(fake_db):
+    fake_db.respond = lambda sql, params: ([('queued',)], None)
+    assert asyncio.run(database.fail_job(1, "w1", RuntimeError("boom"))) is False
+    fake_db.respond = lambda sql, params: ([('failed',)], None)
+    assert asyncio.run(database.fail_job(1, "w1", RuntimeError("boom"))) is True
+    # Not ours any more: nothing updated, nothing final
+    fake_db.respond = lambda sql, params: ([], 0)
+    assert asyncio.run(database.fail_job(1, "w1", RuntimeError("boom"))) is False
+
+    sql, params = fake_db.executed[-1]
+    assert "attempts >= %s OR total_attempts >= %s" in sql
+    assert params[:2] == (database.JOB_MAX_ATTEMPTS, database.JOB_MAX_TOTAL_ATTEMPTS)
+
+def test_deferred_job_gives_its_attempt_back_and_waits(fake_db):
+    fake_db.respond = lambda sql, params: ([], 1)
+    asyncio.run(database.defer_job(1, "w1", 60, "busy"))
+    sql, params = fake_db.executed[-1]
+    assert "attempts = greatest(attempts - 1, 0)" in sql and "total_attempts = greatest(total_attempts - 1, 0)" in sql
+    assert "not_before = now() + make_interval(secs => %s)" in sql and params[0] == 60
+    assert "locked_by = %s" in sql and params[-1] == "w1"
+
+    asyncio.run(database.claim_job("download", "w1", "node-a"))
+    assert "j.not_before IS NULL OR j.not_before <= now()" in fake_db.executed[-1][0]
+
+    fake_db.respond = lambda sql, params: ([], 0)
+    with pytest.raises(database.LeaseLost):
+        asyncio.run(database.defer_job(1, "w1", 60, "busy"))
+
+# --- FAIR CLAIMS (real Postgres) ---
+
+def queue_links(user_id, count, quiet):
+    links = [(f"https://example.com/{user_id}/{n}", f"https://example.com/{user_id}/{n}") for n in range(count)]
+    return asyncio.run(database.enqueue_jobs(user_id, user_id, links, quiet=quiet))
+
+def claims(count, done=False):
+    """Users whose jobs the next `count` claims take; done=True finishes each job before the next claim."""
+    async def claim_all():
+        users = []
+        for n in range(count):
+            job = await database.claim_job("download", f"w{n}", "node-a")
+            users.append(job['user_id'] if job else None)
+            if job and done:
+                pool = await database.get_async_pool()
+                async with pool.connection() as conn:
+                    await conn.execute("UPDATE jobs SET status = 'done' WHERE id = %s", (job['id'],))
+        return users
+    return asyncio.run(claim_all())
+
+def test_users_take_turns_while_their_jobs_run(pg_db):
+    queue_links(1, 100, quiet=False) # Queued first: every one of them is older
+    queue_links(2, 10, quiet=False)
+    assert claims(8) == [1, 2, 1, 2, 1, 2, 1, 2]
+
+def test_bulk_import_does_not_starve_an_interactive_user(pg_db):
+    imported = queue_links(1, 100, quiet=True)
+    assert claims(5) == [1] * 5 # Nobody else is waiting
+    queue_links(2, 3, quiet=False)
+    # Five imports running rank the importer's next at (5 + 1) * FAIR_IMPORT_COST
+    assert claims(3) == [2, 2, 2]
+    assert claims(1) == [1]
+    # The importer's jobs still run oldest first
+    running = pg_db("SELECT id FROM jobs WHERE user_id = 1 AND status = 'running' ORDER BY id")
+    assert [row[0] for row in running] == imported[:6]
+
+def test_imports_take_turns_weighted_by_their_cost(pg_db, monkeypatch):
+    monkeypatch.setattr(database, "FAIR_IMPORT_COST", 3)
+    queue_links(1, 100, quiet=True)
+    queue_links(2, 100, quiet=False)
+    # Nothing stays running: the interactive user's head always ranks 1, the importer's 3
+    assert claims(4, done=True) == [2, 2, 2, 2]
+    # Held running, the interactive user's turns grow past the importer's: 1, 2 < 3, then ties
+    # go to the older job
+    pg_db("UPDATE jobs SET status = 'queued' WHERE status = 'done'")
+    assert claims(4) == [2, 2, 1, 2]
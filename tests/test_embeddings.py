@@ -0,0 +1,74 @@
+import asyncio
+import numpy as np
+import database
+import embeddings
+
+def vector(*values):
+    return np.asarray(values, dtype=np.float32).tobytes()
+
+class Library:
+    """One user's links as the database would return them, plus their rewrite log."""
+
+    def __init__(self, monkeypatch, rows, log=None):
+        self.rows, self.log, self.reads = dict(rows), dict(log or {}), []
+        monkeypatch.setattr(database, "fetch_embeddings", self.fetch_embeddings)
+        monkeypatch.setattr(database, "fetch_rewritten_ids", self.fetch_rewritten_ids)
+
+    async def fetch_embeddings(self, user_id, after_id=0, ids=None):
+        self.reads.append("ids" if ids is not None else after_id)
+        return [(i, v) for i, v in sorted(self.rows.items()) if (i in ids if ids is not None else i > after_id)]
+
+    async def fetch_rewritten_ids(self, user_id, after, upto):
+        return {r: ids for r, ids in self.log.items() if after < r <= upto}
+
+def refresh(index, version, rewrites):
+    return asyncio.run(embeddings.refresh_index(7, index, version, rewrites))
+
+def test_new_saves_are_appended(monkeypatch):
+    library = Library(monkeypatch, {1: vector(1, 0), 2: vector(0, 1)})
+    index, how = refresh(None, 1, 0)
+    assert how == "rebuild" and index.ids.tolist() == [1, 2]
+
+    library.rows[3] = vector(1, 1)
+    index, how = refresh(index, 2, 0)
+    assert how == "append" and index.ids.tolist() == [1, 2, 3]
+    assert refresh(index, 2, 0) == (index, "hit")
+
+def test_updates_and_deletes_are_patched_by_id(monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBEDDING_INDEX_OVERLAP", 2)
+    rows = {i: vector(1, 0) for i in range(1, 11)}
+    library = Library(monkeypatch, rows)
+    index, _ = refresh(None, 1, 0)
+
+    # Rewrite 1 re-embedded link 4, rewrite 2 deleted link 6
+    library.rows[4] = vector(0, 1)
+    del library.rows[6]
+    library.log = {1: [4], 2: [6]}
+    library.reads.clear()
+    patched, how = refresh(index, 3, 2)
+    assert how == "patch" and library.reads == ["ids", 8] # Never re-read the whole library
+    assert sorted(patched.ids.tolist()) == [1, 2, 3, 4, 5, 7, 8, 9, 10]
+    assert patched.top_k(np.asarray([0, 1], dtype=np.float32), 1) == [4]
+    assert index.ids.tolist() == list(range(1, 11)) # The shared old index is left alone
+
+def test_rebuilds_when_the_log_was_pruned(monkeypatch):
+    library = Library(monkeypatch, {i: vector(1, 0) for i in range(1, 11)})
+    index, _ = refresh(None, 1, 0)
+    library.log = {2: [3]} # Rewrite 1 is no longer logged
+    _, how = refresh(index, 3, 2)
+    assert how == "rebuild"
+
+def test_cache_is_bounded_by_bytes(monkeypatch):
+    monkeypatch.setattr(embeddings, "_indexes", embeddings.OrderedDict())
+    monkeypatch.setattr(embeddings, "_indexes_bytes", 0)
+    monkeypatch.setattr(embeddings, "EMBEDDING_INDEX_MB", 1)
+    dims = 384
+    big = [(i, np.zeros(dims, dtype=np.float32).tobytes()) for i in range(300)] # ~0.46 MB each
+    for user_id in (1, 2, 3):
+        embeddings._store_index(user_id, embeddings.UserIndex(1, 0, big))
+    assert list(embeddings._indexes) == [2, 3]
+    assert embeddings._indexes_bytes == sum(index.nbytes for index in embeddings._indexes.values())
+
+    huge = [(i, np.zeros(dims, dtype=np.float32).tobytes()) for i in range(1000)]
+    embeddings._store_index(4, embeddings.UserIndex(1, 0, huge))
+    assert list(embeddings._indexes) == [4] # Over the cap alone, but the newest always stays
@@ -0,0 +1,43 @@
+import io
+import json
+import zipfile
+
+from importer import extract_urls
+
+def make_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, text in files.items(): archive.writestr(name, text)
+    return buffer.getvalue()
+
+def test_plain_list_keeps_every_link_once_in_order():
+    data = b"https://example.com/a\nhttps://www.instagram.com/reel/X1/, https://example.com/a\n"
+    assert extract_urls("links.txt", data) == ["https://example.com/a", "https://www.instagram.com/reel/X1/"]
+
+def test_json_export_only_keeps_post_links():
+    export = json.dumps({"saved_saved_media": [
+        {"href": "https://www.instagram.com/reel/ABC/"},
+        {"href": "https://www.instagram.com/some.profile/"},
+        {"href": "https://www.tiktokv.com/share/video/7312345678901234567/"},
+        {"href": "https://help.instagram.com/privacy"},
+    ]})
+    assert extract_urls("saved_posts.json", export.encode()) == [
+        "https://www.instagram.com/reel/ABC/", "https://www.tiktokv.com/share/video/7312345678901234567/",
+    ]
+
+def test_escaped_slashes_in_json():
+    data = b'{"link": "https:\\/\\/www.instagram.com\\/p\\/XYZ\\/"}'
+    assert extract_urls("posts.json", data) == ["https://www.instagram.com/p/XYZ/"]
+
+def test_zip_reads_export_members_and_skips_the_rest():
+    data = make_zip({
+        "your_instagram_activity/saved/saved_posts.html": '<a href="https://www.instagram.com/p/P1/">x</a>'
+                                                          '<a href="https://www.instagram.com/explore/">y</a>',
+        "media/photo.jpg": "https://www.instagram.com/p/NOT_READ/",
+        "notes.txt": "https://example.com/listed",
+    })
+    assert extract_urls("export.zip", data) == ["https://www.instagram.com/p/P1/", "https://example.com/listed"]
+
+def test_zip_detected_by_content_without_a_name():
+    data = make_zip({"links.txt": "https://youtu.be/abc"})
+    assert extract_urls(None, data) == ["https://youtu.be/abc"]
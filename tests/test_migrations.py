@@ -0,0 +1,39 @@
+import migrations
+from conftest import FakeDatabase
+
+def test_versions_are_contiguous_and_ascending():
+    versions = [version for version, _, _ in migrations.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+
+def test_applies_only_pending_versions_in_order():
+    applied = {1, 2, 3, 5}
+    db = FakeDatabase(lambda sql, params: ([(v,) for v in applied], None) if "SELECT version" in sql else ([], 0))
+    done = migrations.migrate(db)
+
+    expected = [version for version, _, _ in migrations.MIGRATIONS if version not in applied]
+    assert done == expected
+    recorded = [params[0] for sql, params in db.executed if sql.startswith("INSERT INTO schema_migrations")]
+    assert recorded == expected
+    # The advisory lock is taken before anything else runs
+    assert db.executed[0][0].startswith("SELECT pg_advisory_xact_lock")
+
+def test_statements_of_a_version_run_before_it_is_recorded():
+    db = FakeDatabase()
+    migrations.migrate(db)
+    sqls = [sql for sql, _ in db.executed]
+    for version, _, statements in migrations.MIGRATIONS:
+        record = next(i for i, (sql, params) in enumerate(db.executed)
+                      if sql.startswith("INSERT INTO schema_migrations") and params[0] == version)
+        last = sqls.index(" ".join(statements[-1].split()), 0, record)
+        assert last < record
+
+def test_nothing_to_do_when_up_to_date():
+    versions = [(version,) for version, _, _ in migrations.MIGRATIONS]
+    db = FakeDatabase(lambda sql, params: (versions, None) if "SELECT version" in sql else ([], 0))
+    assert migrations.migrate(db) == []
+
+def test_created_at_is_added_without_stamping_existing_links():
+    _, _, statements = next(migration for migration in migrations.MIGRATIONS if migration[0] == 11)
+    add = next(sql for sql in statements if "ADD COLUMN IF NOT EXISTS created_at" in sql)
+    assert "DEFAULT" not in add # Older links keep NULL; only new rows get now()
+    assert "ALTER COLUMN created_at SET DEFAULT now()" in statements[statements.index(add) + 1]
@@ -0,0 +1,56 @@
+import pytest
+from urls import canonicalize_url, download_url
+
+@pytest.mark.parametrize("url", [
+    "https://www.instagram.com/reel/C1abc_-2/?igsh=xyz",
+    "https://instagram.com/p/C1abc_-2/",
+    "https://m.instagram.com/reels/C1abc_-2",
+    "https://www.instagram.com/tv/C1abc_-2/",
+    "https://www.instagram.com/some.user/reel/C1abc_-2/",
+])
+def test_instagram_post_shapes_share_one_key(url):
+    assert canonicalize_url(url, resolve=False) == "https://www.instagram.com/reel/C1abc_-2/"
+
+def test_instagram_sound_page_is_not_a_post():
+    url = "https://www.instagram.com/reels/audio/123456/?igsh=xyz"
+    assert canonicalize_url(url, resolve=False) == "https://instagram.com/reels/audio/123456"
+
+@pytest.mark.parametrize("url, key", [
+    ("https://www.instagram.com/explore/tags/p/xyz", "https://instagram.com/explore/tags/p/xyz"),
+    ("https://www.instagram.com/explore/tags/tv/", "https://instagram.com/explore/tags/tv"),
+    ("https://www.instagram.com/stories/someone/p/123/", "https://instagram.com/stories/someone/p/123"),
+    ("https://www.instagram.com/reel/ABC/comments/", "https://instagram.com/reel/ABC/comments"),
+    ("https://www.instagram.com/p/", "https://instagram.com/p"),
+    ("https://www.instagram.com/some.user/", "https://instagram.com/some.user"),
+])
+def test_instagram_non_post_paths_never_get_a_post_key(url, key):
+    assert canonicalize_url(url, resolve=False) == key
+
+@pytest.mark.parametrize("url", [
+    "https://www.tiktok.com/@someone/video/7312345678901234567?is_from_webapp=1",
+    "https://m.tiktok.com/video/7312345678901234567",
+])
+def test_tiktok_keyed_on_video_id(url):
+    assert canonicalize_url(url, resolve=False) == "https://www.tiktok.com/video/7312345678901234567"
+
+@pytest.mark.parametrize("url", [
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+    "https://m.youtube.com/watch?v=dQw4w9WgXcQ&feature=share",
+])
+def test_youtube_keyed_on_video_id(url):
+    assert canonicalize_url(url, resolve=False) == "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+def test_generic_urls_drop_tracking_params_and_sort_the_rest():
+    url = "https://Example.com/article/?b=2&utm_source=x&a=1&fbclid=y#top)."
+    assert canonicalize_url(url, resolve=False) == "https://example.com/article?a=1&b=2"
+
+def test_download_url_gives_tiktok_links_a_handle():
+    assert download_url("https://www.tiktok.com/video/123") == "https://www.tiktok.com/@/video/123"
+    assert download_url("https://www.tiktok.com/@me/video/123") == "https://www.tiktok.com/@me/video/123"
+    assert download_url("https://www.instagram.com/reel/abc/") == "https://www.instagram.com/reel/abc/"
+
+def test_tiktok_export_share_links():
+    url = "https://www.tiktokv.com/share/video/7312345678901234567/"
+    assert canonicalize_url(url, resolve=False) == "https://www.tiktok.com/video/7312345678901234567"
+    assert download_url(url) == "https://www.tiktok.com/@/video/7312345678901234567"
@@ -0,0 +1,168 @@
+import asyncio
+from concurrent.futures import Future
+import pytest
+import database
+import worker
+
+def make_job(**fields):
+    job = {
+        'id': 1, 'stage': 'download', 'user_id': 7, 'chat_id': 7, 'status_message_id': None,
+        'url': "https://www.instagram.com/reel/X/", 'canonical_url': "https://www.instagram.com/reel/X/",
+        'payload': {}, 'attempts': 1, 'total_attempts': 1, 'quiet': False, 'progress_message_id': None,
+        'locked_by': "w1",
+    }
+    job.update(fields)
+    return job
+
+class QueueStub:
+    """Hands out the given jobs once, then stops the worker loop; records what the worker reported."""
+
+    def __init__(self, monkeypatch, jobs, final=False):
+        self.jobs, self.final = list(jobs), final
+        self.failed, self.deferred = [], []
+        monkeypatch.setattr(database, "claim_job", self.claim_job)
+        monkeypatch.setattr(database, "fail_job", self.fail_job)
+        monkeypatch.setattr(database, "defer_job", self.defer_job)
+
+    async def claim_job(self, stage, worker_id, node):
+        if not self.jobs: raise asyncio.CancelledError
+        return self.jobs.pop(0)
+
+    async def fail_job(self, job_id, worker_id, error):
+        self.failed.append((job_id, str(error)))
+        return self.final
+
+    async def defer_job(self, job_id, worker_id, delay, reason):
+        self.deferred.append((job_id, delay))
+
+def run_worker(handler):
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(worker.stage_worker("download", handler, None, "w1"))
+
+def test_success_reports_nothing(monkeypatch):
+    queue = QueueStub(monkeypatch, [make_job()])
+    ran = []
+    async def handler(job, bot): ran.append(job['id'])
+    run_worker(handler)
+    assert ran == [1] and queue.failed == []
+
+def test_errors_go_back_to_the_queue(monkeypatch):
+    queue = QueueStub(monkeypatch, [make_job()])
+    async def handler(job, bot): raise RuntimeError("boom")
+    run_worker(handler)
+    assert queue.failed == [(1, "boom")]
+
+def test_job_over_its_attempts_fails_without_running(monkeypatch):
+    jobs = [make_job(id=1, attempts=worker.JOB_MAX_ATTEMPTS + 1),
+            make_job(id=2, total_attempts=worker.JOB_MAX_TOTAL_ATTEMPTS + 1)]
+    queue = QueueStub(monkeypatch, jobs, final=True)
+    ran = []
+    async def handler(job, bot): ran.append(job['id'])
+    run_worker(handler)
+    assert ran == [] and [job_id for job_id, _ in queue.failed] == [1, 2]
+
+def test_lost_lease_leaves_the_job_to_its_new_owner(monkeypatch):
+    queue = QueueStub(monkeypatch, [make_job()])
+    async def handler(job, bot): raise database.LeaseLost(job['id'])
+    run_worker(handler)
+    assert queue.failed == []
+
+def test_no_scratch_space_puts_the_job_off_without_failing_it(monkeypatch):
+    queue = QueueStub(monkeypatch, [make_job(attempts=worker.JOB_MAX_ATTEMPTS)])
+    async def handler(job, bot): raise worker.downloads.DownloadBusy("Download scratch space is full")
+    run_worker(handler)
+    assert queue.failed == [] and queue.deferred == [(1, worker.DOWNLOAD_BUSY_RETRY_DELAY)]
+
+def test_long_running_handler_keeps_its_lease(monkeypatch):
+    queue = QueueStub(monkeypatch, [make_job()])
+    renewed = []
+    async def renew_lease(job_id, worker_id): renewed.append((job_id, worker_id))
+    monkeypatch.setattr(database, "renew_lease", renew_lease)
+    monkeypatch.setattr(worker, "JOB_LEASE_SECONDS", 0.06) # Renewed every 0.02 s
+
+    after = []
+    async def claim_job(stage, worker_id, node):
+        if queue.jobs: return queue.jobs.pop(0)
+        # The handler returned: its lease is no longer renewed
+        count = len(renewed)
+        await asyncio.sleep(0.1)
+        after.append(len(renewed) - count)
+        raise asyncio.CancelledError
+    monkeypatch.setattr(database, "claim_job", claim_job)
+
+    async def handler(job, bot): await asyncio.sleep(0.2) # e.g. waiting for Gemini quota
+    run_worker(handler)
+    assert len(renewed) >= 3 and set(renewed) == {(1, "w1")} and queue.failed == []
+    assert after == [0]
+
+# --- THUMBNAILS ON ANALYSIS CACHE HITS ---
+
+class CacheHitStub:
+    """A download that is answered from the analysis cache, with the thumbnail store faked."""
+
+    def __init__(self, monkeypatch, cached, stored=(), cdn=(), page_image=None):
+        self.cached, self.stored, self.cdn = dict(cached), set(stored), set(cdn)
+        self.advanced, self.cache_updates = [], []
+        self.page_image = page_image
+        for name in ("get_cached_analysis", "touch_thumbnail", "save_thumbnail", "set_cached_thumbnail", "advance_job"):
+            monkeypatch.setattr(database, name, getattr(self, name))
+        monkeypatch.setattr(worker.thumbnails, "capture_thumbnail", self.capture_thumbnail)
+        monkeypatch.setattr(worker.metadata, "prefetch", self.prefetch)
+
+    async def get_cached_analysis(self, canonical_url=None, video_hash=None): return dict(self.cached)
+    async def touch_thumbnail(self, key): return key in self.stored
+    async def save_thumbnail(self, key, data): self.stored.add(key)
+    async def advance_job(self, job_id, worker_id, stage, payload, node=None): self.advanced.append((stage, payload))
+
+    async def set_cached_thumbnail(self, canonical_url, key, image_url):
+        self.cache_updates.append((canonical_url, key, image_url))
+        self.cached.update(thumbnail_key=key, image_url=image_url)
+
+    def capture_thumbnail(self, image_url):
+        if image_url not in self.cdn: return None, None # Expired CDN link
+        return f"key-of-{image_url}", b"webp"
+
+    def prefetch(self, url):
+        future = Future()
+        future.set_result({'title': None, 'image': self.page_image, 'description': None})
+        return future
+
+CACHED = {
+    'title': "Ramen", 'description': "", 'image_url': "https://cdn/old.jpg", 'thumbnail_key': "k1",
+    'ai_summary': "Noodles", 'category': "Recipe", 'location_str': None, 'ai_coords': None,
+}
+
+def download(stub, job):
+    asyncio.run(worker.run_download(job, None))
+    stage, payload = stub.advanced[-1]
+    assert stage == 'finalize'
+    return payload['data']
+
+def test_cache_hit_reuses_a_stored_cover_and_restarts_its_grace_period(monkeypatch):
+    stub = CacheHitStub(monkeypatch, CACHED, stored={"k1"})
+    data = download(stub, make_job())
+    assert data['thumbnail_key'] == "k1" and stub.cache_updates == []
+
+def test_resave_after_garbage_collection_captures_the_cover_again(monkeypatch):
+    # The GC deleted k1 and cleared it from the analysis cache; the old CDN link has expired
+    stub = CacheHitStub(monkeypatch, {**CACHED, 'thumbnail_key': None}, page_image="https://cdn/new.jpg",
+                        cdn={"https://cdn/new.jpg"})
+    job = make_job()
+    data = download(stub, job)
+    assert data['thumbnail_key'] == "key-of-https://cdn/new.jpg" and data['image'] == "https://cdn/new.jpg"
+    assert data['thumbnail_key'] in stub.stored
+    assert stub.cache_updates == [(job['canonical_url'], data['thumbnail_key'], "https://cdn/new.jpg")]
+
+    # The next save of the post reuses the recaptured cover
+    data = download(stub, make_job(id=2))
+    assert data['thumbnail_key'] == "key-of-https://cdn/new.jpg" and len(stub.cache_updates) == 1
+
+def test_cover_deleted_between_lookup_and_touch_is_captured_again(monkeypatch):
+    stub = CacheHitStub(monkeypatch, CACHED, stored=(), cdn={"https://cdn/old.jpg"})
+    data = download(stub, make_job())
+    assert data['thumbnail_key'] == "key-of-https://cdn/old.jpg"
+
+def test_no_cover_anywhere_saves_without_one(monkeypatch):
+    stub = CacheHitStub(monkeypatch, {**CACHED, 'thumbnail_key': None})
+    data = download(stub, make_job())
+    assert data['thumbnail_key'] is None and stub.cache_updates == []
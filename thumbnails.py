@@ -0,0 +1,102 @@
+import os
+import hashlib
+import threading
+import requests
+from io import BytesIO
+
+from settings import THUMBNAIL_DIR, THUMBNAIL_CACHE_MB, THUMBNAIL_MAX_SIZE
+
+# --- THUMBNAIL STORE ---
+# Covers are captured once at save time, shrunk to WebP and addressed by the hash of their bytes.
+# Postgres (thumbnails table) holds the canonical copy so every service can read it;
+# each process keeps a local disk cache in front of it, bounded by THUMBNAIL_CACHE_MB (LRU by mtime).
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Referer': 'https://www.instagram.com/'
+}
+
+_disk_lock = threading.Lock()
+_disk_usage = None # Bytes on disk, counted on first write
+
+def capture_thumbnail(image_url):
+    """
+    Downloads a cover image and returns (key, webp_bytes), or (None, None) if it can't be fetched.
+    Origin CDN links (Instagram especially) expire, so this must run at save time.
+    """
+    if not image_url: return None, None
+    try:
+        from PIL import Image
+        response = requests.get(image_url, headers=HEADERS, timeout=5)
+        if response.status_code != 200: return None, None
+
+        image = Image.open(BytesIO(response.content))
+        image.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+        if image.mode not in ("RGB", "RGBA"): image = image.convert("RGB")
+        out = BytesIO()
+        image.save(out, format="WEBP", quality=75, method=4)
+        data = out.getvalue()
+
+        key = hashlib.sha256(data).hexdigest()
+        put(key, data)
+        return key, data
+    except Exception as e:
+        print(f"⚠️ Thumbnail Error: {e}")
+        return None, None
+
+def path_for(key):
+    return os.path.join(THUMBNAIL_DIR, key[:2], f"{key}.webp")
+
+def get_path(key, loader=None):
+    """
+    Local file path of a thumbnail, or None.
+    On a cache miss, loader(key) is asked for the bytes (normally a DB read) and the file is cached.
+    """
+    path = path_for(key)
+    if os.path.exists(path):
+        try: os.utime(path) # Mark as recently used
+        except OSError: pass
+        return path
+    data = loader(key) if loader else None
+    if not data: return None
+    return put(key, data)
+
+def put(key, data):
+    global _disk_usage
+    path = path_for(key)
+    if os.path.exists(path): return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f: f.write(data)
+    os.replace(tmp_path, path) # Atomic, so readers never see half a file
+
+    with _disk_lock:
+        if _disk_usage is None: _disk_usage = _scan()[1]
+        else: _disk_usage += len(data)
+        if _disk_usage > THUMBNAIL_CACHE_MB * 1024 * 1024: _evict()
+    return path
+
+def _scan():
+    files, total = [], 0
+    for root, _, names in os.walk(THUMBNAIL_DIR):
+        for name in names:
+            if not name.endswith(".webp"): continue
+            full = os.path.join(root, name)
+            try: stat = os.stat(full)
+            except OSError: continue
+            files.append((stat.st_mtime, stat.st_size, full))
+            total += stat.st_size
+    return files, total
+
+def _evict():
+    """Deletes least recently used files until the cache is back under 90% of its budget."""
+    global _disk_usage
+    files, total = _scan()
+    target = THUMBNAIL_CACHE_MB * 1024 * 1024 * 0.9
+    for _, size, full in sorted(files):
+        if total <= target: break
+        try:
+            os.remove(full)
+            total -= size
+        except OSError: pass
+    _disk_usage = total
@@ -0,0 +1,87 @@
+import re
+import requests
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from cache import TTLCache
+
+# --- URL CANONICALIZATION ---
+# Different users share the same post in different shapes (tracking params, /p/ vs /reel/,
+# short links). The canonical form is what dedup and the shared analysis cache are keyed on;
+# it is a key, not necessarily a URL yt-dlp can download (see download_url).
+
+TRACKING_PARAMS = {
+    'igshid', 'igsh', 'si', 'fbclid', 'gclid', 'feature', 'is_from_webapp', 'sender_device',
+    'is_copy_url', 'share_app_id', 'share_link_id', 'ref', 'ref_src', '_r', '_t', 'utm_id',
+}
+SHORT_LINK_HOSTS = {
+    'vm.tiktok.com', 'vt.tiktok.com', 'bit.ly', 't.co', 'tinyurl.com', 'instagr.am', 'fb.watch', 'pin.it',
+}
+
+INSTAGRAM_POST_RE = re.compile(r'^/(?:[\w.]+/)?(?:p|reels?|tv)/([A-Za-z0-9_-]+)/?$')
+
+_resolved = TTLCache(maxsize=2048, ttl=24 * 3600)
+
+def resolve_short_link(url):
+    """Follows redirects of known link shorteners. Returns the original URL if that fails."""
+    hit = _resolved.get(url)
+    if hit: return hit
+    final = url
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=5,
+                                 headers={'User-Agent': 'Mozilla/5.0 (compatible; NexusBot/1.0)'})
+        if response.url: final = response.url
+    except Exception as e:
+        print(f"⚠️ Short link not resolved ({url}): {e}")
+    _resolved.set(url, final)
+    return final
+
+def canonicalize_url(url, resolve=True):
+    url = url.strip().rstrip('.,;)>]')
+    parts = urlsplit(url)
+    host = parts.netloc.lower().split('@')[-1].split(':')[0]
+
+    if resolve and host in SHORT_LINK_HOSTS:
+        resolved = resolve_short_link(url)
+        if resolved != url: return canonicalize_url(resolved, resolve=False)
+
+    host = host[4:] if host.startswith('www.') else host
+    host = host[2:] if host.startswith('m.') else host
+    path = parts.path
+
+    # Instagram: /p/X, /reel/X, /reels/X, /tv/X and /<user>/reel/X are all the same post.
+    # Only whole post paths count: sound pages (/reels/audio/X), tags (/explore/tags/p/X) and the
+    # like only get the generic cleanup below, never a post's key.
+    match = INSTAGRAM_POST_RE.match(path)
+    if host == 'instagram.com' and match:
+        return f"https://www.instagram.com/reel/{match.group(1)}/"
+
+    # TikTok: the numeric video id is unique, the @handle in front of it is not needed
+    match = re.search(r'/video/(\d+)', path)
+    if host in ('tiktok.com', 'tiktokv.com') and match: # tiktokv.com: links in TikTok data exports
+        return f"https://www.tiktok.com/video/{match.group(1)}"
+
+    # YouTube: youtu.be/X, /shorts/X and watch?v=X
+    video_id = None
+    if host == 'youtu.be':
+        video_id = path.strip('/').split('/')[0]
+    elif host in ('youtube.com', 'music.youtube.com'):
+        match = re.match(r'/(?:shorts|embed|live)/([A-Za-z0-9_-]+)', path)
+        video_id = match.group(1) if match else dict(parse_qsl(parts.query)).get('v')
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    # Anything else: drop tracking params and fragment, sort the rest
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k.lower() not in TRACKING_PARAMS and not k.lower().startswith('utm_'))
+    return urlunsplit(('https', host, path.rstrip('/') or '/', urlencode(query), ''))
+
+def download_url(url):
+    """
+    The URL to hand to yt-dlp for a link the user sent. Usually the link itself; TikTok links
+    without an @handle (data exports use tiktokv.com) get the /@/video/<id> form its extractor takes.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().split(':')[0].removeprefix('www.').removeprefix('m.')
+    match = re.search(r'/video/(\d+)', parts.path)
+    if host in ('tiktok.com', 'tiktokv.com') and match and not re.match(r'/@[^/]*/video/', parts.path):
+        return f"https://www.tiktok.com/@/video/{match.group(1)}"
+    return url
@@ -1,11 +1,15 @@
 import streamlit as st
-import psycopg2
-from psycopg2 import pool
 import hashlib
+import html
+import math
 import time
-import requests
-from io import BytesIO
-from settings import DATABASE_URL
+from settings import (
+    DATABASE_URL, VIEWER_PAGE_SIZE, VIEWER_SEARCH_LIMIT, VIEWER_CACHE_USERS, VIEWER_CACHE_TTL, VIEWER_VERSION_CHECK,
+    MAP_CELLS_PER_TILE, MAP_MAX_CLUSTERS,
+)
+from cache import TTLCache
+import database
+import thumbnails
 
 # 1. Page Config
 st.set_page_config(
@@ -15,20 +19,12 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# 2. IMAGE PROXY HELPER
-@st.cache_data(ttl=3600, show_spinner=False)
-def load_image_proxy(url):
-    if not url: return None
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://www.instagram.com/'
-        }
-        response = requests.get(url, headers=headers, timeout=3)
-        if response.status_code == 200:
-            return BytesIO(response.content)
-    except: pass
-    return None
+# 2. THUMBNAILS (served from our own store, never fetched from the origin CDN while rendering)
+# Links saved before thumbnails existed show a placeholder until
+# `python backfill.py --task thumbnail --missing-thumbnail` captures their covers.
+def thumbnail_path(thumb_key):
+    if not thumb_key: return None
+    return thumbnails.get_path(thumb_key, database.load_thumbnail)
 
 # --- DATABASE HELPERS (ROBUST POOLING) ---
 
@@ -38,7 +34,8 @@ def get_db_pool():
         st.error("CRITICAL: DATABASE_URL is missing.")
         return None
     try:
-        return psycopg2.pool.ThreadedConnectionPool(1, 10, dsn=DATABASE_URL, sslmode='require')
+        # Same pool size / prepared statement settings as the bot
+        return database.get_pool()
     except Exception as e:
         st.error(f"Failed to connect to Database: {e}")
         return None
@@ -46,22 +43,15 @@ def get_db_pool():
 def run_query(query, params=None):
     db_pool = get_db_pool()
     if not db_pool: return None
-    conn = None
     try:
-        conn = db_pool.getconn()
-        with conn.cursor() as cur:
-            cur.execute(query, params)
+        with db_pool.connection() as conn:
+            cur = conn.execute(query, params)
             if query.strip().upper().startswith("SELECT"):
-                result = cur.fetchall()
-                return result
-            else:
-                conn.commit()
-                return True
+                return cur.fetchall()
+            return True
     except Exception as e:
         print(f"DB Query Error: {e}") 
         return None
-    finally:
-        if db_pool and conn: db_pool.putconn(conn)
 
 def login_user(username, password):
     hashed = hashlib.sha256(password.encode()).hexdigest()
@@ -78,6 +68,158 @@ def login_user(username, password):
 if 'user_id' not in st.session_state:
     st.session_state.user_id = None
 
+# --- PER-USER CACHE ---
+# One entry per user, shared by all their sessions in this process: the category list and every
+# page fetched so far, valid for one library version (bumped by every write, see database.py).
+# The version is re-read at most every VIEWER_VERSION_CHECK seconds, on refresh and after a
+# delete, so ordinary reruns (typing in search, opening popovers) don't touch the database.
+
+@st.cache_resource
+def get_user_cache():
+    return TTLCache(maxsize=VIEWER_CACHE_USERS, ttl=VIEWER_CACHE_TTL)
+
+def library_version(force=False):
+    user_id = st.session_state.user_id
+    checked_user, version, checked_at = st.session_state.get('version_info', (None, 0, 0))
+    if force or checked_user != user_id or time.monotonic() - checked_at > VIEWER_VERSION_CHECK:
+        res = run_query("SELECT version FROM library_versions WHERE user_id = %s", (user_id,))
+        if res is not None: # On a DB error keep using what we had
+            version = res[0][0] if res else 0
+            st.session_state.version_info = (user_id, version, time.monotonic())
+    return version
+
+def user_entry():
+    cache, user_id = get_user_cache(), st.session_state.user_id
+    version = library_version()
+    entry = cache.get(user_id)
+    if entry is not None and entry['version'] > version:
+        # Another session already saw a newer version: catch up instead of going back
+        st.session_state.version_info = (user_id, entry['version'], time.monotonic())
+    elif entry is None or entry['version'] < version:
+        entry = {'version': version, 'categories': None, 'pages': TTLCache(maxsize=256, ttl=VIEWER_CACHE_TTL)}
+        cache.set(user_id, entry)
+    return entry
+
+def invalidate_user():
+    """Drops only this user's entry and re-reads their version (refresh button, delete)."""
+    get_user_cache().pop(st.session_state.user_id)
+    library_version(force=True)
+
+def get_categories():
+    entry = user_entry()
+    if entry['categories'] is None:
+        cats_raw = run_query("SELECT DISTINCT category FROM links WHERE user_id = %s", (st.session_state.user_id,))
+        if cats_raw is None: return []
+        entry['categories'] = sorted([c[0] for c in cats_raw if c[0] and c[0] not in ["All", "Inbox"]])
+    return entry['categories']
+
+# --- PAGINATION ---
+
+def reset_pages():
+    st.session_state.rows = []
+    st.session_state.cursor = None
+    st.session_state.has_more = False
+    st.session_state.pages_loaded = 0
+
+def load_next_page(search_q, category):
+    """
+    Appends the next PAGE_SIZE links after the cursor (fetches one extra row to know if more exist).
+    A search instead loads its VIEWER_SEARCH_LIMIT best matches at once, ranked like the bot's search.
+    """
+    search_q = search_q if database.prefix_terms(search_q) else None
+    pages = user_entry()['pages']
+    page_key = (category, search_q, st.session_state.cursor)
+    page = pages.get(page_key)
+    if page is None:
+        if search_q:
+            sql, params = database.build_search_query(
+                st.session_state.user_id, search_q, category, limit=VIEWER_SEARCH_LIMIT, prefix=True
+            )
+        else:
+            sql, params = database.build_page_query(
+                st.session_state.user_id, category, st.session_state.cursor, VIEWER_PAGE_SIZE + 1
+            )
+        page = run_query(sql, params)
+        if page is not None: pages.set(page_key, page)
+        page = page or []
+    if search_q:
+        st.session_state.rows = page
+        st.session_state.has_more = False
+        st.session_state.pages_loaded = 1
+        return
+    st.session_state.has_more = len(page) > VIEWER_PAGE_SIZE
+    page = page[:VIEWER_PAGE_SIZE]
+    st.session_state.rows += page
+    if page: st.session_state.cursor = page[-1][0]
+    st.session_state.pages_loaded += 1
+
+if 'rows' not in st.session_state:
+    reset_pages()
+
+# --- MAP ---
+# Only the visible box is queried, clustered in Postgres on a grid that follows the zoom level.
+# The box is snapped outwards to that grid, so small pans reuse the cached result.
+
+DEFAULT_MAP_VIEW = {'center': (20.0, 0.0), 'zoom': 2, 'box': (-90.0, -180.0, 90.0, 180.0)}
+
+def snap_box(south, west, north, east, zoom):
+    cell = 360.0 / (2 ** zoom * MAP_CELLS_PER_TILE)
+    south = max(-90.0, math.floor(south / cell) * cell)
+    north = min(90.0, math.ceil(north / cell) * cell)
+    if east - west >= 360:
+        west, east = -180.0, 180.0
+    else:
+        # Leaflet keeps counting past ±180 when you pan around the world
+        west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+        west, east = math.floor(west / cell) * cell, math.ceil(east / cell) * cell
+    return (south, west, north, east), cell
+
+def map_clusters(box, cell, category):
+    pages = user_entry()['pages']
+    key = ('map', box, cell, category)
+    clusters = pages.get(key)
+    if clusters is None:
+        sql, params = database.build_map_query(st.session_state.user_id, *box, cell, category, MAP_MAX_CLUSTERS)
+        clusters = run_query(sql, params)
+        if clusters is not None: pages.set(key, clusters)
+    return clusters or []
+
+def show_map(category):
+    try:
+        import folium
+        from streamlit_folium import st_folium
+    except ImportError:
+        st.info("The map needs the folium and streamlit-folium packages.")
+        return
+
+    view = st.session_state.get('map_view', DEFAULT_MAP_VIEW)
+    box, cell = snap_box(*view['box'], view['zoom'])
+    fmap = folium.Map(location=view['center'], zoom_start=view['zoom'])
+    for count, lat, lon, link_id, title, url, cat in map_clusters(box, cell, category):
+        if count == 1:
+            popup = f'<a href="{html.escape(url or "")}" target="_blank">{html.escape(title or "Saved link")}</a><br>📂 {html.escape(cat or "")}'
+            folium.Marker([lat, lon], popup=folium.Popup(popup, max_width=250), tooltip=html.escape(title or "Saved link")).add_to(fmap)
+        else:
+            folium.CircleMarker(
+                [lat, lon], radius=min(8 + 4 * math.log2(count), 30), tooltip=f"{count} saves",
+                color="#ff4b4b", fill=True, fill_opacity=0.6,
+            ).add_to(fmap)
+
+    out = st_folium(fmap, key="nexus_map", height=520, use_container_width=True,
+                    returned_objects=["bounds", "zoom", "center"])
+
+    # Panned or zoomed onto a different grid box: query that box on the next run
+    bounds = (out or {}).get("bounds") or {}
+    if bounds.get("_southWest") and out.get("zoom") is not None:
+        sw, ne = bounds["_southWest"], bounds["_northEast"]
+        new_view = {
+            'center': (out["center"]["lat"], out["center"]["lng"]), 'zoom': out["zoom"],
+            'box': (sw["lat"], sw["lng"], ne["lat"], ne["lng"]),
+        }
+        if snap_box(*new_view['box'], new_view['zoom']) != (box, cell):
+            st.session_state.map_view = new_view
+            st.rerun()
+
 # --- VIEWS ---
 
 def show_login():
@@ -95,6 +237,7 @@ def show_login():
             user_id = login_user(uname, pwd)
             if user_id:
                 st.session_state.user_id = user_id
+                reset_pages()
                 st.rerun()
             else:
                 st.error("Invalid Username or Password.")
@@ -106,10 +249,13 @@ def show_dashboard():
         st.header("My Stacks")
     with c2:
         if st.button("🔄", help="Refresh Data"):
+            invalidate_user()
+            reset_pages()
             st.rerun()
     with c3:
         if st.button("Logout"):
             st.session_state.user_id = None
+            reset_pages()
             st.rerun()
 
     # --- FILTERS ---
@@ -117,57 +263,53 @@ def show_dashboard():
     with col_search:
         search_q = st.text_input("Search", placeholder="Search titles, notes...", label_visibility="collapsed")
     with col_cat:
-        # Fetch categories dynamically using the INTERNAL user_id
-        cats_raw = run_query("SELECT DISTINCT category FROM links WHERE user_id = %s", (st.session_state.user_id,))
-        cats = ["All"]
-        if cats_raw:
-            cats += sorted([c[0] for c in cats_raw if c[0] and c[0] not in ["All", "Inbox"]])
+        # Categories of the INTERNAL user_id (cached per library version)
+        cats = ["All"] + get_categories()
         selected_cat = st.selectbox("Category", cats, label_visibility="collapsed")
 
+    view_mode = st.radio("View", ["🗂️ Stacks", "🗺️ Map"], horizontal=True, label_visibility="collapsed")
     st.divider()
 
-    # --- DATA FETCH ---
-    query = """
-        SELECT id, title, image_url, url, category, ai_summary, lat, lon 
-        FROM links WHERE user_id = %s
-    """
-    params = [st.session_state.user_id]
+    # --- DATA FETCH (KEYSET PAGINATION) ---
+    category = selected_cat if selected_cat != "All" else None
 
-    if selected_cat != "All":
-        query += " AND category = %s"
-        params.append(selected_cat)
-    
-    query += " ORDER BY id DESC"
-    
-    rows = run_query(query, tuple(params))
-    
-    if not rows:
-        st.info("No links found. Register via the Telegram Bot first!")
+    if view_mode == "🗺️ Map":
+        show_map(category)
         return
 
-    # --- CLIENT SIDE SEARCH ---
-    filtered = []
-    for r in rows:
-        title_match = search_q.lower() in r[1].lower() if r[1] else False
-        summary_match = search_q.lower() in r[5].lower() if r[5] else False
-        if not search_q or title_match or summary_match:
-            filtered.append(r)
+    # Start over from the newest item whenever the filters change, or the library changed since
+    # these rows were loaded (e.g. the bot saved something: seen within VIEWER_VERSION_CHECK seconds)
+    view_key = (search_q, category)
+    version = user_entry()['version']
+    if st.session_state.get('view_key') != view_key or st.session_state.get('rows_version') != version:
+        reset_pages()
+        st.session_state.view_key = view_key
+        st.session_state.rows_version = version
+    if not st.session_state.pages_loaded:
+        load_next_page(search_q, category)
+
+    rows = st.session_state.rows
+    if not rows:
+        if search_q: st.info("No matches.")
+        else: st.info("No links found. Register via the Telegram Bot first!")
+        return
+    if database.prefix_terms(search_q):
+        # Ranked results come in one batch instead of pages
+        limited = " (the best ones: add words to narrow it down)" if len(rows) >= VIEWER_SEARCH_LIMIT else ""
+        st.caption(f"{len(rows)} matches by relevance{limited}. Partial words count.")
 
     # --- GRID LAYOUT ---
     cols = st.columns(2)
     
-    for i, row in enumerate(filtered):
-        link_id, title, img_url, url, category, ai_summary, lat, lon = row
+    for i, row in enumerate(rows):
+        link_id, title, img_url, url, category, ai_summary, lat, lon, thumb_key = row
         
         with cols[i % 2]:
             with st.container(border=True):
                 # 1. Image Cover
-                if img_url:
-                    img_data = load_image_proxy(img_url)
-                    if img_data:
-                        st.image(img_data, use_container_width=True)
-                    else:
-                        st.warning("Image Expired")
+                img_path = thumbnail_path(thumb_key)
+                if img_path:
+                    st.image(img_path, use_container_width=True)
                 else:
                     st.markdown('<div style="height:150px; background-color:#f0f2f6; border-radius: 5px 5px 0 0; margin-bottom: 10px;"></div>', unsafe_allow_html=True)
                 
@@ -197,11 +339,21 @@ def show_dashboard():
                 
                 # 4. Delete
                 if st.button("🗑️ Remove", key=f"del_{link_id}", use_container_width=True):
-                    run_query("DELETE FROM links WHERE id = %s", (link_id,))
+                    database.delete_link(st.session_state.user_id, link_id)
+                    invalidate_user()
+                    # Drop it from the loaded pages instead of re-reading everything
+                    st.session_state.rows = [r for r in st.session_state.rows if r[0] != link_id]
+                    st.session_state.rows_version = user_entry()['version']
                     st.toast("Item removed.")
                     time.sleep(0.5)
                     st.rerun()
 
+    # --- LOAD MORE ---
+    if st.session_state.has_more:
+        if st.button("Load more", use_container_width=True):
+            load_next_page(search_q, category)
+            st.rerun()
+
 # --- MAIN APP ---
 if st.session_state.user_id:
     show_dashboard()
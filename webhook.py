@@ -0,0 +1,95 @@
+import re
+import sys
+import signal
+import asyncio
+import hashlib
+from telegram import Update
+
+import metrics
+import database
+import thumbnails
+from settings import WEBHOOK_URL, WEBHOOK_SECRET
+
+# --- WEBHOOK SERVER ---
+# One aiohttp server on PORT for everything the bot serves:
+#   POST /telegram          updates pushed by Telegram (checked against the secret token header)
+#   GET  /health (and /)    the keep-alive check
+#   GET  /metrics           Prometheus text
+#   GET  /thumbnails/<key>  saved covers (WebP), cached forever since keys are content hashes
+# An update is only put on the application's queue before answering, so Telegram never waits
+# on our handlers. Every replica re-registers the same URL at startup, so several can run
+# behind one load balancer. aiohttp is only imported in webhook mode.
+
+KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def secret_token(bot_token):
+    return WEBHOOK_SECRET or hashlib.sha256(f"nexus-webhook:{bot_token}".encode()).hexdigest()[:64]
+
+def build_app(application, secret):
+    from aiohttp import web
+
+    async def telegram_update(request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=403)
+        try: update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            print(f"⚠️ Bad webhook payload: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response(text="ok")
+
+    async def health(request):
+        return web.Response(text="Nexus Bot is Alive")
+
+    async def metrics_page(request):
+        body = await asyncio.to_thread(metrics.render) # Collectors may query the database
+        return web.Response(body=body.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def thumbnail(request):
+        key = request.match_info["key"].removesuffix(".webp")
+        if not KEY_RE.match(key): raise web.HTTPNotFound()
+        path = await asyncio.to_thread(thumbnails.get_path, key, database.load_thumbnail)
+        if not path: raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={
+            "Content-Type": "image/webp", "Cache-Control": "public, max-age=31536000, immutable",
+        })
+
+    app = web.Application()
+    app.add_routes([
+        web.post("/telegram", telegram_update),
+        web.get("/", health),
+        web.get("/health", health),
+        web.get("/metrics", metrics_page),
+        web.get("/thumbnails/{key}", thumbnail),
+    ])
+    return app
+
+async def serve(application, port, post_init=None, post_shutdown=None):
+    """Runs the bot in webhook mode until SIGINT/SIGTERM (replaces application.run_polling())."""
+    from aiohttp import web
+
+    secret = secret_token(application.bot.token)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
+
+    runner = web.AppRunner(build_app(application, secret), access_log=None)
+    async with application: # initialize() ... shutdown()
+        # run_polling() calls these hooks itself; here it is up to us
+        if post_init: await post_init(application)
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        url = f"{WEBHOOK_URL.rstrip('/')}/telegram"
+        await application.bot.set_webhook(url=url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        print(f"✅ Webhook server listening on port {port}, Telegram pushes to {url}")
+        sys.stdout.flush()
+        try:
+            await stop.wait()
+        finally:
+            # The webhook stays registered: other replicas (or the next deploy) keep receiving
+            await runner.cleanup()
+            await application.stop()
+            if post_shutdown: await post_shutdown(application)
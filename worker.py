@@ -0,0 +1,402 @@
+import asyncio
+import os
+import sys
+import uuid
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Bot
+
+import database
+import geo
+import ai_engine
+import scraper
+import metadata
+import embeddings
+import thumbnails
+import media
+import metrics
+import downloads
+from settings import (
+    TELEGRAM_BOT_TOKEN, NODE_NAME, JOB_POLL_INTERVAL, JOB_MAX_ATTEMPTS, JOB_MAX_TOTAL_ATTEMPTS,
+    INGEST_DOWNLOAD_WORKERS, INGEST_ANALYZE_WORKERS, INGEST_FINALIZE_WORKERS, WORKER_METRICS_PORT,
+    FINALIZE_BATCH_SIZE, FINALIZE_BATCH_WINDOW, INGEST_THREADS, NODE_HEARTBEAT_INTERVAL, NODE_DEAD_AFTER,
+    THUMBNAIL_GC_GRACE_HOURS, DOWNLOAD_BUSY_RETRY_DELAY, EMBEDDING_REWRITE_LOG_HOURS, JOB_LEASE_SECONDS,
+)
+
+# Blocking ingest work runs on its own threads; the loop's default pool stays free for
+# interactive work (Ask Nexus search and embedding) when both run in the bot process.
+_ingest_pool = None
+
+async def run_blocking(fn, *args):
+    global _ingest_pool
+    if _ingest_pool is None: _ingest_pool = ThreadPoolExecutor(INGEST_THREADS, thread_name_prefix="ingest")
+    return await asyncio.get_running_loop().run_in_executor(_ingest_pool, functools.partial(fn, *args))
+
+# --- TELEGRAM HELPERS ---
+
+async def set_status(bot, job, text):
+    if not job['status_message_id']: return
+    try: await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['status_message_id'], text=text)
+    except: pass
+
+async def clear_status(bot, job):
+    if not job['status_message_id']: return
+    try: await bot.delete_message(chat_id=job['chat_id'], message_id=job['status_message_id'])
+    except: pass
+
+async def update_group_progress(bot, job):
+    """Multi-link messages share one progress message, refreshed whenever one of their links ends."""
+    if not job['progress_message_id']: return
+    try:
+        counts = await database.group_progress(job['chat_id'], job['progress_message_id'])
+        done, failed, total = counts.get('done', 0), counts.get('failed', 0), sum(counts.values())
+        if done + failed >= total: text = f"✅ Saved {done} of {total} links"
+        else: text = f"📥 Saving {total} links: {done + failed}/{total} finished"
+        if failed: text += f" ({failed} failed)"
+        await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['progress_message_id'], text=text)
+    except: pass
+
+# --- BATCHED SAVES ---
+
+class LinkBatcher:
+    """
+    Group commit for the finalize stage: saves arriving within FINALIZE_BATCH_WINDOW seconds
+    (or FINALIZE_BATCH_SIZE of them) go to Postgres as one multi-row INSERT, which also marks
+    their jobs done. Each caller still waits until its own row is committed, and gets back
+    whether it was new (False: the user already had that link).
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+        self.flushing = set()
+
+    async def save(self, job, data):
+        """job: (job_id, worker_id) of the finalize job saving this link."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((job, data, future))
+        if len(self.pending) >= FINALIZE_BATCH_SIZE:
+            if self.timer: self.timer.cancel()
+            self._start_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(FINALIZE_BATCH_WINDOW, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch: return
+        task = asyncio.create_task(self._flush(batch))
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await database.save_links([(job, data) for job, data, _ in batch])
+        except Exception as e:
+            # One bad row must not fail the others: retry them one by one
+            print(f"⚠️ Batch save of {len(batch)} links failed, retrying one by one: {e}")
+            results = []
+            for job, data, _ in batch:
+                try: results += await database.save_links([(job, data)])
+                except Exception as row_error:
+                    results.append(row_error)
+        for (_, _, future), result in zip(batch, results):
+            if future.done(): continue # Caller was cancelled
+            if isinstance(result, Exception): future.set_exception(result)
+            else: future.set_result(result)
+
+link_batcher = LinkBatcher()
+
+# --- PIPELINE STAGES ---
+# Each stage takes a claimed job, does its work and hands the job to the next stage.
+
+def cached_payload(job, cached, data=None):
+    """Finalize payload built from a previous analysis of the same post (or the same video)."""
+    if data is None:
+        data = {
+            'url': job['url'], 'title': cached['title'], 'image': cached['image_url'],
+            'description': cached['description'], 'video_path': None, 'thumbnail_key': cached['thumbnail_key']
+        }
+    return {
+        'data': data, 'ai_summary': cached['ai_summary'], 'category': cached['category'],
+        'location_str': cached['location_str'], 'ai_coords': cached['ai_coords']
+    }
+
+async def cached_cover(job, cached):
+    """
+    (thumbnail_key, image_url) for a link answered from the analysis cache. The stored cover's
+    grace period restarts, so the garbage collector can't delete it before this link is saved.
+    A cover it already deleted is captured again: from the cached image URL, or from the page
+    if that CDN link has expired.
+    """
+    key, image = cached['thumbnail_key'], cached['image_url']
+    if key and await database.touch_thumbnail(key): return key, image
+
+    async with metrics.timer("thumbnail"):
+        key, thumb = await run_blocking(thumbnails.capture_thumbnail, image)
+        if not key:
+            try: page = await asyncio.wrap_future(metadata.prefetch(job['url']))
+            except Exception: page = {}
+            if page.get('image'):
+                key, thumb = await run_blocking(thumbnails.capture_thumbnail, page['image'])
+                if key: image = page['image']
+        if not key: return None, image
+        await database.save_thumbnail(key, thumb)
+        await database.set_cached_thumbnail(job['canonical_url'] or job['url'], key, image)
+    return key, image
+
+async def early_preview(bot, job, meta):
+    """Title into the status message and the cover captured while the video still downloads."""
+    try: page = await asyncio.wrap_future(meta)
+    except Exception: return None, None
+    if page['title']: await set_status(bot, job, f"📥 Downloading: {page['title'][:80]}")
+    if not page['image']: return None, None
+    return await run_blocking(thumbnails.capture_thumbnail, page['image'])
+
+async def run_download(job, bot):
+    # Someone already saved this post: reuse that analysis, no download and no Gemini call
+    cached = await database.get_cached_analysis(canonical_url=job['canonical_url'] or job['url'])
+    if cached:
+        cached['thumbnail_key'], cached['image_url'] = await cached_cover(job, cached)
+        await database.advance_job(job['id'], job['locked_by'], 'finalize', cached_payload(job, cached))
+        return
+
+    await set_status(bot, job, "📥 Downloading...")
+    # The page's head arrives long before the video: show the title and grab the cover meanwhile
+    meta = metadata.prefetch(job['url'])
+    preview = asyncio.create_task(early_preview(bot, job, meta))
+    try: data = await run_blocking(scraper.download_and_scrape_blocking, job['url'], meta)
+    except BaseException:
+        preview.cancel()
+        raise
+
+    # Keep our own copy of the cover now, before the CDN link expires
+    async with metrics.timer("thumbnail"):
+        key, thumb = await preview
+        if not key: key, thumb = await run_blocking(thumbnails.capture_thumbnail, data['image'])
+        if key: await database.save_thumbnail(key, thumb)
+    data['thumbnail_key'] = key
+
+    if data['video_path']:
+        # Same video reposted under another URL
+        video_hash = await run_blocking(scraper.fingerprint_video, data['video_path'])
+        cached = await database.get_cached_analysis(video_hash=video_hash)
+        if cached:
+            downloads.release(data['video_path'])
+            data['video_path'] = None
+            await database.advance_job(job['id'], job['locked_by'], 'finalize', cached_payload(job, cached, data))
+            return
+
+        # The video only exists on this node, so the analyze stage must run here too
+        payload = {'data': data, 'video_hash': video_hash}
+        await database.advance_job(job['id'], job['locked_by'], 'analyze', payload, NODE_NAME)
+    else:
+        payload = {'data': data, 'ai_summary': "⚠️ Restricted/Unreachable content.", 'category': "Inbox"}
+        await database.advance_job(job['id'], job['locked_by'], 'finalize', payload)
+
+async def run_analyze(job, bot):
+    data = job['payload']['data']
+    if not os.path.exists(data['video_path'] or ""):
+        # Lost the file (e.g. container restart) - fetch it again
+        await database.advance_job(job['id'], job['locked_by'], 'download', {})
+        return
+
+    await set_status(bot, job, "🧠 Watching...")
+    upload_path = data['video_path']
+    try:
+        async with metrics.timer("video_reduction"):
+            upload_path, mime_type = await run_blocking(media.reduce_video, data['video_path'])
+        ai_summary, ai_category, location_str, ai_coords = await ai_engine.analyze_with_video(
+            upload_path, data['title'], data['description'], data['url'], mime_type
+        )
+    finally:
+        # Removes the download and the reduced copy next to it
+        downloads.release(data['video_path'])
+
+    if not ai_summary.startswith("⚠️"):
+        # Share the result with everyone who saves this post (or this video) later
+        await database.save_cached_analysis(
+            job['canonical_url'] or job['url'], job['payload'].get('video_hash'), data,
+            ai_summary, ai_category, location_str, ai_coords
+        )
+
+    payload = {
+        'data': data, 'ai_summary': ai_summary, 'category': ai_category,
+        'location_str': location_str, 'ai_coords': ai_coords
+    }
+    await database.advance_job(job['id'], job['locked_by'], 'finalize', payload)
+
+async def run_finalize(job, bot):
+    payload = job['payload']
+    data = payload['data']
+    ai_summary, ai_category = payload['ai_summary'], payload['category']
+    location_str, ai_coords = payload.get('location_str'), payload.get('ai_coords')
+
+    lat, lon = None, None
+    if location_str:
+        async with metrics.timer("geocode"):
+            lat, lon = await run_blocking(geo.get_best_coordinates, location_str)
+        if not lat and ai_coords: lat, lon = ai_coords
+
+    async with metrics.timer("embed"):
+        embedding = await run_blocking(embeddings.embed_document, f"{data['title']}\n{ai_summary}")
+
+    save_data = {
+        'url': data['url'], 'title': data['title'], 'image': data['image'],
+        'ai_summary': ai_summary, 'category': ai_category, 'user_id': job['user_id'],
+        'lat': lat, 'lon': lon, 'thumbnail_key': data.get('thumbnail_key'), 'canonical_url': job['canonical_url'],
+        'location_str': location_str, 'embedding': embedding
+    }
+    async with metrics.timer("db_save"):
+        is_new = await link_batcher.save((job['id'], job['locked_by']), save_data) # Also marks the job done
+    if job['quiet']: return # Bulk imports report progress for the whole import instead
+    if not is_new: # Saved by another job in the meantime (e.g. sent twice)
+        await set_status(bot, job, "⚠️ Already Saved.")
+        await update_group_progress(bot, job)
+        return
+
+    await clear_status(bot, job)
+    chat_id = job['chat_id']
+
+    display_text = f"📂 {ai_category}\n{data['title']}\n\n"
+    if location_str and lat: display_text += f"📍 Found: {location_str}\n"
+    if ai_summary: display_text += f"📝 Analysis:\n{ai_summary[:200]}..."
+
+    async with metrics.timer("telegram_reply"):
+        try:
+            if lat and lon:
+                try: await bot.send_location(chat_id=chat_id, latitude=lat, longitude=lon)
+                except: pass
+            if data['image']: await bot.send_photo(chat_id=chat_id, photo=data['image'], caption=display_text[:1000])
+            else: await bot.send_message(chat_id=chat_id, text=display_text[:1000])
+        except: await bot.send_message(chat_id=chat_id, text=f"Saved: {data['title']}")
+    await update_group_progress(bot, job)
+
+STAGES = {
+    'download': (run_download, INGEST_DOWNLOAD_WORKERS),
+    'analyze': (run_analyze, INGEST_ANALYZE_WORKERS),
+    'finalize': (run_finalize, INGEST_FINALIZE_WORKERS),
+}
+
+# --- WORKER LOOP ---
+
+async def keep_lease(job, worker_id):
+    """
+    Renews a job's lease while its handler runs: analyze can wait on the quota governor, an
+    upload slot and Gemini's processing for longer than JOB_LEASE_SECONDS.
+    """
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await database.renew_lease(job['id'], worker_id)
+        except database.LeaseLost:
+            return # The handler's next write raises LeaseLost too
+        except Exception as e:
+            print(f"⚠️ Lease renewal failed for job {job['id']}: {e}")
+            sys.stdout.flush()
+
+async def stage_worker(stage, handler, bot, worker_id):
+    while True:
+        try:
+            job = await database.claim_job(stage, worker_id, NODE_NAME)
+        except Exception as e:
+            print(f"❌ Queue Error ({stage}): {e}")
+            sys.stdout.flush()
+            await asyncio.sleep(JOB_POLL_INTERVAL * 5)
+            continue
+
+        if not job:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        try:
+            if job['attempts'] > JOB_MAX_ATTEMPTS or job['total_attempts'] > JOB_MAX_TOTAL_ATTEMPTS:
+                # Lease expired one time too many (the job keeps killing its worker),
+                # or it keeps bouncing between stages
+                raise RuntimeError("Too many attempts")
+            lease = asyncio.create_task(keep_lease(job, worker_id))
+            try:
+                async with metrics.timer(f"job_{stage}"):
+                    await handler(job, bot)
+            finally:
+                lease.cancel()
+            metrics.JOBS.inc(stage=stage, outcome="ok")
+        except downloads.DownloadBusy as e:
+            # Not the job's fault: retry it later (here or on another node) without spending an attempt
+            metrics.JOBS.inc(stage=stage, outcome="busy")
+            print(f"⏳ Job {job['id']} put off in '{stage}': {e}")
+            sys.stdout.flush()
+            try: await database.defer_job(job['id'], worker_id, DOWNLOAD_BUSY_RETRY_DELAY, e)
+            except Exception as db_error: print(f"❌ Queue Error ({stage}): {db_error}")
+        except database.LeaseLost:
+            # Another worker took the job over (or it was rescued): its result is theirs to write
+            metrics.JOBS.inc(stage=stage, outcome="lost")
+            print(f"⚠️ Job {job['id']} lost its lease in '{stage}'")
+            sys.stdout.flush()
+        except Exception as e:
+            metrics.JOBS.inc(stage=stage, outcome="error")
+            print(f"❌ Job {job['id']} failed in '{stage}': {e}")
+            sys.stdout.flush()
+            try:
+                final = await database.fail_job(job['id'], worker_id, e)
+            except Exception as db_error:
+                print(f"❌ Queue Error ({stage}): {db_error}")
+                continue
+            if final:
+                await set_status(bot, job, f"❌ Could not save: {job['url']}")
+                await update_group_progress(bot, job)
+
+def collect_queue_depth():
+    """Metrics collector: refreshes nexus_queue_depth from the jobs table on every scrape."""
+    depth = database.queue_depth()
+    for stage in STAGES:
+        for status in ('queued', 'running'):
+            metrics.QUEUE_DEPTH.set(depth.get((stage, status), 0), stage=stage, status=status)
+
+metrics.register_collector(collect_queue_depth)
+
+async def sweeper():
+    while True:
+        await ai_engine.sweep_orphan_files()
+        await asyncio.to_thread(downloads.sweep)
+        try:
+            removed = await asyncio.to_thread(database.delete_orphan_thumbnails, THUMBNAIL_GC_GRACE_HOURS)
+            if removed: print(f"🧹 Deleted {removed} thumbnails no link uses")
+        except Exception as e: print(f"⚠️ Thumbnail cleanup failed: {e}")
+        try: await asyncio.to_thread(database.prune_rewrite_log, EMBEDDING_REWRITE_LOG_HOURS)
+        except Exception as e: print(f"⚠️ Rewrite log cleanup failed: {e}")
+        await asyncio.sleep(15 * 60)
+
+async def node_keeper():
+    """Reports this node as alive and hands jobs stuck on dead nodes back to the download stage."""
+    while True:
+        try:
+            await database.heartbeat(NODE_NAME)
+            rescued = await database.rescue_pinned_jobs(NODE_DEAD_AFTER)
+            if rescued: print(f"♻️ Re-queued {len(rescued)} jobs from lost nodes for download")
+        except Exception as e:
+            print(f"⚠️ Node heartbeat failed: {e}")
+        await asyncio.sleep(NODE_HEARTBEAT_INTERVAL)
+
+async def run_workers(bot):
+    """Starts the configured number of workers for every stage and runs them forever."""
+    tasks = [asyncio.create_task(sweeper()), asyncio.create_task(node_keeper())]
+    for stage, (handler, count) in STAGES.items():
+        for i in range(count):
+            worker_id = f"{NODE_NAME}:{os.getpid()}:{stage}-{i}:{uuid.uuid4().hex[:6]}"
+            tasks.append(asyncio.create_task(stage_worker(stage, handler, bot, worker_id)))
+    print(f"⚙️ Ingest workers online on {NODE_NAME}: " + ", ".join(f"{s}={c}" for s, (_, c) in STAGES.items()))
+    sys.stdout.flush()
+    await asyncio.gather(*tasks)
+
+async def main():
+    database.init_db()
+    if WORKER_METRICS_PORT:
+        threading.Thread(target=metrics.start_http_server, args=(WORKER_METRICS_PORT,), daemon=True).start()
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        await run_workers(bot)
+
+if __name__ == '__main__':
+    asyncio.run(main())